@@ -0,0 +1,55 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Compare the available JSON codecs on a large state file
+
+import argparse
+import timeit
+from repotracker import codec
+
+
+def gen_data(repos, tags, labels):
+    """
+    Generate state data similar to what container.check_repos() returns.
+    """
+    data = {}
+    for r in range(repos):
+        repo = f"quay.io/example/repo{r}"
+        data[repo] = {}
+        for t in range(tags):
+            data[repo][f"tag{t}"] = {
+                "repo": repo,
+                "reponame": f"repo{r}",
+                "tag": f"tag{t}",
+                "digest": f"sha256:{r:032x}{t:032x}",
+                "created": "2019-04-23T16:53:28Z",
+                "labels": {f"label{i}": f"value {i} of tag{t}" for i in range(labels)},
+                "os": "linux",
+                "arch": "amd64",
+                "action": "unchanged",
+                "old_digest": None,
+            }
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the speed of the available JSON codecs"
+    )
+    parser.add_argument("--repos", type=int, default=100)
+    parser.add_argument("--tags", type=int, default=1000)
+    parser.add_argument("--labels", type=int, default=10)
+    parser.add_argument("--number", type=int, default=3)
+    args = parser.parse_args()
+    data = gen_data(args.repos, args.tags, args.labels)
+    encoded = codec.get_codec("json").dumps(data)
+    print(f"State file size: {len(encoded) / 2**20:.1f} MiB")
+    print(f"{'codec':<8} {'dumps (s)':>10} {'loads (s)':>10}")
+    for name, impl in sorted(codec.CODECS.items()):
+        assert impl.dumps(data) == encoded
+        dumps = timeit.timeit(lambda: impl.dumps(data), number=args.number)
+        loads = timeit.timeit(lambda: impl.loads(encoded), number=args.number)
+        print(f"{name:<8} {dumps / args.number:>10.3f} {loads / args.number:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
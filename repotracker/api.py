@@ -0,0 +1,136 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Python API for embedding change detection in long-running services
+
+import asyncio
+import collections
+import logging
+from repotracker import config, container, discovery, schedule, sessions, utils
+
+log = logging.getLogger(__name__)
+
+# Actions of the tags which are reported as changes
+CHANGES = ("added", "updated", "removed")
+
+ChangeEvent = collections.namedtuple("ChangeEvent", ["repo", "tag", "action", "data"])
+ChangeEvent.__doc__ = """
+A tag which has been added, updated or removed. data is the state of the tag,
+as it would be sent in a message.
+"""
+
+
+class MemoryState:
+    """
+    State of the repos kept in memory, for callers which persist it themselves,
+    or not at all.
+    """
+
+    def __init__(self, data=None):
+        self.data = data if data is not None else {}
+
+    def load(self):
+        return self.data
+
+    def save(self, data):
+        self.data = data
+
+
+class FileState:
+    """
+    State of the repos kept in a file, in the format of the command-line
+    interface, see utils.save_data().
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        return utils.load_data(self.path)
+
+    def save(self, data):
+        utils.save_data(self.path, data)
+
+
+class Tracker:
+    """
+    Check the repos of conf, a Config or a dict mapping section names to dicts
+    of options as in the config file, and report the changes relative to the
+    state kept by state, a MemoryState by default. Any object with load() and
+    save(data) methods may be used as the state.
+    The Tracker keeps the HTTP connections, CircuitBreaker, Quay host detection
+    and namespace discovery of previous checks, so it should be kept for the
+    lifetime of the caller, and closed when it is no longer needed. Checks run
+    one at a time.
+    Messages are not sent: the caller handles the events itself.
+    """
+
+    def __init__(self, conf, state=None, max_runtime=None):
+        if not isinstance(conf, config.Config):
+            conf = config.Config(conf)
+        self.conf = conf
+        self.state = MemoryState() if state is None else state
+        self.max_runtime = max_runtime
+        self.session = sessions.get_session()
+        self.breaker = container.get_breaker(conf)
+        self.detector = discovery.get_detector(conf, {})
+        self.namespaces = {}
+        self.checked = {}
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def iter_changes(self, repos=None):
+        """
+        Check all repos, or only the repos in the list, which must be in the
+        config, and yield a ChangeEvent for each tag which has changed. Repos
+        which could not be checked keep their previous state, as described in
+        container.check_repo(), and yield no events.
+        The new state is saved once the iterator has been exhausted. If it is
+        abandoned before then, the state is left unchanged, and the same
+        changes are reported by the next check.
+        """
+        conf = self.conf if repos is None else config.select(self.conf, repos=repos)
+        previous = self.state.load()
+        new_data = {}
+        ignored = None
+        for repo, tag, result in container.iter_repos(
+            conf,
+            previous,
+            breaker=self.breaker,
+            deadline=schedule.Deadline(self.max_runtime),
+            checked=self.checked,
+            detector=self.detector,
+            namespaces=self.namespaces,
+            session=self.session,
+        ):
+            new_data.setdefault(repo, {})[tag] = result
+            if tag == "ignore":
+                ignored = repo
+            elif repo != ignored and result.get("action") in CHANGES:
+                yield ChangeEvent(repo, tag, result["action"], result)
+        if repos is not None:
+            data = dict(previous)
+            for repo, tags in new_data.items():
+                if not tags.get("ignore") or repo not in data:
+                    data[repo] = tags
+            new_data = data
+        self.state.save(new_data)
+
+    async def aiter_changes(self, repos=None):
+        """
+        Asynchronous version of iter_changes(). The repos are checked in a
+        worker thread, so the event loop is not blocked.
+        """
+        loop = asyncio.get_running_loop()
+        changes = self.iter_changes(repos)
+        while True:
+            event = await loop.run_in_executor(None, next, changes, None)
+            if event is None:
+                return
+            yield event
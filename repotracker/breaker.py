@@ -0,0 +1,112 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Per-host circuit breaker, to skip registries which are down
+
+import logging
+import threading
+import time
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+log = logging.getLogger(__name__)
+
+# skopeo error output indicating that the registry itself could not be reached
+SKOPEO_HOST_ERRORS = (
+    "connection refused",
+    "connection reset",
+    "i/o timeout",
+    "no such host",
+    "no route to host",
+    "tls handshake timeout",
+    "context deadline exceeded",
+    "timed out",
+    "502 bad gateway",
+    "503 service unavailable",
+    "504 gateway timeout",
+)
+
+
+class CircuitBreaker:
+    """
+    Track consecutive failures of each registry host. Once a host has failed
+    threshold times in a row, the circuit for that host opens and allow()
+    returns False until cooldown seconds have passed. A single probe request is
+    then allowed through: if it succeeds the circuit closes again, if it fails
+    the circuit stays open for another cooldown period.
+    A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, threshold=3, cooldown=300.0, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = {}
+        self.opened = {}
+        # Repos of a namespace are checked from several threads
+        self.lock = threading.Lock()
+
+    def allow(self, host):
+        """
+        Return True if a request to the host should be attempted.
+        """
+        with self.lock:
+            if host not in self.opened:
+                return True
+            if self.clock() - self.opened[host] >= self.cooldown:
+                log.info("Probing %s after %ss cool-down", host, self.cooldown)
+                # Only let one probe through until it has completed
+                self.opened[host] = self.clock()
+                return True
+            return False
+
+    def is_open(self, host):
+        """
+        Return True if the circuit of the host is open, without letting a probe
+        through as allow() does.
+        """
+        with self.lock:
+            return host in self.opened
+
+    def success(self, host):
+        with self.lock:
+            if host in self.opened:
+                log.info("%s is reachable again, closing circuit", host)
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+
+    def failure(self, host):
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.threshold and self.failures[host] >= self.threshold:
+                if host not in self.opened:
+                    log.error(
+                        "%s failed %s times in a row, skipping it for %ss",
+                        host,
+                        self.failures[host],
+                        self.cooldown,
+                    )
+                self.opened[host] = self.clock()
+
+
+def get_breaker(conf):
+    """
+    Return a CircuitBreaker configured from the polling section of the config.
+    """
+    section = conf["polling"] if "polling" in conf else {}
+    return CircuitBreaker(
+        threshold=int(section.get("failure_threshold", 3)),
+        cooldown=float(section.get("failure_cooldown", 300)),
+    )
+
+
+def is_host_failure(exc):
+    """
+    Return True if the exception indicates that the registry host is unhealthy,
+    as opposed to an error which only affects a single repo (such as a repo that
+    does not exist, or a missing token).
+    """
+    if isinstance(exc, (ConnectionError, Timeout)):
+        return True
+    if isinstance(exc, HTTPError):
+        return exc.response is None or exc.response.status_code >= 500
+    message = str(exc).lower()
+    return any(error in message for error in SKOPEO_HOST_ERRORS)
@@ -5,7 +5,26 @@
 import logging
 import argparse
 import pprint
-from repotracker import utils, container, messaging
+import signal
+import threading
+from repotracker import (
+    utils,
+    config,
+    container,
+    daemon,
+    digestindex,
+    discovery,
+    locking,
+    messaging,
+    metrics,
+    profiling,
+    query,
+    runner,
+    schedule,
+    shard,
+    tracing,
+    workqueue,
+)
 
 
 log = logging.getLogger(__name__)
@@ -22,13 +41,170 @@ def get_args():
     parser.add_argument(
         "-c", "--config", help="Config file", default="/etc/repotracker/repotracker.ini"
     )
+    parser.add_argument(
+        "-C",
+        "--config-dir",
+        help="Directory of config fragments (*.ini) read after the config file, "
+        "may be given more than once. Defaults to conf.d alongside the config file",
+        action="append",
+    )
     parser.add_argument(
         "-d",
         "--data",
-        help="File used to record repo state",
+        help="File used to record repo state, compressed if the name ends in .gz, .xz or .zst",
         default="/var/lib/repotracker/containers/repotracker-containers.json",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "-s",
+        "--stream",
+        help="Process tags as they are retrieved, without keeping the state of "
+        "whole repos in memory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-runtime",
+        help="Stop checking repos after this many seconds, keeping the previous "
+        "state of the repos which were not reached. Repos are checked in order of "
+        "priority, least recently checked first",
+        type=float,
+    )
+    parser.add_argument(
+        "--shard",
+        help="Only check the repos of this shard, INDEX/COUNT with INDEX counting "
+        "from 0. Sections are assigned to shards by consistent hashing of their "
+        "names, and each shard should use its own data file",
+        type=shard.parse_shard,
+    )
+    parser.add_argument(
+        "--merge",
+        help="Merge the data files of shards into the data file, without "
+        "checking any repos",
+        nargs="+",
+        metavar="SHARD_DATA",
+    )
+    parser.add_argument(
+        "--queue",
+        help="SQLite database, which may be on a shared volume, holding a job for "
+        "each repo section. The repos are checked by this process and any workers "
+        "using the same queue, then messages are sent and the state saved",
+    )
+    parser.add_argument(
+        "--worker",
+        help="Only run jobs from the queue, without sending messages or saving "
+        "the state",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--worker-wait",
+        help="With --worker, wait this many seconds for jobs to be queued before "
+        "exiting, default 60",
+        type=float,
+        default=60.0,
+    )
+    parser.add_argument(
+        "--only",
+        help="Only check the repos of this section, merging them into the "
+        "existing state. May be given more than once",
+        action="append",
+        metavar="SECTION",
+    )
+    parser.add_argument(
+        "--only-repo",
+        help="Only check this repo, which must be in a container or namespace "
+        "section, merging it into the existing state. May be given more than once",
+        action="append",
+        metavar="REPO",
+    )
+    parser.add_argument(
+        "--lock",
+        help="What to do when another run is using the data file: skip this run "
+        "(the default), wait for the other run to finish, or only lock the repos "
+        "being checked, so runs over different repos can overlap, merging the "
+        "state when it is saved. Runs which lock repos are skipped while another "
+        "run is checking all repos, and the other way round",
+        choices=["skip", "wait", "repo"],
+        default="skip",
+    )
+    parser.add_argument(
+        "--daemon",
+        help="Keep running, checking all repos every --poll-interval seconds, and "
+        "individual repos when Quay reports a push to them through --listen",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        help="Seconds between checks of all repos in daemon mode (default 3600)",
+        type=float,
+        default=3600.0,
+    )
+    parser.add_argument(
+        "--listen",
+        help="Accept Quay repository notification webhooks at [HOST:]PORT in "
+        "daemon mode. HOST defaults to 127.0.0.1",
+        type=daemon.parse_address,
+    )
+    parser.add_argument(
+        "--query-listen",
+        help="Answer queries about the state of the repos at [HOST:]PORT. In "
+        "daemon mode the state is refreshed after each check, otherwise the data "
+        "file is served, without checking any repos, and reloaded when it changes",
+        type=daemon.parse_address,
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Write Prometheus metrics of the run to this file, for the textfile "
+        "collector of the node exporter. In daemon mode it is rewritten after "
+        "each check",
+    )
+    parser.add_argument(
+        "--metrics-listen",
+        help="Serve Prometheus metrics at http://[HOST:]PORT/metrics in daemon "
+        "mode. HOST defaults to 127.0.0.1",
+        type=daemon.parse_address,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Save a cProfile dump of each phase of the run to this directory, "
+        "and print a summary of the time and peak memory of each phase, and of "
+        "the functions taking the most time",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--trace",
+        help="Record a span for each repo check, page fetch, skopeo call, diff, "
+        "message batch and state load or save, and write them to this file",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--trace-format",
+        help="Format of the --trace file: JSON lines (the default), or the "
+        "Trace Event Format of the Chrome trace viewer and Perfetto",
+        choices=tracing.FORMATS,
+        default="jsonl",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    lookup_parser = subparsers.add_parser(
+        "lookup",
+        help="Print the repo:tag of each tag pointing at a digest, from the digest "
+        "index kept alongside the data file",
+    )
+    lookup_parser.add_argument("digest")
+    args = parser.parse_args()
+    if args.daemon and (args.stream or args.queue or args.only or args.only_repo):
+        parser.error(
+            "--daemon cannot be used with --stream, --queue, --only or --only-repo"
+        )
+    if (args.profile or args.trace) and args.daemon:
+        parser.error("--profile and --trace cannot be used with --daemon")
+    if args.metrics_listen and not args.daemon:
+        parser.error("--metrics-listen requires --daemon")
+    if args.worker and not args.queue:
+        parser.error("--worker requires --queue")
+    if args.lock == "repo" and args.stream:
+        parser.error("--lock repo cannot be used with --stream")
+    if (args.only or args.only_repo) and args.stream:
+        parser.error("--only and --only-repo cannot be used with --stream")
+    return args
 
 
 def main():
@@ -37,21 +213,298 @@ def main():
         logging.basicConfig(level=logging.ERROR)
     else:
         logging.basicConfig(level=logging.INFO)
-    conf = utils.load_config(args.config)
-    data = utils.load_data(args.data)
-    new_data = container.check_repos(conf, data)
+    if args.command == "lookup":
+        lookup(args)
+        return
+    signal.signal(signal.SIGTERM, terminate)
+    if args.profile:
+        profiling.profiler.start(args.profile)
+    if args.trace:
+        tracing.tracer.start()
+    try:
+        with tracing.tracer.span("run"):
+            if args.worker or (args.query_listen and not args.daemon):
+                run(args)
+                return
+            try:
+                with locking.run_lock(
+                    args.data, wait=args.lock == "wait", shared=args.lock == "repo"
+                ):
+                    run(args)
+            except locking.LockHeld as exc:
+                log.warning("%s, skipping this run", exc)
+    finally:
+        if args.trace:
+            tracing.tracer.write(args.trace, args.trace_format)
+        if args.metrics_file:
+            metrics.write_textfile(args.metrics_file)
+        if args.profile:
+            profiling.profiler.stop()
+
+
+def terminate(signum, frame):
+    """
+    Kill the skopeo commands which are running, as they are in process groups of
+    their own, then exit.
+    """
+    log.warning("Terminating, killing running skopeo commands")
+    runner.kill_running()
+    raise SystemExit(128 + signum)
+
+
+def run(args):
+    if args.merge:
+        merge(args)
+        return
+    if args.query_listen and not args.daemon:
+        serve_state(args)
+        return
+    with profiling.profiler.phase("config_load"), tracing.tracer.span("load_config"):
+        conf = config.load(
+            args.config, args.config_dir, get_config_cache_path(args.data)
+        )
+    if args.shard:
+        conf = shard.filter_config(conf, *args.shard)
+    if args.only or args.only_repo:
+        conf = config.select(conf, args.only or (), args.only_repo or ())
+    with profiling.profiler.phase("state_load"), metrics.registry.timer(
+        "repotracker_state_seconds", operation="load"
+    ), tracing.tracer.span("load_state"):
+        data = utils.load_data(args.data)
+    quay_hosts = utils.load_data(get_quay_hosts_path(args.data))
+    options = {
+        "deadline": schedule.Deadline(args.max_runtime),
+        "checked": None,
+        "detector": discovery.get_detector(conf, quay_hosts),
+        "namespaces": utils.load_data(get_namespaces_path(args.data)),
+    }
+    if args.lock == "repo":
+        options["repo_locks"] = locking.RepoLocks(args.data, data)
+    if args.max_runtime is not None:
+        options["checked"] = utils.load_data(get_schedule_path(args.data))
+    try:
+        if args.daemon:
+            run_daemon(args, conf, data, options)
+        elif args.worker:
+            queue = workqueue.WorkQueue(args.queue)
+            workqueue.run_worker(queue, conf, wait=args.worker_wait, **options)
+            queue.close()
+            return
+        elif args.stream and not args.queue:
+            stream(args, conf, data, options)
+        else:
+            poll(args, conf, data, options)
+    finally:
+        # The repos stay locked until their new state has been saved
+        if args.lock == "repo":
+            options["repo_locks"].release_all()
+    if options["checked"] is not None:
+        utils.save_data(get_schedule_path(args.data), options["checked"])
+    if quay_hosts:
+        utils.save_data(get_quay_hosts_path(args.data), quay_hosts)
+    if options["namespaces"]:
+        utils.save_data(get_namespaces_path(args.data), options["namespaces"])
+
+
+def get_schedule_path(path):
+    """
+    Return the path of the file recording when each repo was last checked,
+    alongside the state file.
+    """
+    return path + ".schedule"
+
+
+def get_config_cache_path(path):
+    """
+    Return the path of the file caching the parsed config, alongside the state
+    file.
+    """
+    return path + ".confcache"
+
+
+def get_namespaces_path(path):
+    """
+    Return the path of the file caching the repos discovered in each namespace,
+    alongside the state file.
+    """
+    return path + ".namespaces"
+
+
+def get_quay_hosts_path(path):
+    """
+    Return the path of the file caching which registry hosts support the Quay
+    API, alongside the state file.
+    """
+    return path + ".quayhosts"
+
+
+def poll(args, conf, data, options):
+    """
+    Check all repos, then send messages and save the new state. With a queue,
+    the repos are checked by the workers of the queue, including this process.
+    """
+    with profiling.profiler.phase("check_repos"):
+        if args.queue:
+            queue = workqueue.WorkQueue(args.queue)
+            new_data = workqueue.check_repos(queue, conf, data, **options)
+            queue.close()
+        else:
+            new_data = container.check_repos(conf, data, **options)
     if args.verbose:
         pprint.pprint(new_data)
     try:
-        messaging.send_container_updates(conf, new_data)
+        with profiling.profiler.phase("send_container_updates"):
+            messaging.send_container_updates(conf, new_data, data)
     except:
         log.error(
             "Could not send all messages, container state will not be updated. "
             "May result in duplicate messages."
         )
         raise
-    else:
-        utils.save_data(args.data, new_data)
+    with profiling.profiler.phase("save_data"), tracing.tracer.span("save_state"):
+        index = digestindex.DigestIndex(args.data)
+        try:
+            if args.lock == "repo" or args.only or args.only_repo:
+                # Only the repos checked by this run are updated in the index,
+                # unless it no longer matches the state file, in which case it
+                # is rebuilt from the merged state
+                rebuild = not index.is_current()
+                if not rebuild:
+                    index.update_repos(new_data, data)
+                with metrics.registry.timer(
+                    "repotracker_state_seconds", operation="save"
+                ):
+                    merged = locking.merge_on_save(
+                        args.data, new_data, lock=args.lock == "repo"
+                    )
+                if rebuild:
+                    index.update(merged, {}, rebuild=True)
+            else:
+                index.update(new_data, data)
+                with metrics.registry.timer(
+                    "repotracker_state_seconds", operation="save"
+                ):
+                    utils.save_data(args.data, new_data)
+            index.commit()
+        finally:
+            index.rollback()
+            index.close()
+
+
+def run_daemon(args, conf, data, options):
+    """
+    Run checks in daemon mode until the process is interrupted or terminated.
+    """
+    options = {key: value for key, value in options.items() if key != "deadline"}
+    digests = digestindex.DigestIndex(args.data)
+    runner = daemon.Daemon(
+        conf,
+        args.data,
+        data,
+        options,
+        args.poll_interval,
+        args.max_runtime,
+        digests=digests,
+    )
+    servers = []
+    if args.metrics_file:
+        runner.on_update.append(lambda data: metrics.write_textfile(args.metrics_file))
+    if args.metrics_listen:
+        servers.append(metrics.serve(args.metrics_listen))
+    if args.listen:
+        servers.append(daemon.serve(runner, args.listen))
+    if args.query_listen:
+        index = query.StateIndex(data)
+        runner.on_update.append(index.update)
+        servers.append(query.serve(index, args.query_listen))
+    signal.signal(signal.SIGTERM, lambda signum, frame: runner.stop())
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+        digests.close()
+    log.info("Daemon stopped")
+
+
+def serve_state(args):
+    """
+    Answer queries about the state in the data file until the process is
+    interrupted or terminated.
+    """
+    server = query.serve(query.StateIndex(path=args.data), args.query_listen)
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+def merge(args):
+    """
+    Merge the data files of shards, and save the result to the data file.
+    """
+    merged = shard.merge_states(utils.load_data(path) for path in args.merge)
+    log.info("Merged %s repos from %s shards", len(merged), len(args.merge))
+    utils.save_data(args.data, merged)
+
+
+def stream(args, conf, data, options):
+    """
+    Check the repos, send messages and save the new state incrementally.
+    """
+    items = container.iter_repos(conf, data, **options)
+    if args.verbose:
+        items = print_items(items)
+    index = digestindex.DigestIndex(args.data)
+    try:
+        # Checks, messages and saves are interleaved when streaming
+        with profiling.profiler.phase("stream"), tracing.tracer.span("stream"):
+            utils.save_data_iter(
+                args.data,
+                index.record(
+                    messaging.send_container_updates_iter(conf, items, data), data
+                ),
+            )
+        index.commit()
+    except:
+        log.error(
+            "Could not send all messages, container state will not be updated. "
+            "May result in duplicate messages."
+        )
+        raise
+    finally:
+        index.rollback()
+        index.close()
+
+
+def lookup(args):
+    """
+    Print the tags pointing at a digest, from the digest index of the data file.
+    """
+    index = digestindex.DigestIndex(args.data)
+    try:
+        if not index.is_current():
+            log.warning(
+                "The digest index of %s is out of date, it is updated by the "
+                "next run",
+                args.data,
+            )
+        for repo, tag in index.lookup(args.digest):
+            print(f"{repo}:{tag}")
+    finally:
+        index.close()
+
+
+def print_items(items):
+    for item in items:
+        pprint.pprint(item)
+        yield item
 
 
 if __name__ == "__main__":
@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# JSON encoding and decoding of state files and message bodies
+
+import collections
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+Codec = collections.namedtuple("Codec", ["name", "dumps", "loads"])
+
+
+def _json_dumps(obj):
+    # Matches the output of orjson.dumps() byte for byte
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+CODECS = {"json": Codec("json", _json_dumps, json.loads)}
+if orjson is not None:
+    CODECS["orjson"] = Codec("orjson", orjson.dumps, orjson.loads)
+
+
+def get_codec(name=None):
+    """
+    Return the Codec with the given name, or the fastest available Codec if no
+    name is given.
+    The dumps() function of a Codec returns compact UTF-8 encoded bytes, with keys in
+    insertion order, and the output is identical whichever Codec is used.
+    The loads() function of a Codec accepts either bytes or str.
+    """
+    if name is None:
+        name = "orjson" if "orjson" in CODECS else "json"
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown or unavailable JSON codec: {name}")
+
+
+_default = get_codec()
+
+
+def dumps(obj):
+    """
+    Encode obj as JSON using the fastest available Codec.
+    Return UTF-8 encoded bytes.
+    """
+    return _default.dumps(obj)
+
+
+def loads(data):
+    """
+    Decode the JSON bytes or str using the fastest available Codec.
+    """
+    return _default.loads(data)
@@ -0,0 +1,174 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Loading the config from a file and fragment directories, with a parse cache
+
+import configparser
+import glob
+import logging
+import os
+from repotracker import utils
+
+log = logging.getLogger(__name__)
+
+# Version of the format of the parse cache, changed if Config is changed
+CACHE_VERSION = 1
+
+
+class PrefixTable:
+    """
+    Match strings against a set of prefixes, with one set lookup per distinct
+    prefix length rather than a comparison with every prefix.
+    match(value) is equivalent to value.startswith(tuple(prefixes)).
+    """
+
+    def __init__(self, prefixes):
+        self.prefixes = frozenset(prefixes)
+        self.lengths = sorted({len(prefix) for prefix in self.prefixes})
+
+    def match(self, value):
+        return any(value[:length] in self.prefixes for length in self.lengths)
+
+
+class Config(dict):
+    """
+    The parsed config, a dict mapping section names to dicts of options.
+    The container and namespace sections are found once, when the Config is
+    created.
+    tracked_repos is the set of repos with a container section of their own,
+    which are not checked again as part of a namespace. A Config holding part
+    of a larger config is given the tracked_repos of the whole config, so the
+    repos of its namespaces which are checked elsewhere are skipped.
+    """
+
+    def __init__(self, sections, tracked_repos=()):
+        super().__init__(sections)
+        self.container_sections = [
+            (section_name, section)
+            for section_name, section in self.items()
+            if section_name != "broker" and section.get("type") == "container"
+        ]
+        self.tracked_repos = frozenset(tracked_repos) | {
+            section["repo"] for section_name, section in self.container_sections
+        }
+        self.namespace_sections = [
+            (section_name, section)
+            for section_name, section in self.items()
+            if section_name != "broker" and section.get("type") == "namespace"
+        ]
+
+
+def get_files(path, dirs=None):
+    """
+    Return the list of config files to read: the file at path followed by the
+    *.ini files in each of the fragment directories in dirs, in order of name.
+    By default, fragments are read from conf.d alongside the file.
+    """
+    if dirs is None:
+        dirs = [os.path.join(os.path.dirname(path), "conf.d")]
+    files = [path]
+    for dirname in dirs:
+        files.extend(sorted(glob.glob(os.path.join(glob.escape(dirname), "*.ini"))))
+    return files
+
+
+def get_key(files):
+    """
+    Return the key identifying the current contents of the files in the cache.
+    """
+    key = []
+    for path in files:
+        st = os.stat(path)
+        key.append([path, st.st_mtime_ns, st.st_size])
+    return key
+
+
+def parse(files):
+    """
+    Parse the files into a dict mapping section names to dicts of options.
+    Sections which appear in more than one file are merged, with options from
+    later files taking precedence.
+    """
+    parser = configparser.ConfigParser()
+    for path in files:
+        with open(path) as fobj:
+            parser.read_file(fobj)
+    return {
+        section_name: dict(parser[section_name]) for section_name in parser.sections()
+    }
+
+
+def load(path, dirs=None, cache_path=None):
+    """
+    Load the config from the file at path and the fragment directories in dirs,
+    see get_files(), and return a Config.
+    If cache_path is given, the parsed config is saved there, and reused for as
+    long as the modification times and sizes of the files are unchanged.
+    """
+    files = get_files(path, dirs)
+    key = get_key(files)
+    if cache_path:
+        try:
+            cache = utils.load_data(cache_path)
+        except ValueError:
+            log.warning("Ignoring invalid config cache %s", cache_path)
+            cache = {}
+        if cache.get("version") == CACHE_VERSION and cache.get("key") == key:
+            log.debug("Using the cached config from %s", cache_path)
+            return Config(cache["sections"])
+    sections = parse(files)
+    log.info("Loaded %s config sections from %s files", len(sections), len(files))
+    if cache_path:
+        utils.save_data(
+            cache_path, {"version": CACHE_VERSION, "key": key, "sections": sections}
+        )
+    return Config(sections)
+
+
+def select(conf, sections=(), repos=()):
+    """
+    Return a Config with the sections of conf which are not repos, the repo
+    sections named in sections, and sections for the repos in repos. A repo
+    may be configured by a container section, or be in the namespace of a
+    namespace section, whose options it inherits. Names which are not in the
+    config are logged and ignored. The repos with a container section of their
+    own are not checked as part of the selected namespaces.
+    """
+    if not isinstance(conf, Config):
+        conf = Config(conf)
+    repo_types = ("container", "namespace")
+    selected = {
+        section_name: section
+        for section_name, section in conf.items()
+        if section.get("type") not in repo_types or section_name == "broker"
+    }
+    for section_name in sections:
+        if section_name in conf and conf[section_name].get("type") in repo_types:
+            selected[section_name] = conf[section_name]
+        else:
+            log.error("There is no repo section named %s", section_name)
+    for repo in repos:
+        found = find_repo(conf, repo)
+        if found is None:
+            log.error("%s is not in the config", repo)
+        else:
+            selected[found[0]] = found[1]
+    return Config(selected, conf.tracked_repos)
+
+
+def find_repo(conf, repo):
+    """
+    Return a (section_name, section) tuple for checking the repo: its container
+    section, or failing that a section derived from the namespace section it is
+    in, wherever the sections are in the config. Return None if the repo is not
+    in the config.
+    """
+    for section_name, section in conf.items():
+        if section.get("type") == "container" and section.get("repo") == repo:
+            return section_name, section
+    for section_name, section in conf.items():
+        namespace = section.get("namespace", "").rstrip("/")
+        if section.get("type") == "namespace" and repo.startswith(namespace + "/"):
+            repo_section = dict(section, type="container", repo=repo)
+            del repo_section["namespace"]
+            return f"{section_name}:{repo}", repo_section
+    return None
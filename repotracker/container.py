@@ -3,27 +3,37 @@
 # Logic for checking the state of container repos
 
 import os
+import signal
 import subprocess
 import json
 import logging
+import collections
+import contextvars
 import datetime
-from requests import Session
-from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from requests import Timeout
+from repotracker import (
+    config,
+    discovery,
+    latency,
+    metrics,
+    ratelimit,
+    runner,
+    schedule,
+    sessions,
+    tagfilter,
+    tracing,
+)
+from repotracker.breaker import get_breaker, is_host_failure
 from repotracker.utils import format_ts, format_time
 
 log = logging.getLogger(__name__)
 
-
-def get_session():
-    s = Session()
-    retries = Retry(
-        total=3,
-        backoff_factor=0.1,
-        status_forcelist=[502, 503, 504],
-    )
-    s.mount("https://", HTTPAdapter(max_retries=retries))
-    return s
+INSPECT_ARGS = ("inspect", "--no-tags", "--retry-times", "3")
 
 
 def inspect_quay_repo(repo, token=None):
@@ -41,25 +51,47 @@ def inspect_quay_repo(repo, token=None):
     - Os: the operating system of the image
     - Architecture: the processor architecture of the image
     """
-    results = {}
+    return dict(iter_quay_repo(repo, token))
+
+
+def iter_quay_repo(repo, token=None, tag_filter=None, session=None, deadline=None):
+    """
+    Inspect the repo using Quay REST API, one page of tags at a time.
+    Yield a (tag, tagdata) tuple for each tag as soon as the page containing
+    it has been retrieved. See inspect_quay_repo() for the contents of tagdata.
+    If a tagfilter.TagFilter is given, only the tags it matches are yielded,
+    and the registry is asked to filter them where possible.
+    If a requests Session is given, its connections are reused, otherwise a new
+    session is created. See get_page() for deadline.
+    """
+    # Only the names of the tags are remembered, to skip duplicates
+    seen = set()
     # Use the quay.io REST API
     hostname, reponame = repo.split("/", 1)
     headers = {}
     if token:
         headers["Authorization"] = "Bearer {0}".format(token)
-    session = get_session()
+    server_filter = tag_filter.quay_filter() if tag_filter else None
+    if session is None:
+        session = sessions.get_session()
     start = datetime.datetime.now()
     page = 1
     while True:
         url = "https://{0}/api/v1/repository/{1}/tag/?onlyActiveTags=true&limit=100&page={2}".format(
             hostname, reponame, page
         )
-        resp = session.get(url, headers=headers, timeout=60.0)
+        if server_filter:
+            url += "&filter_tag_name=" + quote(server_filter)
+        resp = get_page(session, hostname, url, headers, deadline)
         resp.raise_for_status()
+        metrics.registry.inc("repotracker_quay_pages_total", repo=repo)
         data = resp.json()
         for tag in data["tags"]:
-            if tag["name"] not in results:
-                results[tag["name"]] = {
+            if tag_filter and not tag_filter.match(tag["name"]):
+                continue
+            if tag["name"] not in seen:
+                seen.add(tag["name"])
+                yield tag["name"], {
                     "Name": repo,
                     "Tag": tag["name"],
                     "Digest": tag["manifest_digest"],
@@ -74,10 +106,72 @@ def inspect_quay_repo(repo, token=None):
     log.info(
         "Retrieved tag information for %s in %s", repo, datetime.datetime.now() - start
     )
-    return results
 
 
-def inspect_image_repo(repo, token=None):
+def get_page(session, hostname, url, headers, deadline=None):
+    """
+    Retrieve a page from the Quay API, with a timeout derived from the latency of
+    previous requests to the host. If hedging is enabled and no response has been
+    received after the p95 latency, a duplicate request is sent with a session of
+    its own, and the first response to arrive is used.
+    Requests which time out are recorded at the timeout, so the timeouts of a
+    host which has become slow can grow.
+    If a schedule.Deadline is given, the timeout is reduced so the request ends
+    by then, including its retries, and DeadlineExceeded is raised if it times
+    out because of the deadline.
+    Requests which are rate limited by the host, with a 429 response, are
+    retried up to sessions.RETRIES times, once the rate limiter allows it. If
+    the host asks us to wait beyond the deadline, DeadlineExceeded is raised.
+    """
+    timeout = latency.api.timeout(hostname)
+    capped = False
+    if deadline is not None:
+        capped_timeout = deadline.cap(timeout * (sessions.RETRIES + 1)) / (
+            sessions.RETRIES + 1
+        )
+        capped = capped_timeout < timeout
+        timeout = capped_timeout
+
+    def fetch(session):
+        ratelimit.limiter.acquire(hostname)
+        metrics.registry.inc("repotracker_http_requests_total", host=hostname)
+        start = time.monotonic()
+        try:
+            with tracing.tracer.span("fetch_page", url=url):
+                resp = session.get(url, headers=headers, timeout=timeout)
+        except Exception as exc:
+            # Read timeouts which exhausted the retries are reported as
+            # connection errors
+            if isinstance(exc, Timeout) or time.monotonic() - start >= timeout:
+                if capped:
+                    raise schedule.DeadlineExceeded("Run deadline reached") from exc
+                latency.api.record(hostname, timeout)
+            raise
+        latency.api.record(hostname, time.monotonic() - start)
+        ratelimit.limiter.update(hostname, resp)
+        return resp
+
+    def send():
+        delay = latency.api.hedge_delay(hostname)
+        if delay is None:
+            return fetch(session)
+        return latency.hedged(
+            lambda: fetch(session), delay, lambda: fetch(sessions.get_session())
+        )
+
+    for attempt in range(sessions.RETRIES + 1):
+        resp = send()
+        if resp.status_code != 429 or attempt == sessions.RETRIES:
+            return resp
+        # The rate limiter holds back the retry for as long as the host asked
+        backoff = ratelimit.parse_retry_after(resp.headers.get("Retry-After"))
+        remaining = None if deadline is None else deadline.remaining()
+        if remaining is not None and backoff >= remaining:
+            raise schedule.DeadlineExceeded("Run deadline reached")
+        log.warning("%s is rate limiting requests, retrying %s", hostname, url)
+
+
+def inspect_image_repo(repo, token=None, concurrency=1):
     """
     Inspect a generic repo using SKOPEO. Much slower than QUAY API, but should handle any repo.
     Return a dict whose keys are tag names and whose values
@@ -92,24 +186,109 @@ def inspect_image_repo(repo, token=None):
     - Os: the operating system of the image
     - Architecture: the processor architecture of the image
     """
-    results = {}
+    return dict(iter_image_repo(repo, token, concurrency))
+
+
+def iter_image_repo(
+    repo, token=None, concurrency=1, tag_filter=None, deadline=None, breaker=None
+):
+    """
+    Inspect a generic repo using SKOPEO, one tag at a time.
+    Yield a (tag, tagdata) tuple for each tag as soon as it has been inspected.
+    See inspect_image_repo() for the contents of tagdata.
+    If concurrency is greater than 1, up to that many tags are inspected at once
+    by a runner.AsyncRunner, and yielded in batches.
+    If a tagfilter.TagFilter is given, only the tags it matches are inspected.
+    See skopeo_run() for deadline.
+    Tags which cannot be inspected are skipped. If a CircuitBreaker is given,
+    those failing because the host is unhealthy are recorded against it, until
+    a tag is inspected successfully, and once its circuit opens the error is
+    raised, so the rest of the tags are not inspected.
+    """
     # Use skopeo
-    for tag in list_tags(repo):
+    tags = list_tags(repo, deadline)
+    if tag_filter:
+        tags = [tag for tag in tags if tag_filter.match(tag)]
+    if concurrency > 1:
+        yield from iter_image_tags_async(repo, tags, concurrency, deadline, breaker)
+        return
+    failed = False
+    for tag in tags:
         try:
-            results[tag] = inspect_tag(repo, tag)
-        except:
-            log.error("Could not query %s:%s", repo, tag, exc_info=True)
-    return results
+            tagdata = inspect_tag(repo, tag, deadline)
+        except schedule.DeadlineExceeded:
+            raise
+        except Exception as exc:
+            failed = inspect_failed(repo, tag, exc, breaker) or failed
+            continue
+        if failed:
+            breaker.success(repo.split("/", 1)[0])
+            failed = False
+        yield tag, tagdata
+
+
+def iter_image_tags_async(repo, tags, concurrency, deadline=None, breaker=None):
+    """
+    Inspect the tags of the repo concurrently, in batches of a few times the
+    concurrency, so the results of each batch can be yielded before the next one
+    is started. Processes which are still running at the schedule.Deadline, if
+    one is given, are killed. See iter_image_repo() for breaker.
+    """
+    async_runner = runner.AsyncRunner(concurrency, deadline=deadline)
+    batch_size = concurrency * 4
+    failed = False
+    for i in range(0, len(tags), batch_size):
+        batch = tags[i : i + batch_size]
+        procs = async_runner.run_all([(f"{repo}:{tag}", INSPECT_ARGS) for tag in batch])
+        for tag, proc in zip(batch, procs):
+            try:
+                tagdata = parse_inspect(repo, tag, proc)
+            except Exception as exc:
+                failed = inspect_failed(repo, tag, exc, breaker) or failed
+                continue
+            if failed:
+                breaker.success(repo.split("/", 1)[0])
+                failed = False
+            yield tag, tagdata
+        if deadline is not None and deadline.expired():
+            raise schedule.DeadlineExceeded("Run deadline reached")
 
 
-def inspect_tag(repo, tag):
+def inspect_failed(repo, tag, exc, breaker=None):
+    """
+    Log a tag of the repo which could not be inspected, and record the failure
+    against the host if it is unhealthy. Raise exc if the circuit of the host
+    is open, see iter_image_repo(). Return True if the failure was recorded.
+    """
+    log.error("Could not query %s:%s", repo, tag, exc_info=exc)
+    hostname = repo.split("/", 1)[0]
+    metrics.registry.inc("repotracker_errors_total", host=hostname, operation="inspect")
+    if breaker is None or not is_host_failure(exc):
+        return False
+    breaker.failure(hostname)
+    if breaker.is_open(hostname):
+        log.error("%s is unavailable, not inspecting the rest of %s", hostname, repo)
+        raise exc
+    return True
+
+
+def inspect_tag(repo, tag, deadline=None):
     """
     Inspect the contents of the tag within the given repo.
     Returns a dict describing the image referenced by the given tag.
     If the repo is not accessible, or the tag does not exist, raise an
     exception.
     """
-    proc = skopeo_run(f"{repo}:{tag}", "inspect", "--no-tags", "--retry-times", "3")
+    return parse_inspect(
+        repo, tag, skopeo_run(f"{repo}:{tag}", *INSPECT_ARGS, deadline=deadline)
+    )
+
+
+def parse_inspect(repo, tag, proc):
+    """
+    Return the dict describing the image from the CompletedProcess of a skopeo
+    inspect command, as described in inspect_tag().
+    """
     if proc.returncode:
         if (
             "manifest unknown" in proc.stderr
@@ -123,28 +302,60 @@ def inspect_tag(repo, tag):
     return json.loads(proc.stdout)
 
 
-def list_tags(repo):
+def list_tags(repo, deadline=None):
     """
     List the tags available in the given repo.
     If the repo is not available, raise an exception.
     """
-    proc = skopeo_run(repo, "list-tags", "--retry-times", "3")
+    proc = skopeo_run(repo, "list-tags", "--retry-times", "3", deadline=deadline)
     if proc.returncode:
         raise RuntimeError(f"Error listing tags for {repo}: {proc.stderr}")
     return json.loads(proc.stdout)["Tags"]
 
 
-def skopeo_run(reporef, *args):
+def skopeo_run(reporef, *args, deadline=None):
     """
     Run skopeo with the given args, against the given repo reference.
     Return the CompletedProcess object associated with the skopeo command.
+    If skopeo has not completed runner.KILL_GRACE seconds after its own timeout,
+    it is killed, and its stderr reports that it timed out.
+    If a schedule.Deadline is given, the timeout of the command is reduced so it
+    ends by then, and DeadlineExceeded is raised if it fails once the deadline
+    has expired.
     """
-    cmd = ["/usr/bin/skopeo", "--command-timeout", "60s", *args, f"docker://{reporef}"]
+    hostname = reporef.split("/", 1)[0]
+    ratelimit.limiter.acquire(hostname)
+    timeout = runner.get_timeout(hostname, deadline)
+    cmd = runner.build_cmd(reporef, *args, timeout=timeout)
+    runner.check_stopping()
     start = datetime.datetime.now()
-    proc = subprocess.run(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8"
+    with tracing.tracer.span("skopeo", cmd=" ".join(cmd)):
+        try:
+            proc = subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                encoding="utf-8",
+                timeout=timeout + runner.KILL_GRACE,
+            )
+        except subprocess.TimeoutExpired:
+            proc = subprocess.CompletedProcess(
+                cmd,
+                -signal.SIGKILL,
+                "",
+                f"repotracker: skopeo timed out after {timeout + runner.KILL_GRACE}s",
+            )
+    runtime = (datetime.datetime.now() - start).total_seconds()
+    latency.skopeo.record(hostname, runtime)
+    metrics.registry.inc(
+        "repotracker_skopeo_seconds_total", runtime, host=hostname, command=args[0]
+    )
+    metrics.registry.inc(
+        "repotracker_skopeo_processes_total", host=hostname, command=args[0]
     )
     log.info('Ran "%s" in %s', " ".join(cmd), datetime.datetime.now() - start)
+    if proc.returncode and deadline is not None and deadline.expired():
+        raise schedule.DeadlineExceeded("Run deadline reached")
     return proc
 
 
@@ -164,124 +375,542 @@ def gen_result(repo, tag, tagdata):
     }
 
 
-def check_repos(conf, data):
+def diff_tags(repo, tags, previous):
     """
-    Check the status of all repos in the config.
-    Return a list of dicts describing the state of each repo.
-    The 'action' field of each dict will indicate whether the repo has been
-    'added', 'updated', or 'removed', relative to the data provided.
+    Compare the (tag, tagdata) tuples generated by tags against the state of
+    the repo from the previous run.
+    Yield a (tag, result) tuple for each tag, where result is a dict as returned
+    by gen_result(), with additional 'action' and 'old_digest' fields. Tags which
+    existed in the previous run but are no longer present are yielded last.
     """
-    new_data = {}
-    quay_repos = ["quay.io"]
-    if "quayrepos" in conf:
-        quay_repos = conf["quayrepos"].get("repos").split(",")
-    for section_name, section in conf.items():
-        if section_name == "broker" or section.get("type") != "container":
-            continue
-        repo = section["repo"]
-        token = section.get("token_env")
-        if token:
-            token = os.environ.get(token)
-        try:
-            # Use Quay API for known Quay registries
-            if repo.startswith(tuple(quay_repos)):
-                tags = inspect_quay_repo(repo, token)
-            else:
-                tags = inspect_image_repo(repo, token)
-        except:
-            # Error communicating with the repo.
-            # Assume it's a temporary error, reuse data from the previous run.
-            log.error("Could not query %s", repo, exc_info=True)
-            if repo in data:
-                new_data[repo] = data[repo]
-                new_data[repo]["ignore"] = True
-            continue
-        repodata = {}
-        for tag, tagdata in tags.items():
-            current = gen_result(repo, tag, tagdata)
-            previous = data.get(repo, {}).get(tag, {})
-            if tagdata:
-                if previous:
-                    if previous["action"] == "removed":
-                        # Tag exists now, but it was removed on the previous run.
-                        # Treat this as a tag addition
-                        current["action"] = "added"
-                        current["old_digest"] = None
-                        log.info(
-                            "%s:%s was readded (digest %s, old_digest was %s)",
-                            repo,
-                            tag,
-                            current["digest"],
-                            previous["old_digest"],
-                        )
-                    elif current["digest"] == previous["digest"]:
-                        # Tag exists now, existed before, and has not changed
-                        current["action"] = "unchanged"
-                        current["old_digest"] = previous["old_digest"]
-                        log.info(
-                            "%s:%s is unchanged (digest %s)",
-                            repo,
-                            tag,
-                            current["digest"],
-                        )
-                    else:
-                        # Tag exists now, existed before, and has changed
-                        current["action"] = "updated"
-                        current["old_digest"] = previous["digest"]
-                        log.info(
-                            "%s:%s has been updated (digest %s, was %s)",
-                            repo,
-                            tag,
-                            current["digest"],
-                            previous["digest"],
-                        )
-                else:
-                    # Tag exists now, but did not exist before
+    seen = set()
+    for tag, tagdata in tags:
+        seen.add(tag)
+        current = gen_result(repo, tag, tagdata)
+        prev = previous.get(tag, {})
+        if tagdata:
+            if prev:
+                if prev["action"] == "removed":
+                    # Tag exists now, but it was removed on the previous run.
+                    # Treat this as a tag addition
                     current["action"] = "added"
                     current["old_digest"] = None
                     log.info(
-                        "%s:%s was added (digest %s)", repo, tag, current["digest"]
-                    )
-            else:
-                if previous:
-                    # Tag does not exist now, existed before
-                    # Rare, race condition with deletion when inspecting a repo with skopeo.
-                    current["action"] = "removed"
-                    current["old_digest"] = previous["digest"]
-                    log.info(
-                        "%s:%s has been removed (digest was %s)",
+                        "%s:%s was readded (digest %s, old_digest was %s)",
                         repo,
                         tag,
-                        previous["digest"],
+                        current["digest"],
+                        prev["old_digest"],
                     )
-                else:
-                    # Tag does not exist now, did not exist before
-                    # Should never happen, but could be a race condition with tag creation/deletion
-                    log.warning("%s:%s is a ghost", repo, tag)
-                    continue
-            repodata[tag] = current
-        for tag, previous in data.get(repo, {}).items():
-            # Skip the ignore flag
-            if tag == "ignore":
-                continue
-            # Need to check for tags that we've seen before and have been removed
-            if tag not in repodata:
-                if previous["action"] == "removed":
-                    # we already processed the removal of this tag, so we can ignore it not
+                elif current["digest"] == prev["digest"]:
+                    # Tag exists now, existed before, and has not changed
+                    current["action"] = "unchanged"
+                    current["old_digest"] = prev["old_digest"]
                     log.info(
-                        "%s:%s was previously removed (old_digest %s), ignoring",
+                        "%s:%s is unchanged (digest %s)",
                         repo,
                         tag,
-                        previous["old_digest"],
+                        current["digest"],
                     )
                 else:
-                    # Tag does not exist now, existed before
-                    current = gen_result(repo, tag, {})
-                    current["action"] = "removed"
-                    current["old_digest"] = previous["digest"]
-                    repodata[tag] = current
+                    # Tag exists now, existed before, and has changed
+                    current["action"] = "updated"
+                    current["old_digest"] = prev["digest"]
                     log.info(
-                        "%s:%s has been removed (was %s)", repo, tag, previous["digest"]
+                        "%s:%s has been updated (digest %s, was %s)",
+                        repo,
+                        tag,
+                        current["digest"],
+                        prev["digest"],
                     )
-        new_data[repo] = repodata
+            else:
+                # Tag exists now, but did not exist before
+                current["action"] = "added"
+                current["old_digest"] = None
+                log.info("%s:%s was added (digest %s)", repo, tag, current["digest"])
+        else:
+            if prev:
+                # Tag does not exist now, existed before
+                # Rare, race condition with deletion when inspecting a repo with skopeo.
+                current["action"] = "removed"
+                current["old_digest"] = prev["digest"]
+                log.info(
+                    "%s:%s has been removed (digest was %s)",
+                    repo,
+                    tag,
+                    prev["digest"],
+                )
+            else:
+                # Tag does not exist now, did not exist before
+                # Should never happen, but could be a race condition with tag creation/deletion
+                log.warning("%s:%s is a ghost", repo, tag)
+                continue
+        yield tag, current
+    for tag, prev in previous.items():
+        # Skip the ignore flag
+        if tag == "ignore":
+            continue
+        # Need to check for tags that we've seen before and have been removed
+        if tag not in seen:
+            if prev["action"] == "removed":
+                # we already processed the removal of this tag, so we can ignore it not
+                log.info(
+                    "%s:%s was previously removed (old_digest %s), ignoring",
+                    repo,
+                    tag,
+                    prev["old_digest"],
+                )
+            else:
+                # Tag does not exist now, existed before
+                current = gen_result(repo, tag, {})
+                current["action"] = "removed"
+                current["old_digest"] = prev["digest"]
+                log.info("%s:%s has been removed (was %s)", repo, tag, prev["digest"])
+                yield tag, current
+
+
+def get_sections(conf):
+    """
+    Return a list of (section_name, section) tuples for the container repos in
+    the config. A config.Config has already found them when it was loaded.
+    """
+    if isinstance(conf, config.Config):
+        return conf.container_sections
+    return [
+        (section_name, section)
+        for section_name, section in conf.items()
+        if section_name != "broker" and section.get("type") == "container"
+    ]
+
+
+def get_tracked_repos(conf):
+    """
+    Return the set of repos with a container section of their own, which are
+    skipped when the repos of namespaces are discovered, see
+    config.Config.tracked_repos.
+    """
+    if isinstance(conf, config.Config):
+        return conf.tracked_repos
+    return {section["repo"] for section_name, section in get_sections(conf)}
+
+
+def get_namespace_sections(conf):
+    """
+    Return a list of (section_name, section) tuples for the namespaces in the
+    config, whose repos are discovered with the Quay API.
+    """
+    if isinstance(conf, config.Config):
+        return conf.namespace_sections
+    return [
+        (section_name, section)
+        for section_name, section in conf.items()
+        if section_name != "broker" and section.get("type") == "namespace"
+    ]
+
+
+def iter_quay_namespace(namespace, token=None):
+    """
+    List the repos in the namespace, such as quay.io/factory2, using the Quay
+    REST API, one page at a time. Yield the full name of each repo.
+    """
+    hostname, name = namespace.split("/", 1)
+    headers = {}
+    if token:
+        headers["Authorization"] = "Bearer {0}".format(token)
+    session = sessions.get_session()
+    url = "https://{0}/api/v1/repository?namespace={1}".format(hostname, quote(name))
+    next_page = None
+    while True:
+        page_url = url
+        if next_page:
+            page_url += "&next_page=" + quote(next_page)
+        resp = get_page(session, hostname, page_url, headers)
+        resp.raise_for_status()
+        data = resp.json()
+        for repo in data["repositories"]:
+            yield "{0}/{1}/{2}".format(hostname, repo["namespace"], repo["name"])
+        next_page = data.get("next_page")
+        if not next_page:
+            break
+
+
+def discover_namespace(section, data, namespaces):
+    """
+    Return the sorted list of repos in the namespace of the section.
+    The list is cached in namespaces, a dict mapping each namespace to a dict
+    with "repos" and "checked" keys, for discover_ttl seconds (1 hour by
+    default). If the repos cannot be listed, the cached list is used even if it
+    has expired, or failing that the repos of the namespace in data.
+    """
+    namespace = section["namespace"].rstrip("/")
+    ttl = float(section.get("discover_ttl", 3600))
+    cached = namespaces.get(namespace)
+    if cached and time.time() - cached["checked"] < ttl:
+        return cached["repos"]
+    token = section.get("token_env")
+    if token:
+        token = os.environ.get(token)
+    try:
+        repos = sorted(set(iter_quay_namespace(namespace, token)))
+    except Exception:
+        log.error("Could not list the repos in %s", namespace, exc_info=True)
+        if cached:
+            return cached["repos"]
+        prefix = namespace + "/"
+        return sorted(repo for repo in data if repo.startswith(prefix))
+    log.info("Found %s repos in %s", len(repos), namespace)
+    namespaces[namespace] = {"repos": repos, "checked": time.time()}
+    return repos
+
+
+def discover_namespaces(conf, data, namespaces=None):
+    """
+    Discover the repos of all the namespace sections of the config concurrently.
+    Return a list of (section, repo_sections) tuples, where repo_sections is a
+    list of (section_name, section) tuples for the repos in the namespace, which
+    inherit the options of the namespace section, such as token_env and the tag
+    filters. See discover_namespace() for namespaces.
+    Repos which have a container section of their own, or which are in more
+    than one namespace section, are only checked once, with the first of their
+    sections.
+    """
+    if namespaces is None:
+        namespaces = {}
+    sections = get_namespace_sections(conf)
+    if not sections:
+        return []
+    seen = set(get_tracked_repos(conf))
+    with ThreadPoolExecutor(max_workers=min(len(sections), 8)) as executor:
+        found = list(
+            executor.map(
+                lambda item: discover_namespace(item[1], data, namespaces), sections
+            )
+        )
+    result = []
+    for (section_name, section), repos in zip(sections, found):
+        repo_sections = []
+        for repo in repos:
+            if repo in seen:
+                log.debug(
+                    "Skipping %s in %s, it is already tracked", repo, section_name
+                )
+                continue
+            seen.add(repo)
+            repo_section = dict(section, type="container", repo=repo)
+            del repo_section["namespace"]
+            repo_sections.append((f"{section_name}:{repo}", repo_section))
+        result.append((section, repo_sections))
+    return result
+
+
+def _iter_concurrent(func, items, concurrency, buffer=100):
+    """
+    Call func on each of the items in up to concurrency threads, where func
+    returns an iterable, and yield everything it generates, in the order of the
+    items. Only a few calls are started ahead of the one being yielded, and
+    each of them may only generate buffer values ahead of the consumer, so no
+    more than concurrency * 2 * buffer values are held in memory.
+    """
+    stop = threading.Event()
+    done = object()
+
+    def put(results, value):
+        # Wait for the consumer, unless it has gone away
+        while not stop.is_set():
+            try:
+                results.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(item, results):
+        if stop.is_set():
+            return
+        generated = iter(func(item))
+        try:
+            for value in generated:
+                if not put(results, (value, None)):
+                    return
+        except Exception as exc:
+            put(results, (done, exc))
+            return
+        finally:
+            if hasattr(generated, "close"):
+                generated.close()
+        put(results, (done, None))
+
+    def drain(results):
+        while True:
+            value, exc = results.get()
+            if value is done:
+                if exc is not None:
+                    raise exc
+                return
+            yield value
+
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        for item in items:
+            results = queue.Queue(maxsize=buffer)
+            # Spans started by func are children of the current span
+            context = contextvars.copy_context()
+            executor.submit(context.run, run, item, results)
+            pending.append(results)
+            if len(pending) >= concurrency * 2:
+                yield from drain(pending.popleft())
+        while pending:
+            yield from drain(pending.popleft())
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+
+def iter_repos(
+    conf,
+    data,
+    breaker=None,
+    deadline=None,
+    checked=None,
+    detector=None,
+    namespaces=None,
+    repo_locks=None,
+    session=None,
+):
+    """
+    Check the status of all repos in the config, without building the complete
+    state of any repo in memory.
+    Yield (repo, tag, result) tuples, grouped by repo, where result is a dict
+    as described in check_repos(). See check_repo() for how errors are handled.
+    Repos on a registry host which has failed repeatedly are not queried until
+    the CircuitBreaker allows it, and the data from the previous run is reused.
+    Requests to each host are rate limited as configured, see ratelimit.configure(),
+    and their timeouts are set as described in latency.configure(). Tags of repos
+    inspected with skopeo are inspected concurrently as described in
+    runner.get_concurrency().
+    If a Deadline is given, repos which have not been completely checked when
+    it expires also reuse the data from the previous run, and are reported once
+    all repos have been handled.
+    If checked is given, it must be a dict mapping repos to the time they were
+    last checked successfully. Repos are checked in the order described in
+    schedule.order_sections(), and checked is updated as they complete.
+    Repos on Quay registries are checked with the Quay REST API, and other repos
+    with skopeo. The hosts which are Quay registries are determined by the
+    discovery.QuayDetector, see discovery.get_detector().
+    Only the tags selected by the include_tags and exclude_tags options of each
+    section are tracked, see tagfilter.get_filter().
+    The repos of namespace sections are discovered as described in
+    discover_namespaces(), with namespaces caching the result, and are checked
+    concurrently after the container sections.
+    If locking.RepoLocks are given, repos locked by another run are skipped,
+    and reuse the data from the previous run. The locks of the repos which are
+    checked are left held, for the caller to release with
+    locking.RepoLocks.release_all() once it has saved their new state.
+    If a requests Session is given, it is used for the Quay API requests of the
+    container sections, see iter_quay_repo(). Sessions are not shared between
+    threads, so each thread checking the repos of namespaces has one of its own.
+    """
+    if detector is None:
+        detector = discovery.get_detector(conf)
+    if breaker is None:
+        breaker = get_breaker(conf)
+    if deadline is None:
+        deadline = schedule.Deadline()
+    ratelimit.configure(conf)
+    latency.configure(conf)
+    concurrency = runner.get_concurrency(conf)
+    sections = get_sections(conf)
+    if checked is not None:
+        sections = schedule.order_sections(sections, checked)
+    skipped = []
+    caller = threading.current_thread()
+    local = threading.local()
+    thread_sessions = []
+
+    def get_session():
+        if session is None or threading.current_thread() is caller:
+            return session
+        if not hasattr(local, "session"):
+            local.session = sessions.get_session()
+            thread_sessions.append(local.session)
+        return local.session
+
+    def check_section(section):
+        repo = section["repo"]
+        token = section.get("token_env")
+        if token:
+            token = os.environ.get(token)
+        hostname = repo.split("/", 1)[0]
+        if deadline.expired():
+            skipped.append(repo)
+            yield from ignore_repo(repo, data)
+            return
+        if not breaker.allow(hostname):
+            log.warning("Skipping %s, %s is unavailable", repo, hostname)
+            yield from ignore_repo(repo, data)
+            return
+        if repo_locks is not None and not repo_locks.acquire(repo):
+            log.info("Skipping %s, it is being checked by another run", repo)
+            yield from ignore_repo(repo, data)
+            return
+        yield from check_section_repo(section, repo, token)
+
+    def check_section_repo(section, repo, token):
+        tag_filter = tagfilter.get_filter(section)
+        # Use Quay API for known Quay registries
+        if detector.is_quay(repo):
+            tags = iter_quay_repo(repo, token, tag_filter, get_session(), deadline)
+        else:
+            tags = iter_image_repo(
+                repo, token, concurrency, tag_filter, deadline, breaker
+            )
+        # Only the time taken by the check is measured, not that taken by the
+        # consumer of the results
+        ok = yield from metrics.registry.timed(
+            "repotracker_repo_check_seconds",
+            tracing.tracer.iterate(
+                "check_repo",
+                check_repo(repo, deadline.guard(tags), data, breaker, tag_filter),
+                repo=repo,
+            ),
+            repo=repo,
+        )
+        if ok:
+            if checked is not None:
+                checked[repo] = time.time()
+        elif deadline.expired():
+            skipped.append(repo)
+
+    for section_name, section in sections:
+        yield from check_section(section)
+    try:
+        for section, repo_sections in discover_namespaces(conf, data, namespaces):
+            if checked is not None:
+                repo_sections = schedule.order_sections(repo_sections, checked)
+            # The repos of a namespace are checked concurrently, and the results
+            # of each repo are yielded together, in order
+            yield from _iter_concurrent(
+                lambda item: check_section(item[1]),
+                repo_sections,
+                int(section.get("concurrency", 8)),
+            )
+    finally:
+        for thread_session in thread_sessions:
+            thread_session.close()
+    ratelimit.limiter.report()
+    if skipped:
+        log.warning(
+            "Run deadline reached, %s repos were not checked and kept the data "
+            "from the previous run: %s",
+            len(skipped),
+            ", ".join(skipped),
+        )
+
+
+def check_repo(repo, tags, data, breaker=None, tag_filter=None):
+    """
+    Compare the (tag, tagdata) tuples generated by tags against the data from
+    the previous run, and yield a (repo, tag, result) tuple for each tag.
+    Unchanged tags are yielded as soon as the page containing them has been
+    retrieved. Tags which have been added, updated or removed are held back
+    until the whole repo has been inspected, so that a failure part way through
+    the repo can still fall back to the data from the previous run, as
+    described in ignore_repo().
+    If a CircuitBreaker is given, the outcome is recorded against the host of
+    the repo.
+    If a tagfilter.TagFilter is given, tags from the previous run which it
+    excludes are dropped, rather than reported as removed.
+    Return True if the repo was checked successfully.
+    """
+    hostname = repo.split("/", 1)[0]
+    previous = data.get(repo, {})
+    if tag_filter:
+        previous = {
+            tag: prev
+            for tag, prev in previous.items()
+            if tag == "ignore" or tag_filter.match(tag)
+        }
+    sent = set()
+    changed = []
+    # The tags are fetched while they are compared, the spans of the fetches
+    # are siblings of the diff span rather than its children
+    tags = tracing.tracer.outside(tags)
+    try:
+        for tag, current in tracing.tracer.iterate(
+            "diff", diff_tags(repo, tags, previous), repo=repo
+        ):
+            metrics.registry.inc("repotracker_tags_total", action=current["action"])
+            if current["action"] == "unchanged":
+                sent.add(tag)
+                yield repo, tag, current
+            else:
+                changed.append((tag, current))
+    except schedule.DeadlineExceeded:
+        log.warning("Run deadline reached while checking %s", repo)
+        yield from ignore_repo(repo, data, sent)
+        return False
+    except Exception as exc:
+        # Error communicating with the repo.
+        # Assume it's a temporary error, reuse data from the previous run.
+        log.error("Could not query %s", repo, exc_info=True)
+        metrics.registry.inc(
+            "repotracker_errors_total", host=hostname, operation="check"
+        )
+        if breaker is not None:
+            if is_host_failure(exc):
+                breaker.failure(hostname)
+            else:
+                breaker.success(hostname)
+        yield from ignore_repo(repo, data, sent)
+        return False
+    if breaker is not None:
+        breaker.success(hostname)
+    for tag, current in changed:
+        yield repo, tag, current
+    return True
+
+
+def ignore_repo(repo, data, skip=()):
+    """
+    Reuse the data from the previous run for a repo which could not be queried.
+    If the repo was present in the previous run, yield (repo, "ignore", True)
+    followed by (repo, tag, tagdata) for each of its tags not in skip.
+    """
+    if repo in data:
+        yield repo, "ignore", True
+        for tag, tagdata in data[repo].items():
+            if tag != "ignore" and tag not in skip:
+                yield repo, tag, tagdata
+
+
+def check_repos(
+    conf,
+    data,
+    deadline=None,
+    checked=None,
+    detector=None,
+    namespaces=None,
+    repo_locks=None,
+    session=None,
+):
+    """
+    Check the status of all repos in the config.
+    Return a list of dicts describing the state of each repo.
+    The 'action' field of each dict will indicate whether the repo has been
+    'added', 'updated', or 'removed', relative to the data provided.
+    See iter_repos() for the other arguments.
+    """
+    new_data = {}
+    for repo, tag, result in iter_repos(
+        conf,
+        data,
+        deadline=deadline,
+        checked=checked,
+        detector=detector,
+        namespaces=namespaces,
+        repo_locks=repo_locks,
+        session=session,
+    ):
+        new_data.setdefault(repo, {})[tag] = result
     return new_data
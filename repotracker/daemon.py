@@ -0,0 +1,213 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Long-running mode, checking repos when Quay reports a push and periodically
+
+import http.server
+import json
+import logging
+import queue
+import threading
+import time
+from repotracker import config, container, messaging, metrics, schedule, utils
+
+log = logging.getLogger(__name__)
+
+
+class Daemon:
+    """
+    Check all repos every poll_interval seconds, and check individual repos as
+    soon as possible after notify() is called for them, for instance by the
+    WebhookHandler. Checks run one at a time, in the thread calling run().
+    After each check, messages are sent for the changes and the state is saved
+    to path. options are passed to container.check_repos(), with a new
+    schedule.Deadline of max_runtime seconds for each check. The callables in
+    on_update are called with the new state after it has been saved.
+    If a digestindex.DigestIndex is given, the changes of each check are
+    recorded in it as the state is saved.
+    """
+
+    def __init__(
+        self,
+        conf,
+        path,
+        data,
+        options,
+        poll_interval=3600.0,
+        max_runtime=None,
+        digests=None,
+    ):
+        self.conf = conf
+        self.path = path
+        self.data = data
+        self.options = options
+        self.poll_interval = poll_interval
+        self.max_runtime = max_runtime
+        self.digests = digests
+        self.pending = queue.Queue()
+        self.stopped = threading.Event()
+        self.on_update = []
+
+    def notify(self, repo):
+        """
+        Queue a check of the repo. Return False if it is not in the config.
+        """
+        if config.find_repo(self.conf, repo) is None:
+            log.warning("Ignoring notification for %s, it is not in the config", repo)
+            return False
+        log.info("Queueing a check of %s", repo)
+        self.pending.put(repo)
+        return True
+
+    def stop(self):
+        self.stopped.set()
+        # Wake up run()
+        self.pending.put(None)
+
+    def run(self):
+        """
+        Run checks until stop() is called, starting with a check of all repos.
+        """
+        next_poll = time.monotonic()
+        while not self.stopped.is_set():
+            timeout = next_poll - time.monotonic()
+            if timeout <= 0:
+                self.check()
+                next_poll = time.monotonic() + self.poll_interval
+                continue
+            try:
+                repo = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            repos = {repo}
+            # Coalesce the notifications received while the last check ran
+            while True:
+                try:
+                    repos.add(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            repos.discard(None)
+            if repos and not self.stopped.is_set():
+                self.check(sorted(repos))
+
+    def check(self, repos=None):
+        """
+        Check the repos, or all repos if repos is None, send messages for the
+        changes and save the state. Errors are logged, and leave the state
+        unchanged.
+        """
+        conf = self.conf if repos is None else config.select(self.conf, repos=repos)
+        options = dict(self.options, deadline=schedule.Deadline(self.max_runtime))
+        try:
+            self._check(conf, repos, options)
+        finally:
+            if options.get("repo_locks") is not None:
+                options["repo_locks"].release_all()
+
+    def _check(self, conf, repos, options):
+        try:
+            new_data = container.check_repos(conf, self.data, **options)
+            messaging.send_container_updates(self.conf, new_data, self.data)
+        except Exception:
+            log.error(
+                "Could not check %s, container state will not be updated",
+                "all repos" if repos is None else ", ".join(repos),
+                exc_info=True,
+            )
+            return
+        previous = self.data
+        if repos is None:
+            self.data = new_data
+        else:
+            data = dict(self.data)
+            for repo, tags in new_data.items():
+                if not tags.get("ignore") or repo not in data:
+                    data[repo] = tags
+            self.data = data
+        if self.digests is None:
+            self.save()
+        else:
+            self.save_digests(new_data, previous, repos)
+        for callback in self.on_update:
+            callback(self.data)
+
+    def save(self):
+        with metrics.registry.timer("repotracker_state_seconds", operation="save"):
+            utils.save_data(self.path, self.data)
+
+    def save_digests(self, new_data, previous, repos):
+        """
+        Save the state, recording the changes of new_data, the result of the
+        check of repos, relative to previous in the DigestIndex. Only the tags
+        of the repos checked are updated, unless the index no longer matches
+        the state file and is rebuilt.
+        """
+        try:
+            if not self.digests.is_current():
+                self.digests.update(self.data, {}, rebuild=True)
+            elif repos is None:
+                self.digests.update(new_data, previous)
+            else:
+                self.digests.update_repos(new_data, previous)
+            self.save()
+            self.digests.commit()
+        finally:
+            self.digests.rollback()
+
+
+def get_repo(payload):
+    """
+    Return the repo named by the payload of a Quay repository notification, such
+    as a "repo_push" webhook, or None if it does not name one.
+    """
+    if not isinstance(payload, dict):
+        return None
+    docker_url = payload.get("docker_url")
+    if isinstance(docker_url, str) and "/" in docker_url:
+        return docker_url.strip("/")
+    return None
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Accept Quay repository notifications POSTed as JSON, and queue a check of
+    the repo with the Daemon of the server.
+    """
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400, "Invalid JSON")
+            return
+        repo = get_repo(payload)
+        if repo is None:
+            self.send_error(400, "Not a repository notification")
+        elif self.server.daemon.notify(repo):
+            self.send_response(202)
+            self.end_headers()
+        else:
+            self.send_error(404, "Repository is not tracked")
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+
+def serve(daemon, address, handler=WebhookHandler):
+    """
+    Start an HTTP server at the (host, port) address in a background thread,
+    with handler handling requests for the daemon. Return the server.
+    """
+    server = http.server.ThreadingHTTPServer(address, handler)
+    server.daemon = daemon
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Listening on %s:%s", *server.server_address[:2])
+    return server
+
+
+def parse_address(value):
+    """
+    Parse a [HOST:]PORT command-line argument into a (host, port) tuple.
+    """
+    host, _, port = value.rpartition(":")
+    return host or "127.0.0.1", int(port)
@@ -0,0 +1,174 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Reverse index from digests to the tags pointing at them, alongside the state
+
+import logging
+import os
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    repo TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (repo, tag)
+);
+CREATE INDEX IF NOT EXISTS tags_digest ON tags (digest);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def get_index_path(path):
+    """
+    Return the path of the digest index of the state file at path.
+    """
+    return path + ".digests"
+
+
+class DigestIndex:
+    """
+    SQLite database mapping each digest to the (repo, tag) tuples pointing at
+    it, kept alongside the state file at path and updated with the changes of
+    each run. The index records the modification time of the state file it
+    matches, and is rebuilt from the whole state if they ever differ, for
+    instance if a run failed after saving the state.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(get_index_path(path), isolation_level=None)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def lookup(self, digest):
+        """
+        Return the sorted list of (repo, tag) tuples pointing at the digest.
+        """
+        return self.db.execute(
+            "SELECT repo, tag FROM tags WHERE digest = ? ORDER BY repo, tag",
+            (digest,),
+        ).fetchall()
+
+    def _get_mtime(self):
+        try:
+            return str(os.stat(self.path).st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+    def is_current(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'mtime'").fetchone()
+        return row is not None and row[0] == self._get_mtime()
+
+    def record(self, items, previous, rebuild=False):
+        """
+        Pass through the (repo, tag, result) tuples of a complete run, such as
+        those generated by container.iter_repos(), recording the tags which
+        have been added, updated or removed relative to previous, the data from
+        the previous run. Tags of previous which are no longer in the state of
+        their repo, without having been removed, for instance because a tag
+        filter now excludes them, are dropped. If rebuild is True, or the index
+        does not match the state file, all tags are recorded instead. The
+        changes are only kept once commit() is called.
+        """
+        rebuild = rebuild or not self.is_current()
+        self.db.execute("BEGIN")
+        if rebuild:
+            log.info("Rebuilding the digest index of %s", self.path)
+            self.db.execute("DELETE FROM tags")
+        seen = set()
+        # The tags of the repo being recorded, as the tags of each repo are
+        # generated together
+        current = None
+        tags = set()
+        for repo, tag, result in items:
+            yield repo, tag, result
+            if repo != current:
+                if not rebuild:
+                    self._drop_stale(current, tags, previous)
+                current = repo
+                tags = set()
+            seen.add(repo)
+            tags.add(tag)
+            if tag == "ignore":
+                continue
+            action = result.get("action")
+            if action == "removed" or not result.get("digest"):
+                if not rebuild:
+                    self.db.execute(
+                        "DELETE FROM tags WHERE repo = ? AND tag = ?", (repo, tag)
+                    )
+            elif rebuild or action in ("added", "updated"):
+                self.db.execute(
+                    "INSERT OR REPLACE INTO tags (repo, tag, digest) VALUES (?, ?, ?)",
+                    (repo, tag, result["digest"]),
+                )
+        if not rebuild:
+            self._drop_stale(current, tags, previous)
+            # Repos which are no longer tracked
+            for repo in set(previous) - seen:
+                self.db.execute("DELETE FROM tags WHERE repo = ?", (repo,))
+
+    def _drop_stale(self, repo, tags, previous):
+        # The state of repos which could not be checked is unchanged
+        if repo is None or "ignore" in tags:
+            return
+        for tag in set(previous.get(repo, ())) - tags:
+            self.db.execute("DELETE FROM tags WHERE repo = ? AND tag = ?", (repo, tag))
+
+    def update(self, data, previous, rebuild=False):
+        """
+        Record the tags of data, the complete state of a run, as described in
+        record().
+        """
+        for item in self.record(iter_items(data), previous, rebuild):
+            pass
+
+    def update_repos(self, data, previous):
+        """
+        Record the tags of data, the new state of only some of the repos, such
+        as those selected by config.select(), relative to previous, the state
+        of all repos before they were checked. The other repos are left alone.
+        The index must match the state file, otherwise it is rebuilt from data
+        alone, see is_current().
+        """
+        previous = {repo: previous[repo] for repo in data if repo in previous}
+        self.update(data, previous)
+
+    def rebuild(self, data):
+        """
+        Replace the index with the tags of data, once it has been saved to the
+        state file.
+        """
+        self.update(data, {}, rebuild=True)
+        self.commit()
+
+    def commit(self):
+        """
+        Commit the changes recorded since record() was called, once the state
+        file they match has been saved.
+        """
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('mtime', ?)",
+            (self._get_mtime(),),
+        )
+        self.db.execute("COMMIT")
+
+    def rollback(self):
+        if self.db.in_transaction:
+            self.db.execute("ROLLBACK")
+
+
+def iter_items(data):
+    """
+    Generate (repo, tag, result) tuples from the state of a run.
+    """
+    for repo, tags in data.items():
+        for tag, result in tags.items():
+            yield repo, tag, result
@@ -0,0 +1,133 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Detection of registry hosts which support the Quay REST API
+
+import logging
+import time
+from requests import Session
+from repotracker import latency, metrics, ratelimit
+from repotracker.config import PrefixTable
+from repotracker.utils import parse_bool
+
+log = logging.getLogger(__name__)
+
+DISCOVERY_URL = "https://{0}/api/v1/discovery"
+# The endpoint used by container.iter_quay_repo()
+TAG_PATH = "/api/v1/repository/{repository}/tag/"
+# Longest time to wait for the discovery document
+PROBE_TIMEOUT = 10.0
+
+
+class QuayDetector:
+    """
+    Decide whether each registry host supports the Quay REST API.
+    Hosts listed in the config are always Quay registries. Other hosts are
+    probed through the Quay API discovery endpoint, if detect is enabled, and
+    the result is kept in cache, a dict mapping each hostname to a dict with
+    "quay" and "checked" keys, for ttl seconds. Hosts which could not be probed
+    are treated as generic registries, without probing them again for
+    retry_ttl seconds, or until the next run. Their failure is not recorded with
+    the CircuitBreaker here, it is recorded once the repo fails to be checked
+    as a generic registry.
+    """
+
+    def __init__(
+        self,
+        quay_repos=("quay.io",),
+        detect=True,
+        ttl=604800.0,
+        cache=None,
+        retry_ttl=300.0,
+    ):
+        self.quay_repos = PrefixTable(quay_repos)
+        self.detect = detect
+        self.ttl = ttl
+        self.cache = {} if cache is None else cache
+        self.retry_ttl = retry_ttl
+        # Hosts which could not be probed, and when
+        self.unreachable = {}
+
+    def is_quay(self, repo):
+        """
+        Return True if the repo is on a host which supports the Quay REST API.
+        """
+        if self.quay_repos.match(repo):
+            return True
+        if not self.detect:
+            return False
+        hostname = repo.split("/", 1)[0]
+        failed = self.unreachable.get(hostname)
+        if failed is not None and time.time() - failed < self.retry_ttl:
+            return False
+        entry = self.cache.get(hostname)
+        if entry is None or time.time() - entry["checked"] > self.ttl:
+            quay = probe(hostname)
+            if quay is None:
+                self.unreachable[hostname] = time.time()
+                return False
+            entry = {"quay": quay, "checked": time.time()}
+            self.cache[hostname] = entry
+            log.info(
+                "%s %s the Quay API",
+                hostname,
+                "supports" if quay else "does not support",
+            )
+        return entry["quay"]
+
+
+def probe(hostname):
+    """
+    Ask the host for its Quay API discovery document. Return True if it lists the
+    endpoint for the tags of a repo, False if the host does not provide the
+    document, or None if the host could not be reached.
+    The request is not retried, and times out after PROBE_TIMEOUT seconds at
+    most, so an unreachable host does not hold up the run.
+    """
+    ratelimit.limiter.acquire(hostname)
+    timeout = min(latency.api.timeout(hostname), PROBE_TIMEOUT)
+    start = time.monotonic()
+    try:
+        with Session() as session:
+            resp = session.get(DISCOVERY_URL.format(hostname), timeout=timeout)
+    except Exception:
+        log.warning("Could not probe %s for the Quay API", hostname, exc_info=True)
+        metrics.registry.inc(
+            "repotracker_errors_total", host=hostname, operation="probe"
+        )
+        return None
+    latency.api.record(hostname, time.monotonic() - start)
+    ratelimit.limiter.update(hostname, resp)
+    if resp.status_code >= 500 or resp.status_code == 429:
+        log.warning(
+            "Could not probe %s for the Quay API: HTTP %s", hostname, resp.status_code
+        )
+        metrics.registry.inc(
+            "repotracker_errors_total", host=hostname, operation="probe"
+        )
+        return None
+    if resp.status_code != 200:
+        return False
+    try:
+        paths = resp.json()["paths"]
+    except (ValueError, KeyError, TypeError):
+        return False
+    return TAG_PATH in paths
+
+
+def get_detector(conf, cache=None):
+    """
+    Create a QuayDetector from the quayrepos section of the config. repos is a
+    comma-separated list of Quay registries, detect (true by default) enables
+    probing of other hosts, and detect_ttl is the number of seconds before a
+    host is probed again. cache is the result of previous probes, see QuayDetector.
+    """
+    section = conf["quayrepos"] if "quayrepos" in conf else {}
+    quay_repos = ["quay.io"]
+    if section.get("repos"):
+        quay_repos = section.get("repos").split(",")
+    return QuayDetector(
+        quay_repos,
+        detect=parse_bool(section.get("detect", "true")),
+        ttl=float(section.get("detect_ttl", 604800)),
+        cache=cache,
+    )
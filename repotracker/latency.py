@@ -0,0 +1,194 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Per-host latency tracking, adaptive timeouts and hedged requests
+
+import bisect
+import contextvars
+import logging
+import queue
+import threading
+from repotracker.utils import parse_bool
+
+log = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies in seconds, with logarithmically spaced buckets from
+    10ms to about 3 minutes. Once max_samples latencies have been recorded all
+    counts are halved, so older samples gradually lose their weight.
+    """
+
+    BOUNDS = [0.01 * 1.25**i for i in range(45)]
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += 1
+        if self.total > self.max_samples:
+            self.counts = [count // 2 for count in self.counts]
+            self.total = sum(self.counts)
+
+    def quantile(self, q):
+        """
+        Return the upper bound of the bucket containing the q quantile, or None
+        if nothing has been recorded.
+        """
+        if not self.total:
+            return None
+        target = q * self.total
+        cumulative = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+
+class LatencyTracker:
+    """
+    Keep a LatencyHistogram for each registry host, and derive request timeouts
+    and hedging delays from it.
+    Until adaptive is enabled and min_samples latencies have been recorded for
+    a host, the default timeout is used. Afterwards the timeout is multiplier
+    times the p99 latency, between min_timeout and the default timeout.
+    If hedge is enabled, hedge_delay() returns the p95 latency.
+    """
+
+    def __init__(
+        self,
+        default_timeout=60.0,
+        min_timeout=5.0,
+        multiplier=3.0,
+        min_samples=20,
+        adaptive=False,
+        hedge=False,
+    ):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.configure(
+            default_timeout, min_timeout, multiplier, min_samples, adaptive, hedge
+        )
+
+    def configure(
+        self,
+        default_timeout=60.0,
+        min_timeout=5.0,
+        multiplier=3.0,
+        min_samples=20,
+        adaptive=False,
+        hedge=False,
+    ):
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.adaptive = adaptive
+        self.hedge = hedge
+
+    def record(self, host, seconds):
+        with self.lock:
+            if host not in self.histograms:
+                self.histograms[host] = LatencyHistogram()
+            self.histograms[host].record(seconds)
+
+    def quantile(self, host, q):
+        """
+        Return the q quantile of the latencies of the host, or None if not
+        enough latencies have been recorded.
+        """
+        with self.lock:
+            histogram = self.histograms.get(host)
+            if histogram is None or histogram.total < self.min_samples:
+                return None
+            return histogram.quantile(q)
+
+    def timeout(self, host):
+        """
+        Return the timeout in seconds for a request to the host.
+        """
+        p99 = self.quantile(host, 0.99) if self.adaptive else None
+        if p99 is None:
+            return self.default_timeout
+        return min(self.default_timeout, max(self.min_timeout, p99 * self.multiplier))
+
+    def hedge_delay(self, host):
+        """
+        Return the number of seconds after which a duplicate request to the
+        host should be sent, or None if requests should not be hedged.
+        """
+        if not self.hedge:
+            return None
+        return self.quantile(host, 0.95)
+
+
+def hedged(func, delay, hedge=None):
+    """
+    Call func() in a thread. If it has not completed after delay seconds, call
+    hedge(), or func() again if hedge is None, concurrently. Return the result
+    of whichever call succeeds first. If every call that was made fails, raise
+    the error of the first to fail.
+    The calls must be idempotent. If hedge is None, func must be safe to call
+    from several threads at once. The calls are made in the context of the
+    caller, so the spans they start are children of its current span.
+    """
+    results = queue.Queue()
+
+    def run(func):
+        try:
+            results.put((True, func()))
+        except Exception as exc:
+            results.put((False, exc))
+
+    def start(func):
+        # Each thread needs a copy of its own, a context can only be entered
+        # by one thread at a time
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(run, func), daemon=True).start()
+
+    start(func)
+    attempts = 1
+    try:
+        ok, value = results.get(timeout=delay)
+    except queue.Empty:
+        log.debug("No response after %.2fs, sending a hedged request", delay)
+        start(hedge or func)
+        attempts = 2
+        ok, value = results.get()
+    if not ok and attempts == 2:
+        ok, other = results.get()
+        if ok:
+            value = other
+    if not ok:
+        raise value
+    return value
+
+
+# Latencies of Quay API requests and of skopeo commands, for each host
+api = LatencyTracker()
+skopeo = LatencyTracker()
+
+
+def configure(conf):
+    """
+    Configure the shared trackers from the polling section of the config.
+    adaptive_timeouts enables timeouts derived from observed latencies, bounded
+    by min_timeout and timeout, and hedge_requests enables hedging of Quay API
+    requests for tag pages.
+    """
+    section = conf["polling"] if "polling" in conf else {}
+    options = dict(
+        default_timeout=float(section.get("timeout", 60)),
+        min_timeout=float(section.get("min_timeout", 5)),
+        multiplier=float(section.get("timeout_multiplier", 3)),
+        adaptive=parse_bool(section.get("adaptive_timeouts", "false")),
+    )
+    api.configure(
+        hedge=parse_bool(section.get("hedge_requests", "false")),
+        **options,
+    )
+    skopeo.configure(**options)
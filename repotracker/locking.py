@@ -0,0 +1,163 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Advisory locks preventing overlapping runs from repeating each other's work
+
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+from repotracker import utils
+
+log = logging.getLogger(__name__)
+
+
+class LockHeld(Exception):
+    pass
+
+
+def get_lock_path(path):
+    return path + ".lock"
+
+
+def get_runs_lock_path(path):
+    return path + ".runs.lock"
+
+
+@contextlib.contextmanager
+def _flock(lock_path, path, shared=False, wait=False):
+    with open(lock_path, "a") as fobj:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not wait:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fobj, flags)
+        except BlockingIOError:
+            raise LockHeld(f"Another run is using {path}")
+        try:
+            yield
+        finally:
+            fcntl.flock(fobj, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def run_lock(path, wait=False, shared=False):
+    """
+    Hold an exclusive advisory lock on the state file at path. If another run
+    holds it, wait for it to be released if wait is True, otherwise raise
+    LockHeld.
+    Runs which only lock the repos they check, see RepoLocks, hold the lock
+    with shared set to True instead: they may overlap each other, but not a run
+    holding the exclusive lock, which checks all repos regardless of their
+    locks.
+    """
+    with _flock(get_runs_lock_path(path), path, shared, wait):
+        if shared:
+            yield
+            return
+        with _flock(get_lock_path(path), path, wait=wait):
+            yield
+
+
+def save_lock(path):
+    """
+    Lock the state file at path while it is read or written by a run holding
+    the shared run_lock(), waiting for other runs to finish with it.
+    """
+    return _flock(get_lock_path(path), path, wait=True)
+
+
+class RepoLocks:
+    """
+    Advisory locks on the individual repos of the state file at path, so several
+    runs may check different repos at the same time. data is the state loaded by
+    this run: when a lock is acquired and the file has been saved by another run
+    since it was loaded, data is refreshed in place, so the repo is compared
+    against the latest state.
+    The locks are held until release() or release_all() is called, so a run
+    should keep them until it has saved the state of the repos. The run must
+    hold the shared run_lock(), so no run checking all repos is running.
+    """
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self.directory = path + ".locks"
+        os.makedirs(self.directory, exist_ok=True)
+        self.mtime = self._get_mtime()
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.held = {}
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def acquire(self, repo):
+        """
+        Lock the repo. Return False if it is locked by another run.
+        """
+        with self.lock:
+            if repo in self.held:
+                return True
+        name = hashlib.sha256(repo.encode("utf-8")).hexdigest()[:32]
+        fobj = open(os.path.join(self.directory, name), "a")
+        try:
+            fcntl.flock(fobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fobj.close()
+            return False
+        with self.lock:
+            self.held[repo] = fobj
+        self.refresh()
+        return True
+
+    def release(self, repo):
+        with self.lock:
+            fobj = self.held.pop(repo)
+        fcntl.flock(fobj, fcntl.LOCK_UN)
+        fobj.close()
+
+    def release_all(self):
+        """
+        Release the locks on all the repos held by this run.
+        """
+        with self.lock:
+            held, self.held = self.held, {}
+        for fobj in held.values():
+            fcntl.flock(fobj, fcntl.LOCK_UN)
+            fobj.close()
+
+    def refresh(self):
+        # Only the threads which need the reloaded data wait for it
+        if self._get_mtime() == self.mtime:
+            return
+        with self.refresh_lock:
+            if self._get_mtime() == self.mtime:
+                return
+            log.info("%s was saved by another run, reloading it", self.path)
+            with save_lock(self.path):
+                self.data.update(utils.load_data(self.path))
+                self.mtime = self._get_mtime()
+
+
+def merge_on_save(path, new_data, lock=True):
+    """
+    Save new_data to the state file at path, keeping the repos saved there by
+    other runs. Repos of new_data which were not checked, and only reuse the
+    data from the previous run, do not replace the saved data.
+    The file is locked with save_lock() while it is updated, unless lock is
+    False because the caller holds the exclusive run_lock(). Return the merged
+    state.
+    """
+    with save_lock(path) if lock else contextlib.nullcontext():
+        current = utils.load_data(path)
+        for repo, tags in new_data.items():
+            if tags.get("ignore") and repo in current:
+                continue
+            current[repo] = tags
+        utils.save_data(path, current)
+    return current
@@ -2,61 +2,179 @@
 # Copyright 2018 Mike Bonnet <mikeb@redhat.com>
 # Send messages about updated repos to the UMB
 
-import json
+import hashlib
 import logging
 from rhmsg.activemq.producer import AMQProducer
+from repotracker import codec, metrics, tracing
 
 
 log = logging.getLogger(__name__)
 
+# Maximum number of messages sent at once when streaming updates
+BATCH_SIZE = 500
+# Actions which result in a message, in the order they are sent
+ACTIONS = ("added", "updated", "removed")
 
-def gen_msg(tagdata):
+
+def gen_msg(tagdata, previous=None, delta=False):
     """
     Generate a (headers, body) tuple from the tag data.
+    The body is encoded exactly once, as UTF-8 JSON bytes which are passed to
+    the broker as they are, and the headers share their values with the tag
+    data rather than copying them.
+    If delta is True, the body is generated by gen_delta_body(), comparing the
+    tag data to previous, the data for the same tag from the previous run.
     """
-    headers = tagdata.copy()
-    del headers["labels"]
-    body = json.dumps(tagdata, ensure_ascii=False)
+    headers = {key: value for key, value in tagdata.items() if key != "labels"}
+    if delta:
+        body = codec.dumps(gen_delta_body(tagdata, previous or {}))
+    else:
+        body = codec.dumps(tagdata)
     return (headers, body)
 
 
-def send_container_updates(conf, data):
-    added = []
-    updated = []
-    removed = []
+def gen_delta_body(tagdata, previous):
+    """
+    Generate a message body which only includes the labels of the tag if it has
+    been added, or if its labels differ from those in previous. A labels_hash
+    field is always included, so consumers can tell which labels apply.
+    """
+    include = tagdata["action"] == "added" or tagdata["labels"] != previous.get(
+        "labels"
+    )
+    body = {}
+    for key, value in tagdata.items():
+        if key == "labels":
+            if include:
+                body[key] = value
+            body["labels_hash"] = hash_labels(value)
+        else:
+            body[key] = value
+    return body
+
+
+def hash_labels(labels):
+    """
+    Return a checksum:digest string identifying the set of labels, independent of
+    their order. Images without labels, whose labels are None, have the same
+    hash as those with no labels.
+    """
+    encoded = codec.dumps(dict(sorted((labels or {}).items())))
+    return "sha256:" + hashlib.sha256(encoded).hexdigest()
+
+
+def get_body_format(conf):
+    """
+    Return True if delta message bodies are configured, False for full bodies.
+    """
+    body_format = conf["broker"].get("body_format", "full")
+    if body_format not in ("full", "delta"):
+        raise ValueError(f"Unknown body_format: {body_format}")
+    return body_format == "delta"
+
+
+def msg_action(tagdata):
+    """
+    Return the action of the tag data if a message needs to be sent for it,
+    otherwise None. This is checked before building the message, so no work
+    is done for unchanged tags.
+    """
+    action = tagdata["action"]
+    if action == "unchanged":
+        return None
+    if action not in ACTIONS:
+        log.error("Unknown action: %s", action)  # pragma: no cover
+        return None  # pragma: no cover
+    return action
+
+
+def send_container_updates(conf, data, previous=None):
+    """
+    Send messages for all tags in data which have changed.
+    previous is the data from the previous run, which is required to send
+    delta message bodies (see gen_delta_body()).
+    """
+    delta = get_body_format(conf)
+    previous = previous or {}
+    msgs = {action: [] for action in ACTIONS}
     for repo, tags in data.items():
         if "ignore" in tags:
             log.info("Ignoring data for %s", repo)
             continue
         for tag, tagdata in tags.items():
-            msg = gen_msg(tagdata)
-            if tagdata["action"] == "unchanged":
-                pass
-            elif tagdata["action"] == "updated":
-                updated.append(msg)
-            elif tagdata["action"] == "added":
-                added.append(msg)
-            elif tagdata["action"] == "removed":
-                removed.append(msg)
-            else:
-                log.error("Unknown action: %s", tagdata["action"])  # pragma: no cover
-    producer = AMQProducer(
+            action = msg_action(tagdata)
+            if action:
+                msgs[action].append(
+                    gen_msg(tagdata, previous.get(repo, {}).get(tag), delta)
+                )
+    producer = get_producer(conf)
+    prefix = conf["broker"]["topic_prefix"].rstrip(".")
+    for action in ACTIONS:
+        if msgs[action]:
+            send_msgs(producer, prefix + ".container.tag." + action, msgs[action])
+    log.info("Sent %s messages", sum(map(len, msgs.values())))
+
+
+def send_container_updates_iter(conf, items, previous=None):
+    """
+    Send messages for the (repo, tag, tagdata) tuples generated by items, as
+    returned by container.iter_repos(), and yield each tuple once it has been
+    handled. Messages are sent in batches of at most batch_size (from the broker
+    section of the config) per topic, so only the messages of the current
+    batches are kept in memory. Any remaining messages are sent once items has
+    been exhausted.
+    previous is the data from the previous run, as in send_container_updates().
+    """
+    delta = get_body_format(conf)
+    previous = previous or {}
+    batch_size = int(conf["broker"].get("batch_size", BATCH_SIZE))
+    producer = get_producer(conf)
+    prefix = conf["broker"]["topic_prefix"].rstrip(".")
+    batches = {action: [] for action in ACTIONS}
+    ignored = None
+    count = 0
+    for repo, tag, tagdata in items:
+        if tag == "ignore":
+            log.info("Ignoring data for %s", repo)
+            ignored = repo
+        elif repo != ignored:
+            action = msg_action(tagdata)
+            if action:
+                batches[action].append(
+                    gen_msg(tagdata, previous.get(repo, {}).get(tag), delta)
+                )
+                if len(batches[action]) >= batch_size:
+                    send_msgs(
+                        producer, prefix + ".container.tag." + action, batches[action]
+                    )
+                    count += len(batches[action])
+                    batches[action] = []
+        yield repo, tag, tagdata
+    for action in ACTIONS:
+        if batches[action]:
+            send_msgs(producer, prefix + ".container.tag." + action, batches[action])
+            count += len(batches[action])
+    log.info("Sent %s messages", count)
+
+
+def get_producer(conf):
+    """
+    Return an AMQProducer connecting to the broker described in the config.
+    """
+    return AMQProducer(
         urls=conf["broker"]["urls"].split(),
         certificate=conf["broker"]["cert"],
         private_key=conf["broker"]["key"],
         trusted_certificates=conf["broker"]["cacerts"],
     )
-    prefix = conf["broker"]["topic_prefix"].rstrip(".")
-    if added:
-        with producer as prod:
-            prod.through_topic(prefix + ".container.tag.added")
-            prod.send_msgs(added)
-    if updated:
-        with producer as prod:
-            prod.through_topic(prefix + ".container.tag.updated")
-            prod.send_msgs(updated)
-    if removed:
+
+
+def send_msgs(producer, topic, msgs):
+    """
+    Send the list of (headers, body) tuples to the given topic.
+    """
+    with tracing.tracer.span("publish", topic=topic, messages=len(msgs)):
         with producer as prod:
-            prod.through_topic(prefix + ".container.tag.removed")
-            prod.send_msgs(removed)
-    log.info("Sent %s messages", sum(map(len, [added, updated, removed])))
+            prod.through_topic(topic)
+            prod.send_msgs(msgs)
+    metrics.registry.inc("repotracker_messages_total", len(msgs), topic=topic)
@@ -0,0 +1,187 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Metrics of the runs, in the Prometheus text exposition format
+
+import contextlib
+import http.server
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# The type and help text of each metric
+METRICS = {
+    "repotracker_repo_check_seconds": (
+        "gauge",
+        "Seconds taken by the last check of the repo",
+    ),
+    "repotracker_quay_pages_total": (
+        "counter",
+        "Pages of tags retrieved from the Quay API for the repo",
+    ),
+    "repotracker_http_requests_total": (
+        "counter",
+        "Requests sent to the Quay API of the host",
+    ),
+    "repotracker_skopeo_seconds_total": (
+        "counter",
+        "Seconds spent running skopeo against the host",
+    ),
+    "repotracker_skopeo_processes_total": (
+        "counter",
+        "skopeo processes run against the host",
+    ),
+    "repotracker_tags_total": (
+        "counter",
+        "Tags found by the checks of the repos, by action",
+    ),
+    "repotracker_messages_total": (
+        "counter",
+        "Messages sent to the topic",
+    ),
+    "repotracker_state_seconds": (
+        "gauge",
+        "Seconds taken by the last load or save of the state file",
+    ),
+    "repotracker_errors_total": (
+        "counter",
+        "Failures to check a repo, inspect a tag or probe the Quay API of the host",
+    ),
+}
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry:
+    """
+    Values of the METRICS, for each set of labels. Counters are increased with
+    inc(), gauges are set with set(), and either may be measured with timer(),
+    or timed() for generators.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.values.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values.setdefault(name, {})[key] = value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Measure the seconds taken by the block, adding them to a counter or
+        setting a gauge, depending on the type of the metric.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start, **labels)
+
+    def timed(self, name, generator, **labels):
+        """
+        Yield the values generated by generator, measuring the seconds spent
+        running it as timer() does, but not the time the consumer spends
+        between values. Return the value returned by generator.
+        """
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    value = next(generator)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    elapsed += time.monotonic() - start
+                yield value
+        finally:
+            generator.close()
+            self.record(name, elapsed, **labels)
+
+    def record(self, name, elapsed, **labels):
+        if METRICS[name][0] == "counter":
+            self.inc(name, elapsed, **labels)
+        else:
+            self.set(name, elapsed, **labels)
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text exposition format, as bytes.
+        """
+        lines = []
+        with self.lock:
+            values = {name: dict(samples) for name, samples in self.values.items()}
+        for name, (metric_type, help_text) in METRICS.items():
+            if name not in values:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for key, value in sorted(values[name].items()):
+                labels = ",".join(f'{label}="{escape(val)}"' for label, val in key)
+                if labels:
+                    lines.append(f"{name}{{{labels}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+registry = Registry()
+
+
+def write_textfile(path):
+    """
+    Write the metrics to path, for the textfile collector of the node exporter.
+    The file is replaced atomically, so the collector never reads part of it.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fobj:
+        fobj.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answer GET requests for /metrics with the metrics of the registry.
+    """
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404, "Unknown path")
+            return
+        body = registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+
+def serve(address):
+    """
+    Start a server exposing the metrics at the (host, port) address in a
+    background thread. Return the server.
+    """
+    server = http.server.ThreadingHTTPServer(address, MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Serving metrics on %s:%s", *server.server_address[:2])
+    return server
@@ -0,0 +1,119 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# CPU and memory profiles of the phases of a run
+
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+log = logging.getLogger(__name__)
+
+# Functions whose cumulative time is reported for each way of checking repos
+BACKENDS = {
+    "iter_quay_repo": "quay",
+    "iter_image_repo": "skopeo",
+}
+
+
+class Profiler:
+    """
+    Profile the phases of a run with cProfile and tracemalloc, once start() has
+    been called with the directory where the profiles are dumped. Until then,
+    phase() does nothing.
+    Only the thread running a phase is profiled by cProfile, so the time spent
+    in other threads, such as those checking the repos of namespaces, appears
+    as time waiting for them. Memory is traced in all threads.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.phases = {}
+
+    def start(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Profile the block as the named phase. A phase may be entered more than
+        once, and its profiles are added up. Phases may not be nested.
+        """
+        if self.directory is None:
+            yield
+            return
+        if name not in self.phases:
+            self.phases[name] = {
+                "profile": cProfile.Profile(),
+                "seconds": 0.0,
+                "peak": 0,
+            }
+        phase = self.phases[name]
+        # reset_peak() is only available from Python 3.9
+        getattr(tracemalloc, "reset_peak", tracemalloc.clear_traces)()
+        start = time.perf_counter()
+        phase["profile"].enable()
+        try:
+            yield
+        finally:
+            phase["profile"].disable()
+            phase["seconds"] += time.perf_counter() - start
+            phase["peak"] = max(phase["peak"], tracemalloc.get_traced_memory()[1])
+
+    def stop(self):
+        """
+        Dump the profiles of the phases, print the report, and stop tracing.
+        """
+        self.dump()
+        self.report()
+        tracemalloc.stop()
+        self.directory = None
+
+    def dump(self):
+        """
+        Save the profile of each phase to <phase>.prof in the directory, for
+        pstats or other profile viewers.
+        """
+        for name, phase in self.phases.items():
+            path = os.path.join(self.directory, f"{name}.prof")
+            phase["profile"].dump_stats(path)
+            log.info("Saved the profile of %s to %s", name, path)
+
+    def report(self, out=None, top=15):
+        """
+        Print a table of the time and peak memory of each phase, with the time
+        spent in each backend while checking repos, followed by the top
+        functions of all phases by their own time.
+        """
+        out = out or sys.stderr
+        if not self.phases:
+            return
+        print(f"{'Phase':<24} {'Seconds':>10} {'Peak MiB':>10}", file=out)
+        for name, phase in self.phases.items():
+            peak = phase["peak"] / (1024 * 1024)
+            print(f"{name:<24} {phase['seconds']:>10.3f} {peak:>10.1f}", file=out)
+            stats = pstats.Stats(phase["profile"]).stats
+            for (filename, line, func), (cc, nc, tt, ct, callers) in sorted(
+                stats.items()
+            ):
+                if func in BACKENDS and filename.endswith("container.py"):
+                    label = f"  {BACKENDS[func]}"
+                    print(f"{label:<24} {ct:>10.3f}", file=out)
+        stats = pstats.Stats(*(phase["profile"] for phase in self.phases.values()))
+        hotspots = sorted(
+            stats.stats.items(), key=lambda item: item[1][2], reverse=True
+        )
+        print(file=out)
+        print(f"{'Calls':>10} {'Own s':>10} {'Total s':>10}  Function", file=out)
+        for (filename, line, func), (cc, nc, tt, ct, callers) in hotspots[:top]:
+            location = f"{os.path.basename(filename)}:{line}({func})"
+            print(f"{nc:>10} {tt:>10.3f} {ct:>10.3f}  {location}", file=out)
+
+
+profiler = Profiler()
@@ -0,0 +1,139 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Read-only HTTP API answering queries about the state of the repos
+
+import http.server
+import logging
+import os
+import threading
+import urllib.parse
+from repotracker import codec, utils
+
+log = logging.getLogger(__name__)
+
+
+class StateIndex:
+    """
+    Index the state of the repos, as saved by utils.save_data(), so the digest
+    of a tag, the tags with a digest, and the tags of a repo can each be found
+    with a single dict lookup. update() replaces the whole index at once, so
+    queries always see the state of a single run.
+    If path is given, the index is loaded from the state file, and reloaded by
+    refresh() whenever the file has been modified.
+    """
+
+    def __init__(self, data=None, path=None):
+        self.path = path
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.update(data or {})
+        if path is not None:
+            self.refresh()
+
+    def update(self, data):
+        repos = {}
+        digests = {}
+        for repo, tags in data.items():
+            if tags.get("ignore"):
+                tags = {
+                    tag: tagdata for tag, tagdata in tags.items() if tag != "ignore"
+                }
+            # Removed tags are only kept to avoid sending duplicate messages
+            tags = {
+                tag: tagdata
+                for tag, tagdata in tags.items()
+                if tagdata.get("action") != "removed"
+            }
+            repos[repo] = tags
+            for tag, tagdata in tags.items():
+                if tagdata.get("digest"):
+                    digests.setdefault(tagdata["digest"], []).append((repo, tag))
+        # A single assignment, so concurrent queries see either index
+        self._state = (repos, digests)
+
+    @property
+    def repos(self):
+        return self._state[0]
+
+    @property
+    def digests(self):
+        return self._state[1]
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        with self.lock:
+            if mtime != self.mtime:
+                log.info("Loading the state from %s", self.path)
+                self.update(utils.load_data(self.path))
+                self.mtime = mtime
+
+    def get_tag(self, repo, tag):
+        return self._state[0].get(repo, {}).get(tag)
+
+    def get_digest(self, digest):
+        return self._state[1].get(digest, [])
+
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answer GET requests about the StateIndex of the server, in JSON:
+    - /repos: the list of repos
+    - /tags?repo=REPO: a dict mapping the tags of the repo to their digests
+    - /tag?repo=REPO&tag=TAG: the state of the tag
+    - /digest?digest=DIGEST: the list of [repo, tag] with the digest
+    """
+
+    def do_GET(self):
+        index = self.server.index
+        if index.path is not None:
+            index.refresh()
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            if url.path == "/repos":
+                result = sorted(index.repos)
+            elif url.path == "/tags":
+                tags = index.repos.get(params["repo"])
+                if tags is None:
+                    result = None
+                else:
+                    result = {
+                        tag: tagdata.get("digest") for tag, tagdata in tags.items()
+                    }
+            elif url.path == "/tag":
+                result = index.get_tag(params["repo"], params["tag"])
+            elif url.path == "/digest":
+                result = index.get_digest(params["digest"])
+            else:
+                self.send_error(404, "Unknown query")
+                return
+        except KeyError as exc:
+            self.send_error(400, f"Missing parameter {exc}")
+            return
+        if result is None:
+            self.send_error(404, "Not found")
+            return
+        body = codec.dumps(result)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+
+def serve(index, address):
+    """
+    Start a query server for the StateIndex at the (host, port) address in a
+    background thread. Return the server.
+    """
+    server = http.server.ThreadingHTTPServer(address, QueryHandler)
+    server.index = index
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Answering queries on %s:%s", *server.server_address[:2])
+    return server
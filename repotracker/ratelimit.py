@@ -0,0 +1,211 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Per-host rate limiting of requests to registries
+
+import datetime
+import email.utils
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Allow rate requests per second on average, with bursts of up to burst
+    requests. A rate of 0 means no limit. Requests can also be blocked entirely
+    until a given time, when the registry has asked us to back off.
+    """
+
+    def __init__(self, rate=0.0, burst=1, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self.blocked_until = 0.0
+
+    def reserve(self):
+        """
+        Take a token from the bucket, and return the number of seconds the caller
+        must wait before making its request. Tokens may be reserved ahead of
+        time, so concurrent callers are scheduled in the order they asked.
+        """
+        now = self.clock()
+        wait = max(0.0, self.blocked_until - now)
+        if self.rate > 0:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.tokens -= 1
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+        self.updated = now
+        return wait
+
+    def block(self, seconds):
+        """
+        Block all requests for the given number of seconds from now.
+        """
+        self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+
+
+class RateLimiter:
+    """
+    Schedule requests to each registry host through a TokenBucket, and keep
+    track of the rate limit reported by the host in its responses.
+    """
+
+    def __init__(self, rate=0.0, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.stats = {}
+
+    def configure(self, rate, burst):
+        with self.lock:
+            self.rate = rate
+            self.burst = burst
+            for bucket in self.buckets.values():
+                bucket.rate = rate
+                bucket.capacity = max(burst, 1)
+
+    def _get(self, host):
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst, self.clock)
+            self.stats[host] = {
+                "requests": 0,
+                "throttled": 0,
+                "waited": 0.0,
+                "limit": None,
+                "remaining": None,
+            }
+        return self.buckets[host], self.stats[host]
+
+    def acquire(self, host):
+        """
+        Wait until a request to the host is allowed.
+        """
+        with self.lock:
+            bucket, stats = self._get(host)
+            wait = bucket.reserve()
+            stats["requests"] += 1
+            if wait > 0:
+                stats["throttled"] += 1
+                stats["waited"] += wait
+        if wait > 0:
+            log.debug("Waiting %.2fs before sending a request to %s", wait, host)
+            self.sleep(wait)
+
+    def update(self, host, resp):
+        """
+        Record the rate limit headers of a response from the host. If the host
+        asked us to back off, with a Retry-After header or by reporting that no
+        requests remain, block further requests until it allows them again.
+        """
+        headers = resp.headers
+        backoff = None
+        if resp.status_code == 429 or "Retry-After" in headers:
+            backoff = parse_retry_after(headers.get("Retry-After"))
+        limit = parse_int(headers.get("X-RateLimit-Limit"))
+        remaining = parse_int(headers.get("X-RateLimit-Remaining"))
+        if remaining == 0 and backoff is None:
+            backoff = parse_reset(headers.get("X-RateLimit-Reset"))
+        with self.lock:
+            bucket, stats = self._get(host)
+            if limit is not None:
+                stats["limit"] = limit
+            if remaining is not None:
+                stats["remaining"] = remaining
+            if backoff is not None:
+                log.warning(
+                    "%s is rate limiting requests, backing off for %ss", host, backoff
+                )
+                bucket.block(backoff)
+
+    def report(self):
+        """
+        Log how close each host is to its rate limit, and return the statistics
+        for each host.
+        """
+        with self.lock:
+            report = {host: dict(stats) for host, stats in self.stats.items()}
+        for host, stats in sorted(report.items()):
+            if stats["limit"]:
+                usage = "{0}/{1} of rate limit remaining".format(
+                    stats["remaining"], stats["limit"]
+                )
+            else:
+                usage = "no rate limit reported"
+            log.info(
+                "%s: %s requests, %s throttled for %.1fs, %s",
+                host,
+                stats["requests"],
+                stats["throttled"],
+                stats["waited"],
+                usage,
+            )
+        return report
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_retry_after(value, default=1.0):
+    """
+    Parse a Retry-After header, which is either a number of seconds or an HTTP
+    date, into a number of seconds from now.
+    """
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (when - now).total_seconds())
+
+
+def parse_reset(value, default=1.0):
+    """
+    Parse an X-RateLimit-Reset header, which is either a Unix timestamp or a
+    number of seconds from now, into a number of seconds from now.
+    """
+    reset = parse_int(value)
+    if reset is None:
+        return default
+    # Anything later than 2001 must be a timestamp rather than a delay
+    if reset > 1000000000:
+        return max(0.0, reset - time.time())
+    return float(reset)
+
+
+# Shared by all requests to registries in this process
+limiter = RateLimiter()
+
+
+def configure(conf):
+    """
+    Configure the shared RateLimiter from the polling section of the config.
+    rate_limit is the maximum number of requests per second to each host,
+    0 (the default) meaning unlimited, and rate_burst the number of requests
+    that may be sent at once.
+    """
+    section = conf["polling"] if "polling" in conf else {}
+    limiter.configure(
+        float(section.get("rate_limit", 0)), int(section.get("rate_burst", 1))
+    )
@@ -0,0 +1,199 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Running skopeo, including many concurrent processes with asyncio
+
+import asyncio
+import logging
+import math
+import os
+import signal
+import subprocess
+import threading
+import time
+from repotracker import latency, metrics, ratelimit, tracing
+
+log = logging.getLogger(__name__)
+
+SKOPEO = "/usr/bin/skopeo"
+# Extra time given to skopeo beyond its own --command-timeout before it is killed
+KILL_GRACE = 10.0
+
+# Set by kill_running(), after which no more skopeo commands are started
+stopping = threading.Event()
+# The processes of all AsyncRunners, in any thread
+running = set()
+running_lock = threading.Lock()
+
+
+class Terminated(Exception):
+    pass
+
+
+def check_stopping():
+    if stopping.is_set():
+        raise Terminated("repotracker is terminating, not starting skopeo")
+
+
+def kill_running():
+    """
+    Kill the process groups of all the commands run by AsyncRunners, which would
+    otherwise outlive repotracker, and stop any more commands from starting.
+    """
+    stopping.set()
+    with running_lock:
+        procs = list(running)
+    for proc in procs:
+        kill_group(proc)
+
+
+def get_timeout(hostname, deadline=None):
+    """
+    Return the timeout in whole seconds for a skopeo command against the host,
+    derived from the latency of the host, and reduced to the time left before
+    the schedule.Deadline if one is given.
+    """
+    timeout = latency.skopeo.timeout(hostname)
+    if deadline is not None:
+        timeout = deadline.cap(timeout)
+    return max(1, math.ceil(timeout))
+
+
+def build_cmd(reporef, *args, timeout=None):
+    """
+    Return the skopeo command line to run the given args against the given repo
+    reference, with the timeout in seconds, by default get_timeout() for the
+    registry host.
+    """
+    if timeout is None:
+        timeout = get_timeout(reporef.split("/", 1)[0])
+    return [SKOPEO, "--command-timeout", f"{timeout}s", *args, f"docker://{reporef}"]
+
+
+class AsyncRunner:
+    """
+    Run skopeo commands concurrently, at most concurrency at a time.
+    Each process runs in its own process group, which is killed if the process
+    has not completed within its deadline, if the run is cancelled, or by
+    kill_running(). If a schedule.Deadline is given, the timeouts of the
+    processes are reduced so they end by then. The command, exit status, runtime
+    and whether it timed out are recorded in records for every process.
+    """
+
+    def __init__(self, concurrency=4, timeout=None, deadline=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.deadline = deadline
+        self.records = []
+        self.procs = set()
+
+    async def run(self, semaphore, reporef, *args):
+        """
+        Run skopeo with the given args, against the given repo reference.
+        Return a CompletedProcess with the decoded output of the command. If the
+        process had to be killed, its stderr reports that it timed out.
+        """
+        hostname = reporef.split("/", 1)[0]
+        async with semaphore:
+            command_timeout = get_timeout(hostname, self.deadline)
+            cmd = build_cmd(reporef, *args, timeout=command_timeout)
+            timeout = self.timeout or command_timeout + KILL_GRACE
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, ratelimit.limiter.acquire, hostname)
+            start = time.monotonic()
+            check_stopping()
+            with tracing.tracer.span("skopeo", cmd=" ".join(cmd)):
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    start_new_session=True,
+                )
+                self.procs.add(proc)
+                with running_lock:
+                    running.add(proc)
+                timed_out = False
+                try:
+                    stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    kill_group(proc)
+                    await proc.wait()
+                    stdout = b""
+                    stderr = f"repotracker: skopeo timed out after {timeout}s".encode()
+                except asyncio.CancelledError:
+                    kill_group(proc)
+                    raise
+                finally:
+                    self.procs.discard(proc)
+                    with running_lock:
+                        running.discard(proc)
+            runtime = time.monotonic() - start
+        latency.skopeo.record(hostname, runtime)
+        metrics.registry.inc(
+            "repotracker_skopeo_seconds_total", runtime, host=hostname, command=args[0]
+        )
+        metrics.registry.inc(
+            "repotracker_skopeo_processes_total", host=hostname, command=args[0]
+        )
+        self.records.append(
+            {
+                "cmd": cmd,
+                "returncode": proc.returncode,
+                "runtime": runtime,
+                "timed_out": timed_out,
+            }
+        )
+        log.info(
+            'Ran "%s" in %.3fs (exit status %s)',
+            " ".join(cmd),
+            runtime,
+            proc.returncode,
+        )
+        return subprocess.CompletedProcess(
+            cmd, proc.returncode, stdout.decode("utf-8"), stderr.decode("utf-8")
+        )
+
+    async def run_many(self, commands):
+        """
+        Run each (reporef, args) tuple in commands, and return a list of the
+        CompletedProcess objects in the same order.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            return await asyncio.gather(
+                *(self.run(semaphore, reporef, *args) for reporef, args in commands)
+            )
+        finally:
+            # Make sure nothing is left running if one of the commands failed
+            self.kill_all()
+
+    def run_all(self, commands):
+        """
+        Synchronous wrapper around run_many().
+        """
+        return asyncio.run(self.run_many(commands))
+
+    def kill_all(self):
+        """
+        Kill the process groups of all commands which are still running.
+        """
+        for proc in list(self.procs):
+            kill_group(proc)
+
+
+def kill_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+        log.warning("Killed process group %s", proc.pid)
+    except ProcessLookupError:
+        pass
+
+
+def get_concurrency(conf):
+    """
+    Return the number of skopeo commands which may run at once when inspecting
+    the tags of a repo, from skopeo_concurrency in the polling section of the
+    config. The default of 1 runs them one at a time, without asyncio.
+    """
+    section = conf["polling"] if "polling" in conf else {}
+    return max(1, int(section.get("skopeo_concurrency", 1)))
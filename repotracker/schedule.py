@@ -0,0 +1,71 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Ordering of repos within a run, and the deadline for the whole run
+
+import time
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    The time by which a run must finish, seconds from now. A Deadline of None
+    seconds never expires.
+    """
+
+    def __init__(self, seconds=None, clock=time.monotonic):
+        self.clock = clock
+        self.end = None if seconds is None else clock() + seconds
+
+    def expired(self):
+        return self.end is not None and self.clock() >= self.end
+
+    def remaining(self):
+        """
+        Return the number of seconds left, or None if there is no deadline.
+        """
+        if self.end is None:
+            return None
+        return max(0.0, self.end - self.clock())
+
+    def cap(self, timeout):
+        """
+        Return timeout, or the number of seconds left if there are fewer, so an
+        operation started now does not outlast the deadline. Raise
+        DeadlineExceeded if it has already expired.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            raise DeadlineExceeded("Run deadline reached")
+        return min(timeout, remaining)
+
+    def guard(self, items):
+        """
+        Pass through the items of the iterable, raising DeadlineExceeded if the
+        deadline expires before all of them have been generated.
+        """
+        for item in items:
+            if self.expired():
+                raise DeadlineExceeded("Run deadline reached")
+            yield item
+
+
+def order_sections(sections, checked):
+    """
+    Sort the (section_name, section) tuples so that repos with the highest
+    priority option come first, and repos with the same priority are ordered
+    from the least recently checked, according to checked, a dict mapping repos
+    to the time they were last checked. Repos which have never been checked
+    come first.
+    """
+    return sorted(
+        sections,
+        key=lambda item: (
+            -int(item[1].get("priority", 0)),
+            checked.get(item[1]["repo"], 0),
+        ),
+    )
@@ -0,0 +1,30 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# HTTP sessions for requests to registries
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# Number of times failed requests are retried by a session
+RETRIES = 3
+
+
+def get_session():
+    """
+    Return a Session which retries requests failing with a server error.
+    Responses asking the client to back off, 429 or a Retry-After header, are
+    returned rather than waited for, so the rate limiter and the run deadline
+    can handle them, see container.get_page().
+    """
+    s = Session()
+    retries = Retry(
+        total=RETRIES,
+        backoff_factor=0.1,
+        status_forcelist=[502, 503, 504],
+        respect_retry_after_header=False,
+    )
+    adapter = HTTPAdapter(max_retries=retries)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
@@ -0,0 +1,78 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Splitting the repos between several nodes, and merging their states
+
+import argparse
+import hashlib
+import logging
+from repotracker import config
+
+log = logging.getLogger(__name__)
+
+
+def parse_shard(value):
+    """
+    Parse a shard given as INDEX/COUNT on the command line, where INDEX is
+    between 0 and COUNT - 1, into an (index, count) tuple.
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Not INDEX/COUNT: {value}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            f"INDEX must be between 0 and COUNT - 1: {value}"
+        )
+    return index, count
+
+
+def score(name, index):
+    digest = hashlib.blake2b(f"{index}/{name}".encode("utf-8"), digest_size=8)
+    return int.from_bytes(digest.digest(), "big")
+
+
+def get_shard(name, count):
+    """
+    Return the shard which the section with the given name belongs to.
+    Rendezvous hashing is used, so when count changes only the sections which
+    now belong to a new shard, or belonged to a removed one, move.
+    """
+    return max(range(count), key=lambda index: score(name, index))
+
+
+def filter_config(conf, index, count):
+    """
+    Return a config.Config with the container and namespace sections of conf
+    which belong to the shard, and all of the other sections. The repos with a
+    container section of their own are tracked by every shard, so a namespace
+    does not check those on another shard again.
+    """
+    if not isinstance(conf, config.Config):
+        conf = config.Config(conf)
+    return config.Config(
+        {
+            section_name: section
+            for section_name, section in conf.items()
+            if section.get("type") not in ("container", "namespace")
+            or section_name == "broker"
+            or get_shard(section_name, count) == index
+        },
+        conf.tracked_repos,
+    )
+
+
+def merge_states(states):
+    """
+    Merge the states of several shards into one. A repo found in several states,
+    after the shards have been rebalanced, is taken from the last state in which
+    it was checked successfully, or else from the last state.
+    """
+    merged = {}
+    for data in states:
+        for repo, tags in data.items():
+            if repo in merged:
+                log.warning("%s is in the state of more than one shard", repo)
+                if tags.get("ignore") and not merged[repo].get("ignore"):
+                    continue
+            merged[repo] = tags
+    return merged
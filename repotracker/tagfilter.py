@@ -0,0 +1,81 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Filtering of the tags tracked in a repo
+
+import fnmatch
+import functools
+import re
+
+REGEX_PREFIX = "re:"
+# Characters which are wildcards in an SQL LIKE pattern
+LIKE_SPECIAL = set("%_\\")
+
+
+class TagFilter:
+    """
+    Decide which tags of a repo are tracked. A tag is tracked if it matches any
+    of the include patterns, or there are none, and does not match any of the
+    exclude patterns. Patterns are globs, or regular expressions if they start
+    with "re:", and must match the whole tag.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.include_re = compile_patterns(self.include)
+        self.exclude_re = compile_patterns(self.exclude)
+
+    def __bool__(self):
+        return bool(self.include or self.exclude)
+
+    def match(self, tag):
+        if self.include_re is not None and not self.include_re.fullmatch(tag):
+            return False
+        return self.exclude_re is None or not self.exclude_re.fullmatch(tag)
+
+    def quay_filter(self):
+        """
+        Return a value for the filter_tag_name parameter of the Quay tag API,
+        which selects at least all the tracked tags, or None if the patterns
+        cannot be expressed that way. Only a single include glob whose wildcards
+        are all "*" or "?" can be sent to the registry. The tags returned are
+        still checked with match().
+        """
+        if len(self.include) != 1:
+            return None
+        pattern = self.include[0]
+        if pattern.startswith(REGEX_PREFIX) or LIKE_SPECIAL & set(pattern):
+            return None
+        if "[" in pattern:
+            return None
+        return "like:" + pattern.replace("*", "%").replace("?", "_")
+
+
+def compile_patterns(patterns):
+    """
+    Compile the patterns into a single regular expression, or return None if
+    there are no patterns.
+    """
+    if not patterns:
+        return None
+    regexes = []
+    for pattern in patterns:
+        if pattern.startswith(REGEX_PREFIX):
+            regexes.append(pattern[len(REGEX_PREFIX) :])
+        else:
+            regexes.append(fnmatch.translate(pattern))
+    return re.compile("|".join(f"(?:{regex})" for regex in regexes))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_filter(include, exclude):
+    return TagFilter(include.split(), exclude.split())
+
+
+def get_filter(section):
+    """
+    Return the TagFilter for a repo section of the config, from its whitespace
+    separated include_tags and exclude_tags options. Filters are compiled once,
+    and shared by all the sections with the same patterns.
+    """
+    return _get_filter(section.get("include_tags", ""), section.get("exclude_tags", ""))
@@ -0,0 +1,164 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Timeline of the operations of a run, as nested spans
+
+import contextlib
+import contextvars
+import itertools
+import logging
+import os
+import threading
+import time
+from repotracker import codec
+
+log = logging.getLogger(__name__)
+
+FORMATS = ("jsonl", "chrome")
+
+# The span of the current thread or task, parent of the spans it starts
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """
+    Record spans, each timing an operation of the run, once start() has been
+    called. Until then, span() does nothing.
+    The parent of a span is the span which was current when it was started, in
+    the same thread or asyncio task. Threads started with
+    contextvars.copy_context() inherit the current span of the thread starting
+    them. Generators must be traced with iterate() rather than span(), so the
+    span is only current while the generator is running, and the spans of its
+    consumer are not recorded as its children. A generator consumed within the
+    span of another, but started outside it, is wrapped with outside() so its
+    spans are not children of that span either.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.spans = []
+
+    def start(self):
+        self.enabled = True
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """
+        Record the block as a span with the name and attributes.
+        """
+        if not self.enabled:
+            yield
+            return
+        span_id = next(self.ids)
+        parent = current_span.get()
+        token = current_span.set(span_id)
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            current_span.reset(token)
+            self.record(span_id, parent, name, start, end, attrs)
+
+    def iterate(self, name, generator, **attrs):
+        """
+        Yield the values generated by generator, recording a span with the name
+        and attributes from the first value requested until generator is
+        exhausted. The span is only current while generator is running, not
+        while it is suspended. Return the value returned by generator.
+        """
+        if not self.enabled:
+            return (yield from generator)
+        span_id = next(self.ids)
+        parent = current_span.get()
+        start = time.time()
+        try:
+            while True:
+                token = current_span.set(span_id)
+                try:
+                    value = next(generator)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    current_span.reset(token)
+                yield value
+        finally:
+            generator.close()
+            self.record(span_id, parent, name, start, time.time(), attrs)
+
+    def outside(self, generator):
+        """
+        Return a generator yielding the values generated by generator, with the
+        span which is current when outside() is called, rather than the span of
+        its consumer, current while generator is running.
+        """
+        if not self.enabled:
+            return generator
+        return self._outside(generator, current_span.get())
+
+    def _outside(self, generator, span_id):
+        try:
+            while True:
+                token = current_span.set(span_id)
+                try:
+                    value = next(generator)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    current_span.reset(token)
+                yield value
+        finally:
+            generator.close()
+
+    def record(self, span_id, parent, name, start, end, attrs):
+        span = {
+            "id": span_id,
+            "parent": parent,
+            "name": name,
+            "start": start,
+            "duration": end - start,
+            "thread": threading.get_native_id(),
+            "attrs": attrs,
+        }
+        with self.lock:
+            self.spans.append(span)
+
+    def write(self, path, trace_format="jsonl"):
+        """
+        Write the spans to path, in order of their start time, either as JSON
+        lines, one span per line, or in the Trace Event Format of the Chrome
+        trace viewer and Perfetto.
+        """
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        with open(path, "wb") as fobj:
+            if trace_format == "chrome":
+                fobj.write(codec.dumps({"traceEvents": to_chrome(spans)}))
+            else:
+                for span in spans:
+                    fobj.write(codec.dumps(span) + b"\n")
+        log.info("Saved %s spans to %s", len(spans), path)
+
+
+def to_chrome(spans):
+    """
+    Convert spans to a list of complete ("X") events of the Trace Event Format,
+    with timestamps in microseconds.
+    """
+    pid = os.getpid()
+    return [
+        {
+            "name": span["name"],
+            "ph": "X",
+            "ts": round(span["start"] * 1e6),
+            "dur": round(span["duration"] * 1e6),
+            "pid": pid,
+            "tid": span["thread"],
+            "args": dict(span["attrs"], id=span["id"], parent=span["parent"]),
+        }
+        for span in spans
+    ]
+
+
+tracer = Tracer()
@@ -2,16 +2,31 @@
 # Copyright 2018 Mike Bonnet <mikeb@redhat.com>
 # Utility functions for repotacker
 
+import codecs
 import configparser
+import contextlib
+import gzip
+import itertools
 import json
+import lzma
+import operator
 import tempfile
 import os
 import stat
 import datetime
 import re
+from repotracker import codec
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
 
 
 FRACTIONAL_SECONDS_RE = re.compile(r"\.\d+(\w*)$")
+WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+JSON_DECODER = json.JSONDecoder()
+COMPRESSED_EXTENSIONS = (".gz", ".xz", ".zst")
 
 
 def load_config(path):
@@ -21,16 +36,227 @@ def load_config(path):
     return parser
 
 
+def parse_bool(value):
+    """
+    Parse a boolean config value the same way as ConfigParser.getboolean().
+    """
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ("1", "yes", "true", "on"):
+        return True
+    if value.lower() in ("0", "no", "false", "off"):
+        return False
+    raise ValueError(f"Not a boolean: {value}")
+
+
 def load_data(path):
     if os.path.exists(path) and os.path.getsize(path) > 0:
-        with open(path) as fobj:
-            return json.load(fobj)
+        with open(path, "rb") as fobj:
+            if not is_compressed(path):
+                return codec.loads(fobj.read())
+            with _compressed_file(fobj, path, "rb") as stream:
+                return {repo: dict(tags) for repo, tags in iter_data(stream)}
     return {}
 
 
 def save_data(path, data):
+    with _replace_file(path) as fobj:
+        if is_compressed(path):
+            write_data(fobj, ((repo, tags.items()) for repo, tags in data.items()))
+        else:
+            fobj.write(codec.dumps(data))
+
+
+def save_data_iter(path, items):
+    """
+    Save data to path as it is generated, without holding all of it in memory.
+    items must be an iterable of (repo, tag, tagdata) tuples, grouped by repo,
+    such as the one returned by container.iter_repos().
+    The file at path is only replaced once items has been exhausted. If an
+    exception is raised while iterating, the existing file is left untouched.
+    """
+    with _replace_file(path) as fobj:
+        write_data(
+            fobj,
+            (
+                (repo, ((tag, tagdata) for _, tag, tagdata in group))
+                for repo, group in itertools.groupby(items, operator.itemgetter(0))
+            ),
+        )
+
+
+def write_data(fobj, repos):
+    """
+    Write data to the binary file object one tag at a time.
+    repos must be an iterable of (repo, tags) tuples, where tags is an iterable
+    of (tag, tagdata) tuples. The output is identical to codec.dumps() of the
+    equivalent dict.
+    """
+    fobj.write(b"{")
+    for i, (repo, tags) in enumerate(repos):
+        if i:
+            fobj.write(b",")
+        fobj.write(codec.dumps(repo))
+        fobj.write(b":{")
+        for j, (tag, tagdata) in enumerate(tags):
+            if j:
+                fobj.write(b",")
+            fobj.write(codec.dumps(tag))
+            fobj.write(b":")
+            fobj.write(codec.dumps(tagdata))
+        fobj.write(b"}")
+    fobj.write(b"}")
+
+
+def iter_data(fobj):
+    """
+    Read data from the binary file object without decoding it all at once.
+    Yield a (repo, tags) tuple for each repo, where tags is an iterator of
+    (tag, tagdata) tuples, which must be consumed before moving on to the
+    next repo. Only a single tag is decoded at a time, so memory use is
+    bounded by the size of the largest tag rather than the size of the file.
+    """
+    reader = _JSONReader(fobj)
+    reader.expect("{")
+    for _ in reader.members():
+        repo = reader.value()
+        reader.expect(":")
+        reader.expect("{")
+        tags = _iter_tags(reader)
+        yield repo, tags
+        # Skip over any tags the caller did not consume
+        for _ in tags:
+            pass
+    reader.expect("")
+
+
+def _iter_tags(reader):
+    for _ in reader.members():
+        tag = reader.value()
+        reader.expect(":")
+        yield tag, reader.value()
+
+
+class _JSONReader:
+    """
+    Minimal incremental reader for the nested objects of a state file. Values
+    are decoded one at a time from a buffer refilled from the file object.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Read more data into the buffer, discarding what has already been decoded.
+        Return False if the end of the file has been reached.
+        """
+        if self.eof:
+            return False
+        chunk = self.fobj.read(self.CHUNK_SIZE)
+        self.eof = not chunk
+        self.buf = self.buf[self.pos :] + self.decoder.decode(chunk, final=self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Return the next non-whitespace character, or "" at the end of the file.
+        """
+        while True:
+            self.pos = WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self.fill():
+                return self.buf[self.pos : self.pos + 1]
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Invalid data: expected {char!r} but found {found!r}")
+        self.pos += len(char)
+
+    def members(self):
+        """
+        Generate once for each member of the object being read, consuming the
+        separators between members and the closing brace.
+        """
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == "}":
+                self.pos += 1
+                return
+            self.expect(",")
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = JSON_DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end < len(self.buf) or not self.fill():
+                self.pos = end
+                return obj
+
+
+def is_compressed(path):
+    """
+    Return True if the extension of path indicates a compressed file.
+    """
+    return os.path.splitext(path)[1] in COMPRESSED_EXTENSIONS
+
+
+@contextlib.contextmanager
+def _compressed_file(fobj, path, mode):
+    """
+    Wrap the binary file object in a streaming compressor or decompressor,
+    chosen by the extension of path. Closing the wrapper does not close fobj.
+    """
+    ext = os.path.splitext(path)[1]
+    if ext == ".gz":
+        stream = gzip.GzipFile(fileobj=fobj, mode=mode)
+    elif ext == ".xz":
+        stream = lzma.LZMAFile(fobj, mode=mode)
+    elif zstandard is None:
+        raise RuntimeError(f"The zstandard module is required to use {path}")
+    elif mode == "rb":
+        stream = zstandard.ZstdDecompressor().stream_reader(fobj, closefd=False)
+    else:
+        stream = zstandard.ZstdCompressor().stream_writer(fobj, closefd=False)
+    with stream:
+        yield stream
+
+
+@contextlib.contextmanager
+def _replace_file(path):
+    """
+    Yield a temporary file, opened for writing in binary mode, in the same
+    directory as path. When the context exits, atomically replace path with it.
+    If the extension of path indicates a compressed file, the data written
+    is compressed as it is written.
+    If an exception is raised, the temporary file is removed instead.
+    """
     with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as fobj:
-        fobj.write(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+        try:
+            if is_compressed(path):
+                with _compressed_file(fobj, path, "wb") as stream:
+                    yield stream
+            else:
+                yield fobj
+        except:
+            os.unlink(fobj.name)
+            raise
     os.chmod(fobj.name, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
     os.replace(fobj.name, path)
 
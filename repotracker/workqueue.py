@@ -0,0 +1,312 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+# Checking repos from a queue of jobs shared by several worker processes
+
+import collections
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from repotracker import codec, config, container
+
+log = logging.getLogger(__name__)
+
+REPO_TYPES = ("container", "namespace")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    section TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    previous BLOB NOT NULL,
+    result BLOB
+)
+"""
+
+Job = collections.namedtuple("Job", ["name", "section", "previous"])
+Job.__doc__ = """
+A repo section to check, with previous the state of its repos from the
+previous run, as loaded by the process which queued it.
+"""
+
+
+class WorkQueue:
+    """
+    A queue of jobs, one for each repo section of the config, in a SQLite
+    database which may be on a volume shared by several hosts. A path of
+    ":memory:" gives a queue local to the process, for testing.
+    A job claimed by a worker is leased to it for lease seconds. The worker must
+    renew the lease with heartbeat() until it completes the job, otherwise the
+    job may be claimed by another worker. A job which fails max_attempts times
+    is abandoned.
+    """
+
+    def __init__(self, path, lease=300.0, max_attempts=3, clock=time.time):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute(SCHEMA)
+
+    def _transaction(self, func, *args):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
+
+    def enqueue(self, sections, data):
+        """
+        Replace the jobs in the queue with one for each (section_name, section)
+        tuple. The state of the repos of each section in data is stored with
+        its job, so workers on other hosts compare against the same state.
+        """
+
+        def enqueue():
+            self.db.execute("DELETE FROM jobs")
+            self.db.executemany(
+                "INSERT INTO jobs (name, section, status, previous) "
+                "VALUES (?, ?, 'pending', ?)",
+                (
+                    (
+                        name,
+                        codec.dumps(dict(section)).decode("utf-8"),
+                        codec.dumps(get_previous(section, data)),
+                    )
+                    for name, section in sections
+                ),
+            )
+
+        self._transaction(enqueue)
+
+    def claim(self, worker):
+        """
+        Claim a pending job, or a job whose lease has expired, for the worker.
+        Return the Job, or None if there is nothing to claim.
+        """
+
+        def claim():
+            now = self.clock()
+            row = self.db.execute(
+                "SELECT name, section, previous FROM jobs WHERE status = 'pending' "
+                "OR (status = 'running' AND lease_until < ?) ORDER BY rowid LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, "
+                "attempts = attempts + 1 WHERE name = ?",
+                (worker, now + self.lease, row[0]),
+            )
+            return Job(row[0], codec.loads(row[1]), codec.loads(row[2]))
+
+        return self._transaction(claim)
+
+    def heartbeat(self, job, worker):
+        """
+        Renew the lease of the job. Return False if the job is no longer leased
+        to the worker.
+        """
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE jobs SET lease_until = ? "
+                "WHERE name = ? AND worker = ? AND status = 'running'",
+                (self.clock() + self.lease, job.name, worker),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job, worker, result):
+        """
+        Record the result of the job, a dict mapping repos to their tags. Return
+        False if the job was no longer leased to the worker, in which case the
+        result is discarded.
+        """
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE jobs SET status = 'done', lease_until = NULL, result = ? "
+                "WHERE name = ? AND worker = ? AND status = 'running'",
+                (codec.dumps(result), job.name, worker),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, job, worker):
+        """
+        Release the job so it can be retried, or abandon it if it has been
+        attempted max_attempts times.
+        """
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET lease_until = NULL, "
+                "status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END "
+                "WHERE name = ? AND worker = ? AND status = 'running'",
+                (self.max_attempts, job.name, worker),
+            )
+
+    def counts(self):
+        """
+        Return a dict mapping each status to the number of jobs with it.
+        """
+        with self.lock:
+            return dict(
+                self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+            )
+
+    def results(self):
+        """
+        Yield a (job, result) tuple for each job, where result is None unless
+        the job is done.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, section, previous, status, result FROM jobs "
+                "ORDER BY rowid"
+            ).fetchall()
+        for name, section, previous, status, result in rows:
+            job = Job(name, codec.loads(section), codec.loads(previous))
+            yield job, codec.loads(result) if status == "done" else None
+
+    def close(self):
+        self.db.close()
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def get_section_repos(section, data):
+    """
+    Return the repos of a container or namespace section which are in data.
+    """
+    if "repo" in section:
+        return [section["repo"]] if section["repo"] in data else []
+    prefix = section["namespace"].rstrip("/") + "/"
+    return [repo for repo in data if repo.startswith(prefix)]
+
+
+def get_previous(section, data):
+    """
+    Return the state of the repos of the section in data.
+    """
+    return {repo: data[repo] for repo in get_section_repos(section, data)}
+
+
+def get_job_conf(conf, job):
+    """
+    Return the config for checking the job: the sections of conf which are not
+    repos, and the section of the job. The repos with container sections of
+    their own are skipped by namespace jobs, as they have jobs of their own.
+    """
+    job_conf = {
+        section_name: section
+        for section_name, section in conf.items()
+        if section.get("type") not in REPO_TYPES or section_name == "broker"
+    }
+    job_conf[job.name] = job.section
+    return config.Config(job_conf, container.get_tracked_repos(conf))
+
+
+def run_job(queue, conf, job, worker, **options):
+    """
+    Check the repos of the job against its previous state, renewing its lease
+    in the background, and record the result in the queue.
+    """
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(queue.lease / 3):
+            if not queue.heartbeat(job, worker):
+                log.warning("Lost the lease of %s", job.name)
+                return
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    try:
+        result = container.check_repos(get_job_conf(conf, job), job.previous, **options)
+    except Exception:
+        log.error("Could not run %s", job.name, exc_info=True)
+        queue.fail(job, worker)
+        return
+    finally:
+        stop.set()
+        thread.join()
+    if not queue.complete(job, worker, result):
+        log.warning("%s was claimed by another worker, discarding result", job.name)
+
+
+def run_worker(queue, conf, worker=None, poll_interval=5.0, wait=0.0, **options):
+    """
+    Claim and run jobs until none are left to claim, no other worker is running
+    any, and no jobs have been queued for wait seconds, so a worker started
+    before the jobs of a run are queued, or between runs, waits for them. Jobs
+    running elsewhere are waited for, so they can be claimed if their lease
+    expires. options are passed to container.check_repos().
+    Return the number of jobs run.
+    """
+    if worker is None:
+        worker = get_worker_id()
+    count = 0
+    idle_since = None
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            if queue.counts().get("running"):
+                idle_since = None
+            else:
+                now = time.monotonic()
+                if idle_since is None:
+                    idle_since = now
+                if now - idle_since >= wait:
+                    return count
+            time.sleep(poll_interval)
+            continue
+        idle_since = None
+        log.info("%s is running %s", worker, job.name)
+        run_job(queue, conf, job, worker, **options)
+        count += 1
+
+
+def collect(queue, data):
+    """
+    Return the new state of all repos from the results of the jobs. The repos
+    of jobs which failed keep their data from the previous run, as described
+    in container.ignore_repo(), unless another job checked them.
+    """
+    new_data = {}
+    previous = {}
+    for job, result in queue.results():
+        if result is not None:
+            new_data.update(result)
+            continue
+        log.error("%s failed, reusing the data from the previous run", job.name)
+        for repo in get_section_repos(job.section, data):
+            for repo, tag, result in container.ignore_repo(repo, data):
+                previous.setdefault(repo, {})[tag] = result
+    previous.update(new_data)
+    return previous
+
+
+def check_repos(queue, conf, data, **options):
+    """
+    Queue a job for each repo section of the config, run jobs until all of them
+    are finished, by this process or by other workers, and return the new state
+    of all repos, as described in container.check_repos().
+    """
+    sections = container.get_sections(conf) + container.get_namespace_sections(conf)
+    queue.enqueue(sections, data)
+    log.info("Queued %s jobs", len(sections))
+    count = run_worker(queue, conf, **options)
+    log.info("Ran %s of %s jobs", count, len(sections))
+    return collect(queue, data)
@@ -0,0 +1,86 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import api, utils
+from unittest.mock import patch
+import asyncio
+
+CONF = {
+    "quayrepos": {"detect": "false"},
+    "test1": {"type": "container", "repo": "quay.io/repos/test1"},
+    "test2": {"type": "container", "repo": "quay.io/repos/test2"},
+}
+
+PREVIOUS = {
+    "quay.io/repos/test1": {"latest": {"action": "added", "digest": "1"}},
+    "quay.io/repos/test2": {"latest": {"action": "added", "digest": "2"}},
+}
+
+ITEMS = [
+    ("quay.io/repos/test1", "latest", {"action": "updated", "digest": "3"}),
+    ("quay.io/repos/test1", "v1", {"action": "unchanged", "digest": "1"}),
+    ("quay.io/repos/test2", "ignore", True),
+    ("quay.io/repos/test2", "latest", {"action": "added", "digest": "2"}),
+]
+
+
+@patch.object(api.container, "iter_repos", autospec=True)
+def test_iter_changes(iter_repos):
+    """
+    Test that changed tags are yielded, ignored repos are skipped, and the new
+    state is saved once the iterator is exhausted.
+    """
+    iter_repos.return_value = iter(ITEMS)
+    state = api.MemoryState(PREVIOUS)
+    with api.Tracker(CONF, state) as tracker:
+        changes = tracker.iter_changes()
+        event = next(changes)
+        assert event == api.ChangeEvent(
+            "quay.io/repos/test1",
+            "latest",
+            "updated",
+            {"action": "updated", "digest": "3"},
+        )
+        assert state.data is PREVIOUS
+        assert list(changes) == []
+    assert iter_repos.call_args.args[1] is PREVIOUS
+    assert iter_repos.call_args.kwargs["session"] is tracker.session
+    assert state.data["quay.io/repos/test1"]["latest"]["digest"] == "3"
+    assert state.data["quay.io/repos/test2"]["ignore"] is True
+
+
+@patch.object(api.container, "iter_repos", autospec=True)
+def test_iter_changes_repos(iter_repos, tmpdir):
+    """
+    Test that checking some repos merges them into the state.
+    """
+    path = str(tmpdir.join("data"))
+    utils.save_data(path, PREVIOUS)
+    iter_repos.return_value = iter(ITEMS[:2])
+    tracker = api.Tracker(CONF, api.FileState(path))
+    assert len(list(tracker.iter_changes(["quay.io/repos/test1"]))) == 1
+    tracker.close()
+    conf = iter_repos.call_args.args[0]
+    assert [name for name, section in conf.container_sections] == ["test1"]
+    data = utils.load_data(path)
+    assert data["quay.io/repos/test1"]["v1"]["digest"] == "1"
+    assert data["quay.io/repos/test2"] == PREVIOUS["quay.io/repos/test2"]
+
+
+@patch.object(api.container, "iter_repos", autospec=True)
+def test_aiter_changes(iter_repos):
+    """
+    Test that changes can be iterated asynchronously.
+    """
+    iter_repos.return_value = iter(ITEMS)
+    tracker = api.Tracker(CONF)
+
+    async def collect():
+        return [event async for event in tracker.aiter_changes()]
+
+    events = asyncio.run(collect())
+    tracker.close()
+    assert [(event.repo, event.tag) for event in events] == [
+        ("quay.io/repos/test1", "latest")
+    ]
+    assert tracker.state.data["quay.io/repos/test1"]["v1"]["action"] == "unchanged"
@@ -0,0 +1,101 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import breaker
+from requests.exceptions import ConnectionError, HTTPError, ReadTimeout
+from unittest.mock import Mock
+import pytest
+
+
+def test_breaker_trips():
+    """
+    Test that the circuit opens after the configured number of consecutive failures.
+    """
+    cb = breaker.CircuitBreaker(threshold=2, cooldown=60, clock=Mock(return_value=0))
+    assert cb.allow("quay.io")
+    cb.failure("quay.io")
+    assert cb.allow("quay.io")
+    cb.failure("quay.io")
+    assert not cb.allow("quay.io")
+    assert cb.allow("example.com")
+
+
+def test_breaker_success_resets():
+    """
+    Test that a success resets the count of consecutive failures.
+    """
+    cb = breaker.CircuitBreaker(threshold=2, cooldown=60, clock=Mock(return_value=0))
+    cb.failure("quay.io")
+    cb.success("quay.io")
+    cb.failure("quay.io")
+    assert cb.allow("quay.io")
+
+
+def test_breaker_probe():
+    """
+    Test that a single probe is allowed after the cool-down.
+    """
+    clock = Mock(return_value=0)
+    cb = breaker.CircuitBreaker(threshold=1, cooldown=60, clock=clock)
+    cb.failure("quay.io")
+    clock.return_value = 59
+    assert not cb.allow("quay.io")
+    clock.return_value = 60
+    assert cb.allow("quay.io")
+    # The probe is in flight, nothing else is let through
+    assert not cb.allow("quay.io")
+    # The probe failed
+    cb.failure("quay.io")
+    clock.return_value = 119
+    assert not cb.allow("quay.io")
+    clock.return_value = 120
+    assert cb.allow("quay.io")
+    cb.success("quay.io")
+    assert cb.allow("quay.io")
+    assert cb.allow("quay.io")
+
+
+def test_breaker_disabled():
+    """
+    Test that a threshold of 0 disables the breaker.
+    """
+    cb = breaker.CircuitBreaker(threshold=0)
+    for i in range(10):
+        cb.failure("quay.io")
+    assert cb.allow("quay.io")
+
+
+def test_get_breaker():
+    """
+    Test that the breaker is configured from the polling section.
+    """
+    cb = breaker.get_breaker(
+        {"polling": {"failure_threshold": "5", "failure_cooldown": "10"}}
+    )
+    assert cb.threshold == 5
+    assert cb.cooldown == 10.0
+    cb = breaker.get_breaker({})
+    assert cb.threshold == 3
+    assert cb.cooldown == 300.0
+
+
+@pytest.mark.parametrize(
+    "exc,expected",
+    [
+        (ConnectionError("refused"), True),
+        (ReadTimeout("timed out"), True),
+        (HTTPError(response=Mock(status_code=503)), True),
+        (HTTPError(response=Mock(status_code=404)), False),
+        (
+            RuntimeError("Error listing tags for quay.io/foo: dial tcp: i/o timeout"),
+            True,
+        ),
+        (RuntimeError("Error listing tags for quay.io/foo: unauthorized"), False),
+        (KeyError("tags"), False),
+    ],
+)
+def test_is_host_failure(exc, expected):
+    """
+    Test that only errors affecting the whole host are counted as failures.
+    """
+    assert breaker.is_host_failure(exc) is expected
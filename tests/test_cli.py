@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 # Copyright 2018 Mike Bonnet <mikeb@redhat.com>
 
+import json
 import pytest
 from unittest.mock import patch, MagicMock
 
@@ -20,6 +21,12 @@ def test_get_args_default():
     assert args.verbose is False
     assert args.config == "/etc/repotracker/repotracker.ini"
     assert args.data == "/var/lib/repotracker/containers/repotracker-containers.json"
+    assert args.stream is False
+    assert args.max_runtime is None
+    assert args.config_dir is None
+    assert args.only is None
+    assert args.only_repo is None
+    assert args.command is None
 
 
 @patch(
@@ -97,3 +104,423 @@ def test_main_error(send_container_updates, tmpdir):
     with patch("sys.argv", new=["foo", "-c", str(conf), "-d", str(data), "-q", "-v"]):
         with pytest.raises(RuntimeError):
             cli.main()
+
+
+@patch.object(cli.container, "iter_repos")
+def test_main_stream(iter_repos, tmpdir):
+    """
+    Test that the main() method saves streamed data.
+    """
+    conf = tmpdir.join("conf")
+    conf.write(
+        """[broker]
+    urls = amqps://broker01.example.com
+    cert = /cert
+    key = /key
+    cacerts = /cacerts
+    topic_prefix = container
+    """
+    )
+    data = tmpdir.join("data")
+    iter_repos.return_value = iter(
+        [("example.com/repos/testrepo", "latest", {"action": "unchanged"})]
+    )
+    with patch("sys.argv", new=["foo", "-c", str(conf), "-d", str(data), "-s", "-v"]):
+        cli.main()
+    assert cli.utils.load_data(str(data)) == {
+        "example.com/repos/testrepo": {"latest": {"action": "unchanged"}}
+    }
+
+
+@patch.object(
+    cli.messaging,
+    "send_container_updates_iter",
+    side_effect=RuntimeError("could not send messages"),
+)
+def test_main_stream_error(send_container_updates_iter, tmpdir):
+    """
+    Test that the main() method does not update the data when streaming fails.
+    """
+    conf = tmpdir.join("conf")
+    conf.write(
+        """[broker]
+    urls = amqps://broker01.example.com
+    cert = /cert
+    key = /key
+    cacerts = /cacerts
+    topic_prefix = container
+    """
+    )
+    data = tmpdir.join("data")
+    with patch("sys.argv", new=["foo", "-c", str(conf), "-d", str(data), "-s"]):
+        with pytest.raises(RuntimeError):
+            cli.main()
+    assert data.check() is False
+
+
+@patch.object(cli.container, "iter_repos", return_value=iter([]))
+def test_main_max_runtime(iter_repos, tmpdir):
+    """
+    Test that the main() method passes the deadline and schedule to the checks,
+    and saves the schedule.
+    """
+    conf = tmpdir.join("conf")
+    conf.write(
+        """[broker]
+    urls = amqps://broker01.example.com
+    cert = /cert
+    key = /key
+    cacerts = /cacerts
+    topic_prefix = container
+    """
+    )
+    data = tmpdir.join("data")
+    schedule = tmpdir.join("data.schedule")
+    schedule.write('{"example.com/repos/testrepo": 100.0}')
+    argv = ["foo", "-c", str(conf), "-d", str(data), "--max-runtime", "600"]
+    with patch("sys.argv", new=argv):
+        cli.main()
+    options = iter_repos.call_args.kwargs
+    assert 599 < options["deadline"].remaining() <= 600
+    assert options["checked"] == {"example.com/repos/testrepo": 100.0}
+    assert cli.utils.load_data(str(schedule)) == options["checked"]
+
+
+@patch.object(cli.container, "iter_repos", return_value=iter([]))
+def test_main_shard(iter_repos, tmpdir):
+    """
+    Test that the main() method only checks the sections of the shard.
+    """
+    conf = tmpdir.join("conf")
+    conf.write(
+        """[broker]
+    urls = amqps://broker01.example.com
+    cert = /cert
+    key = /key
+    cacerts = /cacerts
+    topic_prefix = container
+
+    [test1]
+    type = container
+    repo = example.com/repos/test1
+
+    [test2]
+    type = container
+    repo = example.com/repos/test2
+    """
+    )
+    data = tmpdir.join("data")
+    sections = set()
+    for index in range(2):
+        argv = ["foo", "-c", str(conf), "-d", str(data), "-s", "--shard", f"{index}/2"]
+        with patch("sys.argv", new=argv):
+            cli.main()
+        shard_conf = iter_repos.call_args.args[0]
+        assert "broker" in shard_conf
+        sections.update(name for name, section in shard_conf.container_sections)
+    assert sections == {"test1", "test2"}
+
+
+def test_main_merge(tmpdir):
+    """
+    Test that the main() method merges the data files of shards.
+    """
+    shard1 = tmpdir.join("shard1")
+    shard1.write('{"example.com/repos/test1": {}}')
+    shard2 = tmpdir.join("shard2")
+    shard2.write('{"example.com/repos/test2": {}}')
+    data = tmpdir.join("data")
+    argv = ["foo", "-d", str(data), "--merge", str(shard1), str(shard2)]
+    with patch("sys.argv", new=argv):
+        cli.main()
+    assert cli.utils.load_data(str(data)) == {
+        "example.com/repos/test1": {},
+        "example.com/repos/test2": {},
+    }
+
+
+@patch.object(cli.workqueue.container, "check_repos", autospec=True)
+def test_main_queue(check_repos, tmpdir):
+    """
+    Test that the main() method checks repos through the work queue, and saves
+    the combined results.
+    """
+    conf = tmpdir.join("conf")
+    conf.write(
+        """[broker]
+    urls = amqps://broker01.example.com
+    cert = /cert
+    key = /key
+    cacerts = /cacerts
+    topic_prefix = container
+
+    [test1]
+    type = container
+    repo = example.com/repos/test1
+    """
+    )
+    check_repos.return_value = {"example.com/repos/test1": {}}
+    data = tmpdir.join("data")
+    queue = tmpdir.join("queue.db")
+    argv = ["foo", "-c", str(conf), "-d", str(data), "--queue", str(queue)]
+    with patch("sys.argv", new=argv):
+        cli.main()
+    check_repos.assert_called_once()
+    assert cli.utils.load_data(str(data)) == {"example.com/repos/test1": {}}
+    argv += ["--worker", "--worker-wait", "0"]
+    with patch("sys.argv", new=argv):
+        cli.main()
+    check_repos.assert_called_once()
+
+
+@patch.object(cli.container, "iter_repos", return_value=iter([]))
+def test_main_locked(iter_repos, tmpdir):
+    """
+    Test that the main() method skips the run if another run holds the lock on
+    the data file.
+    """
+    conf = tmpdir.join("conf")
+    conf.write("[broker]\n")
+    data = tmpdir.join("data")
+    argv = ["foo", "-c", str(conf), "-d", str(data), "-s"]
+    with cli.locking.run_lock(str(data)):
+        with patch("sys.argv", new=argv):
+            cli.main()
+    iter_repos.assert_not_called()
+
+
+@patch.object(cli.container, "check_repos", autospec=True)
+def test_main_only(check_repos, tmpdir):
+    """
+    Test that the main() method only checks the selected repos, and merges them
+    into the existing state.
+    """
+    conf = tmpdir.join("conf")
+    conf.write(
+        """[broker]
+    urls = amqps://broker01.example.com
+    cert = /cert
+    key = /key
+    cacerts = /cacerts
+    topic_prefix = container
+
+    [test1]
+    type = container
+    repo = example.com/repos/test1
+
+    [test2]
+    type = container
+    repo = example.com/repos/test2
+    """
+    )
+    data = tmpdir.join("data")
+    data.write(
+        '{"example.com/repos/test1": {"latest": {"action": "added", "digest": "1"}},'
+        '"example.com/repos/test2": {"latest": {"action": "added", "digest": "2"}}}'
+    )
+    check_repos.return_value = {
+        "example.com/repos/test2": {"latest": {"action": "unchanged", "digest": "2"}}
+    }
+    argv = ["foo", "-c", str(conf), "-d", str(data), "--only", "test2"]
+    with patch("sys.argv", new=argv):
+        cli.main()
+    only_conf = check_repos.call_args.args[0]
+    assert [name for name, section in only_conf.container_sections] == ["test2"]
+    assert cli.utils.load_data(str(data)) == {
+        "example.com/repos/test1": {"latest": {"action": "added", "digest": "1"}},
+        "example.com/repos/test2": {"latest": {"action": "unchanged", "digest": "2"}},
+    }
+
+
+@patch.object(cli.container, "iter_repos")
+def test_main_lookup(iter_repos, tmpdir, capsys):
+    """
+    Test that the tags of a digest are looked up from the index saved by a run.
+    """
+    conf = tmpdir.join("conf")
+    conf.write(
+        """[broker]
+    urls = amqps://broker01.example.com
+    cert = /cert
+    key = /key
+    cacerts = /cacerts
+    topic_prefix = container
+    """
+    )
+    data = tmpdir.join("data")
+    iter_repos.return_value = iter(
+        [
+            ("example.com/repos/test1", "latest", {"action": "added", "digest": "1"}),
+            ("example.com/repos/test2", "latest", {"action": "added", "digest": "2"}),
+        ]
+    )
+    with patch("sys.argv", new=["foo", "-c", str(conf), "-d", str(data), "-s"]):
+        cli.main()
+    capsys.readouterr()
+    with patch("sys.argv", new=["foo", "-d", str(data), "lookup", "2"]):
+        cli.main()
+    assert capsys.readouterr().out == "example.com/repos/test2:latest\n"
+
+
+@patch.object(cli.container, "iter_repos")
+def test_main_metrics_file(iter_repos, tmpdir):
+    """
+    Test that the metrics of the run are written to the metrics file.
+    """
+    conf = tmpdir.join("conf")
+    conf.write(
+        """[broker]
+    urls = amqps://broker01.example.com
+    cert = /cert
+    key = /key
+    cacerts = /cacerts
+    topic_prefix = container
+    """
+    )
+    data = tmpdir.join("data")
+    prom = tmpdir.join("repotracker.prom")
+    iter_repos.return_value = iter([])
+    argv = ["foo", "-c", str(conf), "-d", str(data), "--metrics-file", str(prom)]
+    with patch("sys.argv", new=argv):
+        cli.main()
+    assert 'repotracker_state_seconds{operation="load"}' in prom.read()
+
+
+@patch.object(cli.container, "iter_repos")
+def test_main_profile(iter_repos, tmpdir, capsys):
+    """
+    Test that the phases of the run are profiled.
+    """
+    conf = tmpdir.join("conf")
+    conf.write(
+        """[broker]
+    urls = amqps://broker01.example.com
+    cert = /cert
+    key = /key
+    cacerts = /cacerts
+    topic_prefix = container
+    """
+    )
+    data = tmpdir.join("data")
+    profile = tmpdir.join("profile")
+    iter_repos.return_value = iter([])
+    argv = ["foo", "-c", str(conf), "-d", str(data), "--profile", str(profile)]
+    with patch("sys.argv", new=argv):
+        cli.main()
+    assert sorted(profile.listdir()) == [
+        profile.join(f"{name}.prof")
+        for name in [
+            "check_repos",
+            "config_load",
+            "save_data",
+            "send_container_updates",
+            "state_load",
+        ]
+    ]
+    assert "send_container_updates" in capsys.readouterr().err
+    assert not cli.profiling.tracemalloc.is_tracing()
+
+
+@patch.object(cli.container, "iter_repos")
+def test_main_trace(iter_repos, tmpdir):
+    """
+    Test that the spans of the run are written to the trace file.
+    """
+    conf = tmpdir.join("conf")
+    conf.write(
+        """[broker]
+    urls = amqps://broker01.example.com
+    cert = /cert
+    key = /key
+    cacerts = /cacerts
+    topic_prefix = container
+    """
+    )
+    data = tmpdir.join("data")
+    trace = tmpdir.join("trace.json")
+    iter_repos.return_value = iter([])
+    argv = ["foo", "-c", str(conf), "-d", str(data), "-s", "--trace", str(trace)]
+    argv += ["--trace-format", "chrome"]
+    with patch("sys.argv", new=argv), patch.object(
+        cli.tracing, "tracer", cli.tracing.Tracer()
+    ):
+        cli.main()
+    events = json.loads(trace.read())["traceEvents"]
+    assert [event["name"] for event in events] == [
+        "run",
+        "load_config",
+        "load_state",
+        "stream",
+    ]
+
+
+@patch.object(cli.runner, "kill_running", autospec=True)
+def test_terminate(kill_running):
+    """
+    Test that SIGTERM kills the running skopeo commands and exits.
+    """
+    with pytest.raises(SystemExit) as exc:
+        cli.terminate(cli.signal.SIGTERM, None)
+    assert exc.value.code == 143
+    kill_running.assert_called_once_with()
+
+
+@patch.object(cli.container, "check_repos", autospec=True)
+def test_main_lock_repo(check_repos, tmpdir):
+    """
+    Test that with --lock repo, the repos checked stay locked until their new
+    state has been saved.
+    """
+    conf = tmpdir.join("conf")
+    conf.write(
+        """[broker]
+    urls = amqps://broker01.example.com
+    cert = /cert
+    key = /key
+    cacerts = /cacerts
+    topic_prefix = container
+
+    [test1]
+    type = container
+    repo = example.com/repos/test1
+    """
+    )
+    data = tmpdir.join("data")
+    other = cli.locking.RepoLocks(str(data), {})
+    result = {"example.com/repos/test1": {"latest": {"action": "unchanged"}}}
+
+    def check(conf, data, repo_locks=None, **options):
+        assert repo_locks.acquire("example.com/repos/test1")
+        return result
+
+    def merge_on_save(path, new_data, lock=True):
+        assert not other.acquire("example.com/repos/test1")
+        return merge(path, new_data, lock)
+
+    check_repos.side_effect = check
+    merge = cli.locking.merge_on_save
+    argv = ["foo", "-c", str(conf), "-d", str(data), "--lock", "repo"]
+    with patch("sys.argv", new=argv), patch.object(
+        cli.locking, "merge_on_save", side_effect=merge_on_save
+    ) as merge_mock:
+        cli.main()
+    merge_mock.assert_called_once()
+    assert cli.utils.load_data(str(data)) == result
+    assert other.acquire("example.com/repos/test1")
+    other.release_all()
+
+
+@patch.object(cli.container, "iter_repos", return_value=iter([]))
+def test_main_lock_repo_full_run(iter_repos, tmpdir):
+    """
+    Test that a run locking repos is skipped while a full run holds the lock
+    on the data file.
+    """
+    conf = tmpdir.join("conf")
+    conf.write("[broker]\n")
+    data = tmpdir.join("data")
+    argv = ["foo", "-c", str(conf), "-d", str(data), "--lock", "repo"]
+    with cli.locking.run_lock(str(data)):
+        with patch("sys.argv", new=argv):
+            cli.main()
+    iter_repos.assert_not_called()
@@ -0,0 +1,76 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import codec
+from unittest.mock import patch
+import json
+import pytest
+
+DATA = {
+    "example.com/repos/testrepo": {
+        "latest": {
+            "action": "added",
+            "repo": "example.com/repos/testrepo",
+            "reponame": "testrepo",
+            "tag": "latest",
+            "digest": "abc123",
+            "old_digest": None,
+            "created": "2018-10-28T00:07:23Z",
+            "labels": {
+                "zzz": "first",
+                "description": 'Quotes " and \\ slashes / and unicode é  ',
+                "control": "\x00\x1f\x7f\t\n",
+            },
+            "os": "linux",
+            "arch": "x86_64",
+        },
+        "ignore": True,
+    }
+}
+
+
+def test_get_codec_default():
+    """
+    Test that the fastest available codec is used by default.
+    """
+    expected = "orjson" if "orjson" in codec.CODECS else "json"
+    assert codec.get_codec().name == expected
+
+
+@patch.dict(codec.CODECS, values={"json": codec.CODECS["json"]}, clear=True)
+def test_get_codec_fallback():
+    """
+    Test that the stdlib codec is used when no faster codec is installed.
+    """
+    assert codec.get_codec().name == "json"
+
+
+def test_get_codec_unknown():
+    """
+    Test that requesting an unknown codec raises an error.
+    """
+    with pytest.raises(ValueError, match="Unknown or unavailable JSON codec: foo"):
+        codec.get_codec("foo")
+
+
+@pytest.mark.parametrize("name", sorted(codec.CODECS))
+def test_codec_roundtrip(name):
+    """
+    Test that each codec produces compact output in insertion order and decodes it again.
+    """
+    impl = codec.get_codec(name)
+    result = impl.dumps(DATA)
+    assert isinstance(result, bytes)
+    assert result == json.dumps(DATA, ensure_ascii=False, separators=(",", ":")).encode(
+        "utf-8"
+    )
+    assert impl.loads(result) == DATA
+    assert impl.loads(result.decode("utf-8")) == DATA
+
+
+def test_codecs_identical():
+    """
+    Test that all available codecs produce byte-identical output.
+    """
+    results = {impl.dumps(DATA) for impl in codec.CODECS.values()}
+    assert len(results) == 1
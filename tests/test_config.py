@@ -0,0 +1,157 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import config
+from unittest.mock import patch
+import os
+
+MAIN = """[broker]
+topic_prefix = container
+
+[quayrepos]
+repos = quay.io
+
+[example]
+type = container
+repo = example.com/repos/testrepo
+"""
+
+FRAGMENT = """[other]
+type = container
+repo = quay.io/repos/other
+
+[example]
+priority = 10
+"""
+
+
+def test_prefix_table():
+    """
+    Test that PrefixTable matches the same strings as str.startswith().
+    """
+    prefixes = ["quay.io", "quay.io/special", "images.example.com", "q"]
+    table = config.PrefixTable(prefixes)
+    for value in [
+        "quay.io/repos/a",
+        "quay.iox/repos/a",
+        "images.example.com/a",
+        "images.example.org/a",
+        "registry.example.com/a",
+        "",
+    ]:
+        assert table.match(value) == value.startswith(tuple(prefixes))
+    assert not config.PrefixTable([]).match("quay.io/repos/a")
+
+
+def test_load_fragments(tmpdir):
+    """
+    Test that fragments in conf.d are merged into the config, in order.
+    """
+    main = tmpdir.join("repotracker.ini")
+    main.write(MAIN)
+    tmpdir.mkdir("conf.d").join("10-other.ini").write(FRAGMENT)
+    tmpdir.join("conf.d", "20-ignored.txt").write("not a config file")
+    conf = config.load(str(main))
+    assert conf["broker"]["topic_prefix"] == "container"
+    assert conf["example"] == {
+        "type": "container",
+        "repo": "example.com/repos/testrepo",
+        "priority": "10",
+    }
+    assert [name for name, section in conf.container_sections] == ["example", "other"]
+
+
+def test_load_dirs(tmpdir):
+    """
+    Test that fragment directories can be given explicitly.
+    """
+    main = tmpdir.join("repotracker.ini")
+    main.write(MAIN)
+    tmpdir.mkdir("conf.d").join("10-other.ini").write(FRAGMENT)
+    conf = config.load(str(main), [str(tmpdir.mkdir("empty"))])
+    assert "other" not in conf
+    assert [name for name, section in conf.container_sections] == ["example"]
+
+
+def test_load_cache(tmpdir):
+    """
+    Test that the parsed config is reused until one of the files changes.
+    """
+    main = tmpdir.join("repotracker.ini")
+    main.write(MAIN)
+    fragment = tmpdir.mkdir("conf.d").join("10-other.ini")
+    fragment.write(FRAGMENT)
+    cache = str(tmpdir.join("cache"))
+    conf = config.load(str(main), cache_path=cache)
+    with patch.object(config, "parse", autospec=True) as parse:
+        assert config.load(str(main), cache_path=cache) == conf
+        parse.assert_not_called()
+    fragment.write(FRAGMENT.replace("priority = 10", "priority = 20"))
+    st = os.stat(str(fragment))
+    os.utime(str(fragment), ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    conf = config.load(str(main), cache_path=cache)
+    assert conf["example"]["priority"] == "20"
+    assert len(conf.container_sections) == 2
+
+
+def test_load_invalid_cache(tmpdir):
+    """
+    Test that an invalid cache is ignored and replaced.
+    """
+    main = tmpdir.join("repotracker.ini")
+    main.write(MAIN)
+    cache = tmpdir.join("cache")
+    cache.write("{not json")
+    conf = config.load(str(main), cache_path=str(cache))
+    assert conf["example"]["repo"] == "example.com/repos/testrepo"
+    assert config.load(str(main), cache_path=str(cache)) == conf
+
+
+def test_select():
+    """
+    Test that only the named sections and repos are selected, along with the
+    sections which are not repos.
+    """
+    conf = {
+        "broker": {"topic_prefix": "container"},
+        "polling": {"rate_limit": "1"},
+        "test1": {"type": "container", "repo": "example.com/repos/test1"},
+        "test2": {"type": "container", "repo": "example.com/repos/test2"},
+        "test3": {"type": "container", "repo": "example.com/repos/test3"},
+        "ns": {"type": "namespace", "namespace": "quay.io/ns", "token_env": "TOKEN"},
+    }
+    selected = config.select(
+        conf,
+        ["test1", "missing", "polling"],
+        ["example.com/repos/test3", "quay.io/ns/repo", "quay.io/other/repo"],
+    )
+    assert selected == {
+        "broker": conf["broker"],
+        "polling": conf["polling"],
+        "test1": conf["test1"],
+        "test3": conf["test3"],
+        "ns:quay.io/ns/repo": {
+            "type": "container",
+            "repo": "quay.io/ns/repo",
+            "token_env": "TOKEN",
+        },
+    }
+    assert [name for name, section in selected.container_sections] == [
+        "test1",
+        "test3",
+        "ns:quay.io/ns/repo",
+    ]
+    assert "example.com/repos/test2" in selected.tracked_repos
+
+
+def test_find_repo_container_first():
+    """
+    Test that the container section of a repo is used rather than a namespace
+    section containing it, even if the namespace section comes first.
+    """
+    conf = {
+        "ns": {"type": "namespace", "namespace": "quay.io/ns", "token_env": "NS"},
+        "repo": {"type": "container", "repo": "quay.io/ns/repo", "token_env": "REPO"},
+    }
+    assert config.find_repo(conf, "quay.io/ns/repo") == ("repo", conf["repo"])
+    assert config.find_repo(conf, "quay.io/ns/other")[0] == "ns:quay.io/ns/other"
@@ -3,11 +3,14 @@
 
 
 from repotracker import container
+from repotracker.breaker import CircuitBreaker
 from repotracker.utils import format_ts, format_time
-from unittest.mock import patch, call, Mock
+from unittest.mock import ANY, patch, call, Mock
+import http.server
 import json
 import pytest
-
+import threading
+import time
 
 CONF = {
     "broker": {
@@ -23,6 +26,7 @@ CONF = {
     },
     "quayrepos": {
         "repos": "quay.io",
+        "detect": "false",
     },
 }
 RAW_DATA_1 = """
@@ -115,7 +119,7 @@ def test_inspect_repo_no_latest(run, list_tags):
     run.return_value.returncode = 0
     run.return_value.stdout = json.dumps(INSPECT_DATA_1)
     result = container.inspect_image_repo("example.com/repos/testrepo")
-    list_tags.assert_called_once_with("example.com/repos/testrepo")
+    list_tags.assert_called_once_with("example.com/repos/testrepo", ANY)
     assert result == {"some-tag": INSPECT_DATA_1}
 
 
@@ -147,7 +151,7 @@ def test_check_repos_raises(list_tags):
     Test that an error inspecting the repo results in the correct output.
     """
     result = container.check_repos(CONF, {})
-    list_tags.assert_called_once_with("example.com/repos/testrepo")
+    list_tags.assert_called_once_with("example.com/repos/testrepo", ANY)
     assert result == {}
 
 
@@ -158,8 +162,8 @@ def test_check_repos_added(inspect_tag, list_tags):
     Test that a new repo results in the correct output.
     """
     result = container.check_repos(CONF, {})
-    list_tags.assert_called_once_with("example.com/repos/testrepo")
-    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest")
+    list_tags.assert_called_once_with("example.com/repos/testrepo", ANY)
+    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest", ANY)
     assert result == {
         "example.com/repos/testrepo": {
             "latest": {
@@ -201,8 +205,8 @@ def test_check_repos_unchanged(inspect_tag, list_tags):
         }
     }
     result = container.check_repos(CONF, old_data)
-    list_tags.assert_called_once_with("example.com/repos/testrepo")
-    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest")
+    list_tags.assert_called_once_with("example.com/repos/testrepo", ANY)
+    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest", ANY)
     assert result == {
         "example.com/repos/testrepo": {
             "latest": {
@@ -245,8 +249,8 @@ def test_check_repos_unchanged_ignore(inspect_tag, list_tags):
         }
     }
     result = container.check_repos(CONF, old_data)
-    list_tags.assert_called_once_with("example.com/repos/testrepo")
-    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest")
+    list_tags.assert_called_once_with("example.com/repos/testrepo", ANY)
+    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest", ANY)
     assert result == {
         "example.com/repos/testrepo": {
             "latest": {
@@ -288,8 +292,8 @@ def test_check_repos_updated(inspect_tag, list_tags):
         }
     }
     result = container.check_repos(CONF, old_data)
-    list_tags.assert_called_once_with("example.com/repos/testrepo")
-    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest")
+    list_tags.assert_called_once_with("example.com/repos/testrepo", ANY)
+    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest", ANY)
     assert result == {
         "example.com/repos/testrepo": {
             "latest": {
@@ -343,8 +347,8 @@ def test_check_repos_removed(inspect_tag, list_tags):
         }
     }
     result = container.check_repos(CONF, old_data)
-    list_tags.assert_called_once_with("example.com/repos/testrepo")
-    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest")
+    list_tags.assert_called_once_with("example.com/repos/testrepo", ANY)
+    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest", ANY)
     assert result == {
         "example.com/repos/testrepo": {
             "latest": {
@@ -410,8 +414,8 @@ def test_check_repos_removed_previously(inspect_tag, list_tags):
         }
     }
     result = container.check_repos(CONF, old_data)
-    list_tags.assert_called_once_with("example.com/repos/testrepo")
-    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest")
+    list_tags.assert_called_once_with("example.com/repos/testrepo", ANY)
+    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest", ANY)
     assert result == {
         "example.com/repos/testrepo": {
             "latest": {
@@ -653,8 +657,8 @@ def test_check_repos_readded(inspect_tag, list_tags):
         }
     }
     result = container.check_repos(CONF, old_data)
-    list_tags.assert_called_once_with("example.com/repos/testrepo")
-    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest")
+    list_tags.assert_called_once_with("example.com/repos/testrepo", ANY)
+    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest", ANY)
     assert result == {
         "example.com/repos/testrepo": {
             "latest": {
@@ -694,6 +698,7 @@ def test_list_tags(run):
         stdout=-1,
         stderr=-1,
         encoding="utf-8",
+        timeout=70.0,
     )
     assert result == json.loads(TAG_DATA)["Tags"]
 
@@ -747,6 +752,28 @@ def test_skopeo_run(run):
     ]
 
 
+@patch.object(container, "list_tags", autospec=True, return_value=["a", "b", "c"])
+@patch.object(container.runner.AsyncRunner, "run_all", autospec=True)
+def test_inspect_image_repo_concurrent(run_all, list_tags):
+    """
+    Test that tags are inspected by the AsyncRunner when concurrency is enabled,
+    and that tags which could not be inspected are skipped.
+    """
+    run_all.return_value = [
+        container.subprocess.CompletedProcess([], 0, json.dumps(INSPECT_DATA_1), ""),
+        container.subprocess.CompletedProcess([], 1, "", "manifest unknown"),
+        container.subprocess.CompletedProcess([], 1, "", "timed out"),
+    ]
+    result = container.inspect_image_repo("example.com/repos/testrepo", None, 2)
+    assert result == {"a": INSPECT_DATA_1, "b": {}}
+    run_all.assert_called_once()
+    assert run_all.call_args.args[1] == [
+        ("example.com/repos/testrepo:a", container.INSPECT_ARGS),
+        ("example.com/repos/testrepo:b", container.INSPECT_ARGS),
+        ("example.com/repos/testrepo:c", container.INSPECT_ARGS),
+    ]
+
+
 # Test use of the quay.io API
 QUAY_API_DATA = {
     "has_additional": False,
@@ -817,7 +844,7 @@ for i in range(3):
 
 
 @patch.dict(CONF["test"], repo="quay.io/repos/testrepo")
-@patch.object(container, "Session", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
 def test_quay_latest(Session):
     """
     Test that data for a single tag from the quay.io API is handled correctly.
@@ -849,7 +876,7 @@ def test_quay_latest(Session):
 
 @patch.dict(CONF["quayrepos"], repos="quay-like.io")
 @patch.dict(CONF["test"], repo="quay-like.io/repos/testrepo")
-@patch.object(container, "Session", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
 def test_quay_repo_detection(Session):
     """
     Test that custom quay instances passed via config are inspected via Quay API
@@ -879,9 +906,51 @@ def test_quay_repo_detection(Session):
     }
 
 
+@patch.dict(CONF["quayrepos"], detect="true")
+@patch.dict(CONF["test"], repo="quay-like.io/repos/testrepo")
+@patch.object(container.discovery, "probe", autospec=True, return_value=True)
+@patch.object(container.sessions, "Session", autospec=True)
+def test_quay_repo_autodetection(Session, probe):
+    """
+    Test that quay instances which are not in the config are detected, and
+    inspected via Quay API
+    """
+    Session.return_value.get.return_value.json.return_value = QUAY_API_DATA
+    result = container.check_repos(CONF, {})
+    probe.assert_called_once_with("quay-like.io")
+    Session.return_value.get.assert_called_once_with(
+        "https://quay-like.io/api/v1/repository/repos/testrepo/tag/?onlyActiveTags=true&limit=100&page=1",
+        headers={},
+        timeout=60.0,
+    )
+    assert list(result["quay-like.io/repos/testrepo"]) == ["latest"]
+
+
+@patch.object(container.discovery, "probe", autospec=True, return_value=None)
+@patch.object(
+    container,
+    "list_tags",
+    autospec=True,
+    side_effect=RuntimeError("dial tcp: lookup example.com: no such host"),
+)
+def test_unreachable_host_one_failure(list_tags, probe):
+    """
+    Test that a host which can neither be probed nor reached by skopeo only
+    counts as one failure with the breaker.
+    """
+    conf = {
+        "polling": {"failure_threshold": "2"},
+        "test1": {"type": "container", "repo": "example.com/repos/test1"},
+        "test2": {"type": "container", "repo": "example.com/repos/test2"},
+    }
+    container.check_repos(conf, {})
+    probe.assert_called_once_with("example.com")
+    assert list_tags.call_count == 2
+
+
 @patch.dict(CONF["test"], repo="quay.io/repos/testrepo", token_env="ENV_TOKEN")
 @patch.dict(container.os.environ, {"ENV_TOKEN": "TOKEN"})
-@patch.object(container, "Session", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
 def test_quay_token(Session):
     """
     Test that token is passed from config.
@@ -897,7 +966,7 @@ def test_quay_token(Session):
 
 @patch.dict(CONF["test"], repo="quay.io/repos/testrepo", token_env="ENV_TOKEN")
 @patch.dict(container.os.environ, {})
-@patch.object(container, "Session", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
 def test_quay_token_missing(Session):
     """
     Test missing token in env but defined in config.
@@ -912,7 +981,7 @@ def test_quay_token_missing(Session):
 
 
 @patch.dict(CONF["test"], repo="quay.io/repos/testrepo")
-@patch.object(container, "Session", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
 def test_quay_multitag(Session):
     """
     Test that data for multiple tags from the quay.io API is handled correctly.
@@ -954,8 +1023,43 @@ def test_quay_multitag(Session):
     }
 
 
+@patch.dict(CONF["test"], repo="quay.io/repos/testrepo", include_tags="st*")
+@patch.object(container.sessions, "Session", autospec=True)
+def test_quay_tag_filter(Session):
+    """
+    Test that tag filters are sent to the quay.io API, and applied to the tags
+    it returns. Excluded tags from the previous run are not reported as removed.
+    """
+    Session.return_value.get.return_value.json.return_value = QUAY_API_DATA_MULTITAG
+    old_data = {
+        "quay.io/repos/testrepo": {
+            "prod": {"action": "added", "digest": "abc123"},
+        }
+    }
+    result = container.check_repos(CONF, old_data)
+    Session.return_value.get.assert_called_once_with(
+        "https://quay.io/api/v1/repository/repos/testrepo/tag/"
+        "?onlyActiveTags=true&limit=100&page=1&filter_tag_name=like%3Ast%25",
+        headers={},
+        timeout=60.0,
+    )
+    assert list(result["quay.io/repos/testrepo"]) == ["stage"]
+
+
+@patch.dict(CONF["test"], exclude_tags="re:pr-[0-9]+")
+@patch.object(container, "list_tags", autospec=True, return_value=["latest", "pr-1"])
+@patch.object(container, "inspect_tag", autospec=True, return_value=INSPECT_DATA_1)
+def test_image_tag_filter(inspect_tag, list_tags):
+    """
+    Test that excluded tags are not inspected.
+    """
+    result = container.check_repos(CONF, {})
+    inspect_tag.assert_called_once_with("example.com/repos/testrepo", "latest", ANY)
+    assert list(result["example.com/repos/testrepo"]) == ["latest"]
+
+
 @patch.dict(CONF["test"], repo="quay.io/repos/testrepo")
-@patch.object(container, "Session", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
 def test_quay_multipage(Session):
     """
     Test that multiple pages of data from the quay.io API are handled correctly.
@@ -1025,7 +1129,7 @@ def test_quay_multipage(Session):
 @patch.dict(CONF["test"], repo="quay.io/repos/testrepo")
 @patch.dict(QUAY_API_DATA_MULTITAG, has_additional=True)
 @patch.dict(QUAY_API_DATA, page=2)
-@patch.object(container, "Session", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
 def test_quay_multitag_multipage(Session):
     """
     Test that multiple pages of data containing multiple tags from the quay.io API are handled correctly.
@@ -1091,7 +1195,7 @@ def test_quay_multitag_multipage(Session):
 
 
 @patch.dict(CONF["test"], repo="quay.io/repos/testrepo")
-@patch.object(container, "Session", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
 def test_quay_error_unchanged(Session):
     """
     Test that a (temporary) error when querying the quay.io API leaves the data unchanged.
@@ -1142,7 +1246,7 @@ def test_quay_error_unchanged(Session):
 
 @patch.dict(CONF["test"], repo="quay.io/repos/testrepo")
 @patch.dict(QUAY_API_DATA_MULTITAG["tags"][0], name="prod")
-@patch.object(container, "Session", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
 def test_quay_duplicate_tag(Session):
     """
     Test that data for duplicate tags with the same name from the quay.io API is handled correctly.
@@ -1170,3 +1274,710 @@ def test_quay_duplicate_tag(Session):
             }
         }
     }
+
+
+@patch.object(container.sessions, "Session", autospec=True)
+def test_iter_quay_repo_streams_pages(Session):
+    """
+    Test that iter_quay_repo() yields the tags of a page before requesting the next one.
+    """
+    Session.return_value.get.return_value.json.side_effect = QUAY_API_DATA_MULTIPAGE
+    tags = container.iter_quay_repo("quay.io/repos/testrepo")
+    tag, tagdata = next(tags)
+    assert tag == "tag1"
+    assert tagdata["Digest"] == QUAY_API_DATA["tags"][0]["manifest_digest"]
+    Session.return_value.get.assert_called_once()
+    assert [tag for tag, tagdata in tags] == ["tag2", "tag3"]
+    assert Session.return_value.get.call_count == 3
+
+
+@patch.dict(CONF["test"], repo="quay.io/repos/testrepo")
+@patch.object(container.sessions, "Session", autospec=True)
+def test_iter_repos_holds_back_changes(Session):
+    """
+    Test that iter_repos() yields unchanged tags immediately, and changed tags once
+    the whole repo has been inspected.
+    """
+    Session.return_value.get.return_value.json.side_effect = QUAY_API_DATA_MULTIPAGE
+    old_data = {
+        "quay.io/repos/testrepo": {
+            "tag2": {
+                "action": "added",
+                "repo": "quay.io/repos/testrepo",
+                "reponame": "testrepo",
+                "tag": "tag2",
+                "digest": QUAY_API_DATA["tags"][0]["manifest_digest"],
+                "old_digest": None,
+                "created": format_ts(QUAY_API_DATA["tags"][0]["start_ts"]),
+                "labels": {},
+                "os": "",
+                "arch": "",
+            },
+            "gone": {
+                "action": "added",
+                "repo": "quay.io/repos/testrepo",
+                "reponame": "testrepo",
+                "tag": "gone",
+                "digest": "sha256:abc123",
+                "old_digest": None,
+                "created": format_ts(QUAY_API_DATA["tags"][0]["start_ts"]),
+                "labels": {},
+                "os": "",
+                "arch": "",
+            },
+        }
+    }
+    items = container.iter_repos(CONF, old_data)
+    repo, tag, result = next(items)
+    assert (repo, tag, result["action"]) == (
+        "quay.io/repos/testrepo",
+        "tag2",
+        "unchanged",
+    )
+    assert Session.return_value.get.call_count == 2
+    assert [(tag, result["action"]) for repo, tag, result in items] == [
+        ("tag1", "added"),
+        ("tag3", "added"),
+        ("gone", "removed"),
+    ]
+
+
+@patch.dict(CONF["test"], repo="quay.io/repos/testrepo")
+@patch.object(container.sessions, "Session", autospec=True)
+def test_iter_repos_error_part_way(Session):
+    """
+    Test that an error part way through a repo falls back to the data from the
+    previous run for the tags which have not been yielded yet.
+    """
+    Session.return_value.get.return_value.json.side_effect = [
+        QUAY_API_DATA_MULTIPAGE[0],
+        QUAY_API_DATA_MULTIPAGE[1],
+        RuntimeError("request error"),
+    ]
+    old_data = {
+        "quay.io/repos/testrepo": {
+            tag: {
+                "action": "added",
+                "repo": "quay.io/repos/testrepo",
+                "reponame": "testrepo",
+                "tag": tag,
+                "digest": digest,
+                "old_digest": None,
+                "created": format_ts(QUAY_API_DATA["tags"][0]["start_ts"]),
+                "labels": {},
+                "os": "",
+                "arch": "",
+            }
+            for tag, digest in [
+                ("tag1", QUAY_API_DATA["tags"][0]["manifest_digest"]),
+                ("tag2", "sha256:abc123"),
+                ("tag3", "sha256:def456"),
+            ]
+        }
+    }
+    result = list(container.iter_repos(CONF, old_data))
+    assert [
+        (tag, value if tag == "ignore" else value["action"])
+        for repo, tag, value in result
+    ] == [
+        ("tag1", "unchanged"),
+        ("ignore", True),
+        ("tag2", "added"),
+        ("tag3", "added"),
+    ]
+    assert result[2][2] is old_data["quay.io/repos/testrepo"]["tag2"]
+
+
+@patch.object(
+    container,
+    "list_tags",
+    autospec=True,
+    side_effect=RuntimeError("dial tcp: lookup example.com: no such host"),
+)
+def test_check_repos_breaker(list_tags):
+    """
+    Test that repos on a host which keeps failing are skipped, and their data
+    from the previous run is reused.
+    """
+    conf = {
+        "polling": {"failure_threshold": "2"},
+        "quayrepos": {"detect": "false"},
+        "test1": {"type": "container", "repo": "example.com/repos/test1"},
+        "test2": {"type": "container", "repo": "example.com/repos/test2"},
+        "test3": {"type": "container", "repo": "example.com/repos/test3"},
+        "other": {"type": "container", "repo": "other.example.com/repos/test"},
+    }
+    old_data = {
+        "example.com/repos/test3": {
+            "latest": {"action": "added", "digest": "abc123"},
+        }
+    }
+    result = container.check_repos(conf, old_data)
+    assert list_tags.call_args_list == [
+        call("example.com/repos/test1", ANY),
+        call("example.com/repos/test2", ANY),
+        call("other.example.com/repos/test", ANY),
+    ]
+    assert result == {
+        "example.com/repos/test3": {
+            "ignore": True,
+            "latest": {"action": "added", "digest": "abc123"},
+        }
+    }
+
+
+@patch.object(container, "list_tags", autospec=True, return_value=["a", "b", "c", "d"])
+@patch.object(container, "inspect_tag", autospec=True)
+def test_iter_image_repo_breaker(inspect_tag, list_tags):
+    """
+    Test that tags which cannot be inspected because the host is unhealthy
+    are recorded against the breaker, and the repo is abandoned once its
+    circuit opens.
+    """
+    inspect_tag.side_effect = [
+        RuntimeError("503 Service Unavailable"),
+        INSPECT_DATA_1,
+        RuntimeError("503 Service Unavailable"),
+        RuntimeError("503 Service Unavailable"),
+    ]
+    breaker = CircuitBreaker(threshold=2)
+    container.metrics.registry.clear()
+    tags = container.iter_image_repo(
+        "example.com/repos/testrepo", breaker=breaker, concurrency=1
+    )
+    assert next(tags) == ("b", INSPECT_DATA_1)
+    assert not breaker.is_open("example.com")
+    with pytest.raises(RuntimeError, match="503"):
+        next(tags)
+    assert breaker.is_open("example.com")
+    assert inspect_tag.call_count == 4
+    errors = container.metrics.registry.values["repotracker_errors_total"]
+    assert errors == {(("host", "example.com"), ("operation", "inspect")): 3}
+
+
+@patch.object(container.ratelimit, "limiter", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
+def test_quay_rate_limited(Session, limiter):
+    """
+    Test that requests to the Quay API go through the rate limiter, which sees
+    every response.
+    """
+    Session.return_value.get.return_value.json.side_effect = QUAY_API_DATA_MULTIPAGE
+    container.inspect_quay_repo("quay.io/repos/testrepo")
+    assert limiter.acquire.call_args_list == [call("quay.io")] * 3
+    assert (
+        limiter.update.call_args_list
+        == [call("quay.io", Session.return_value.get.return_value)] * 3
+    )
+
+
+@patch.object(container.ratelimit, "limiter", autospec=True)
+@patch.object(container.subprocess, "run")
+def test_skopeo_rate_limited(run, limiter):
+    """
+    Test that skopeo commands go through the rate limiter.
+    """
+    container.skopeo_run("example.com/repos/testrepo:latest", "inspect")
+    limiter.acquire.assert_called_once_with("example.com")
+
+
+def serve_rate_limited(retry_after):
+    """
+    Start a server answering the first request with a 429 response, and the
+    others with an empty JSON object. Return the server and the list of paths
+    requested.
+    """
+    requested = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            if len(requested) == 1:
+                self.send_response(429)
+                self.send_header("Retry-After", retry_after)
+                body = b""
+            else:
+                self.send_response(200)
+                body = b"{}"
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, requested
+
+
+@patch.object(container.ratelimit, "limiter", autospec=True)
+def test_get_page_rate_limited(limiter):
+    """
+    Test that a 429 response is returned by the session rather than waited for
+    and retried by it, so the rate limiter sees it, and the request is retried
+    once the rate limiter allows it.
+    """
+    server, requested = serve_rate_limited("30")
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/v1/repository"
+    try:
+        start = time.monotonic()
+        resp = container.get_page(
+            container.sessions.get_session(), "127.0.0.1", url, {}
+        )
+        assert time.monotonic() - start < 10
+    finally:
+        server.shutdown()
+    assert resp.status_code == 200
+    assert len(requested) == 2
+    assert [c.args[1].status_code for c in limiter.update.call_args_list] == [
+        429,
+        200,
+    ]
+
+
+@patch.object(container.ratelimit, "limiter", autospec=True)
+def test_get_page_rate_limited_deadline(limiter):
+    """
+    Test that DeadlineExceeded is raised if the host asks us to wait beyond the
+    deadline.
+    """
+    server, requested = serve_rate_limited("30")
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/v1/repository"
+    try:
+        with pytest.raises(container.schedule.DeadlineExceeded):
+            container.get_page(
+                container.sessions.get_session(),
+                "127.0.0.1",
+                url,
+                {},
+                container.schedule.Deadline(10),
+            )
+    finally:
+        server.shutdown()
+    assert len(requested) == 1
+
+
+@patch.object(container.latency, "hedged", autospec=True)
+@patch.object(container.latency, "api", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
+def test_quay_hedged(Session, api, hedged):
+    """
+    Test that Quay API requests use the adaptive timeout, and are hedged when
+    a hedging delay is available.
+    """
+    api.timeout.return_value = 7.5
+    api.hedge_delay.return_value = 0.5
+    hedged.side_effect = lambda func, delay, hedge: func()
+    Session.return_value.get.return_value.json.return_value = QUAY_API_DATA
+    container.inspect_quay_repo("quay.io/repos/testrepo")
+    Session.return_value.get.assert_called_once_with(
+        "https://quay.io/api/v1/repository/repos/testrepo/tag/?onlyActiveTags=true&limit=100&page=1",
+        headers={},
+        timeout=7.5,
+    )
+    assert hedged.call_args.args[1] == 0.5
+    api.record.assert_called_once()
+    assert api.record.call_args.args[0] == "quay.io"
+    # The hedged request has a session of its own
+    Session.reset_mock()
+    hedged.call_args.args[2]()
+    assert Session.call_count == 1
+    Session.return_value.get.assert_called_once()
+
+
+@patch.object(container.latency, "api", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
+def test_quay_timeout_recorded(Session, api):
+    """
+    Test that requests which time out are recorded at the timeout.
+    """
+    api.timeout.return_value = 7.5
+    api.hedge_delay.return_value = None
+    Session.return_value.get.side_effect = container.Timeout("timed out")
+    with pytest.raises(container.Timeout):
+        container.inspect_quay_repo("quay.io/repos/testrepo")
+    api.record.assert_called_once_with("quay.io", 7.5)
+
+
+@patch.object(container.latency, "skopeo", autospec=True)
+@patch.object(container.subprocess, "run")
+def test_skopeo_adaptive_timeout(run, skopeo):
+    """
+    Test that skopeo uses the adaptive timeout, rounded up to whole seconds.
+    """
+    skopeo.timeout.return_value = 12.2
+    container.skopeo_run("example.com/repos/testrepo", "foo")
+    assert run.call_args.args[0][1:3] == ["--command-timeout", "13s"]
+    skopeo.record.assert_called_once()
+
+
+@patch.object(container.subprocess, "run")
+def test_skopeo_run_timeout(run):
+    """
+    Test that skopeo is killed if it outlives its own timeout, and the result
+    reports that it timed out.
+    """
+    run.side_effect = container.subprocess.TimeoutExpired("skopeo", 70.0)
+    proc = container.skopeo_run("example.com/repos/testrepo", "foo")
+    assert run.call_args.kwargs["timeout"] == 70.0
+    assert proc.returncode != 0
+    assert "timed out" in proc.stderr
+
+
+@patch.object(container.subprocess, "run")
+def test_skopeo_run_stopping(run):
+    """
+    Test that no skopeo command is started once repotracker is terminating.
+    """
+    container.runner.stopping.set()
+    try:
+        with pytest.raises(container.runner.Terminated):
+            container.skopeo_run("example.com/repos/testrepo", "foo")
+    finally:
+        container.runner.stopping.clear()
+    run.assert_not_called()
+
+
+@patch.object(container.latency, "skopeo", autospec=True)
+@patch.object(container.subprocess, "run")
+def test_skopeo_deadline(run, skopeo):
+    """
+    Test that the skopeo timeout is reduced to the time left before the
+    deadline, and that failures past the deadline raise DeadlineExceeded.
+    """
+    skopeo.timeout.return_value = 60.0
+    clock = Mock(return_value=0.0)
+    deadline = container.schedule.Deadline(7.5, clock=clock)
+    run.return_value.returncode = 0
+    container.skopeo_run("example.com/repos/testrepo", "foo", deadline=deadline)
+    assert run.call_args.args[0][1:3] == ["--command-timeout", "8s"]
+    clock.return_value = 7.5
+    run.return_value.returncode = 1
+    with pytest.raises(container.schedule.DeadlineExceeded):
+        container.skopeo_run("example.com/repos/testrepo", "foo", deadline=deadline)
+    run.reset_mock()
+    clock.return_value = 10.0
+    with pytest.raises(container.schedule.DeadlineExceeded):
+        container.skopeo_run("example.com/repos/testrepo", "foo", deadline=deadline)
+    run.assert_not_called()
+
+
+@patch.object(container.latency, "api", autospec=True)
+@patch.object(container.sessions, "Session", autospec=True)
+def test_quay_deadline(Session, api):
+    """
+    Test that Quay API timeouts are reduced so requests and their retries end
+    by the deadline, and that timeouts caused by it raise DeadlineExceeded.
+    """
+    api.timeout.return_value = 60.0
+    api.hedge_delay.return_value = None
+    deadline = container.schedule.Deadline(20, clock=Mock(return_value=0.0))
+    Session.return_value.get.side_effect = container.Timeout("timed out")
+    with pytest.raises(container.schedule.DeadlineExceeded):
+        list(container.iter_quay_repo("quay.io/repos/testrepo", deadline=deadline))
+    assert Session.return_value.get.call_args.kwargs["timeout"] == 5.0
+    api.record.assert_not_called()
+
+
+@patch.object(container, "list_tags", autospec=True, return_value=["latest"])
+@patch.object(container, "inspect_tag", autospec=True, return_value=INSPECT_DATA_1)
+@patch.object(container.time, "time")
+def test_check_repos_deadline(time, inspect_tag, list_tags):
+    """
+    Test that repos are checked least recently checked first, and repos which
+    are not reached before the deadline keep their previous data.
+    """
+    clock = Mock(return_value=0.0)
+    deadline = container.schedule.Deadline(10, clock=clock)
+
+    def finish():
+        # The deadline expires as soon as the first repo has been checked
+        clock.return_value = 10.0
+        return 1000.0
+
+    time.side_effect = finish
+    conf = {
+        "quayrepos": {"detect": "false"},
+        "test1": {"type": "container", "repo": "example.com/repos/test1"},
+        "test2": {"type": "container", "repo": "example.com/repos/test2"},
+        "test3": {"type": "container", "repo": "example.com/repos/test3"},
+    }
+    old_data = {
+        "example.com/repos/test1": {
+            "latest": {"action": "added", "digest": "abc123"},
+        }
+    }
+    checked = {"example.com/repos/test1": 100.0, "example.com/repos/test2": 50.0}
+    result = container.check_repos(conf, old_data, deadline=deadline, checked=checked)
+    # test3 has never been checked, so it comes first, then test2
+    list_tags.assert_called_once_with("example.com/repos/test3", ANY)
+    assert checked == {
+        "example.com/repos/test1": 100.0,
+        "example.com/repos/test2": 50.0,
+        "example.com/repos/test3": 1000.0,
+    }
+    assert result["example.com/repos/test1"] == {
+        "ignore": True,
+        "latest": {"action": "added", "digest": "abc123"},
+    }
+    assert "example.com/repos/test2" not in result
+    assert result["example.com/repos/test3"]["latest"]["action"] == "added"
+
+
+@patch.dict(CONF["test"], repo="quay.io/repos/testrepo")
+@patch.object(container.sessions, "Session", autospec=True)
+def test_check_repos_deadline_part_way(Session):
+    """
+    Test that a deadline expiring while a repo is being checked falls back to
+    the data from the previous run.
+    """
+    clock = Mock(return_value=0.0)
+    deadline = container.schedule.Deadline(10, clock=clock)
+    pages = iter(QUAY_API_DATA_MULTIPAGE)
+
+    def page():
+        clock.return_value += 5.0
+        return next(pages)
+
+    Session.return_value.get.return_value.json.side_effect = page
+    old_data = {
+        "quay.io/repos/testrepo": {
+            "tag3": {"action": "added", "digest": "abc123"},
+        }
+    }
+    result = container.check_repos(CONF, old_data, deadline=deadline)
+    assert Session.return_value.get.call_count == 2
+    assert result == {
+        "quay.io/repos/testrepo": {
+            "ignore": True,
+            "tag3": {"action": "added", "digest": "abc123"},
+        }
+    }
+
+
+QUAY_API_NAMESPACE_PAGES = [
+    {
+        "repositories": [
+            {"namespace": "factory2", "name": "repo1"},
+            {"namespace": "factory2", "name": "repo2"},
+        ],
+        "next_page": "abc",
+    },
+    {
+        "repositories": [{"namespace": "factory2", "name": "repo3"}],
+    },
+]
+
+
+@patch.object(container.sessions, "Session", autospec=True)
+def test_iter_quay_namespace(Session):
+    """
+    Test that the repos of a namespace are listed page by page.
+    """
+    Session.return_value.get.return_value.json.side_effect = QUAY_API_NAMESPACE_PAGES
+    repos = list(container.iter_quay_namespace("quay.io/factory2", "TOKEN"))
+    assert repos == [
+        "quay.io/factory2/repo1",
+        "quay.io/factory2/repo2",
+        "quay.io/factory2/repo3",
+    ]
+    assert Session.return_value.get.call_args_list == [
+        call(
+            "https://quay.io/api/v1/repository?namespace=factory2",
+            headers={"Authorization": "Bearer TOKEN"},
+            timeout=60.0,
+        ),
+        call(
+            "https://quay.io/api/v1/repository?namespace=factory2&next_page=abc",
+            headers={"Authorization": "Bearer TOKEN"},
+            timeout=60.0,
+        ),
+    ]
+
+
+@patch.object(container, "iter_quay_namespace", autospec=True)
+def test_discover_namespace_cache(iter_quay_namespace):
+    """
+    Test that discovered repos are cached, and that the cache or the previous
+    data is used when the repos cannot be listed.
+    """
+    iter_quay_namespace.return_value = iter(["quay.io/ns/b", "quay.io/ns/a"])
+    section = {"type": "namespace", "namespace": "quay.io/ns"}
+    namespaces = {}
+    assert container.discover_namespace(section, {}, namespaces) == [
+        "quay.io/ns/a",
+        "quay.io/ns/b",
+    ]
+    assert container.discover_namespace(section, {}, namespaces) == [
+        "quay.io/ns/a",
+        "quay.io/ns/b",
+    ]
+    iter_quay_namespace.assert_called_once_with("quay.io/ns", None)
+    namespaces["quay.io/ns"]["checked"] -= 3601
+    iter_quay_namespace.side_effect = RuntimeError("unavailable")
+    assert container.discover_namespace(section, {}, namespaces) == [
+        "quay.io/ns/a",
+        "quay.io/ns/b",
+    ]
+    data = {"quay.io/ns/c": {}, "quay.io/other/d": {}}
+    assert container.discover_namespace(section, data, {}) == ["quay.io/ns/c"]
+
+
+@patch.object(
+    container,
+    "discover_namespace",
+    autospec=True,
+    return_value=["example.com/ns/repo1", "example.com/ns/repo2"],
+)
+@patch.object(container, "list_tags", autospec=True, return_value=["latest"])
+@patch.object(container, "inspect_tag", autospec=True, return_value=INSPECT_DATA_1)
+def test_check_repos_namespace(inspect_tag, list_tags, discover_namespace):
+    """
+    Test that the repos of a namespace are checked with the options of the
+    namespace section, and their results are grouped by repo.
+    """
+    conf = {
+        "quayrepos": {"detect": "false"},
+        "ns": {
+            "type": "namespace",
+            "namespace": "example.com/ns",
+            "exclude_tags": "*-ci",
+            "concurrency": "2",
+        },
+    }
+    items = list(container.iter_repos(conf, {}))
+    assert [(repo, tag) for repo, tag, result in items] == [
+        ("example.com/ns/repo1", "latest"),
+        ("example.com/ns/repo2", "latest"),
+    ]
+    assert sorted(call.args[:2] for call in inspect_tag.call_args_list) == [
+        ("example.com/ns/repo1", "latest"),
+        ("example.com/ns/repo2", "latest"),
+    ]
+
+
+@patch.object(
+    container,
+    "discover_namespace",
+    autospec=True,
+    return_value=[f"quay.io/ns/repo{i}" for i in range(8)],
+)
+@patch.object(container.sessions, "get_session", autospec=True)
+@patch.object(container, "iter_quay_repo", autospec=True, return_value=iter([]))
+def test_check_repos_namespace_sessions(
+    iter_quay_repo, get_session, discover_namespace
+):
+    """
+    Test that the threads checking the repos of a namespace do not share the
+    Session given to iter_repos(), and their sessions are closed at the end.
+    """
+    get_session.side_effect = lambda: Mock()
+    conf = {
+        "test": {"type": "container", "repo": "quay.io/repos/testrepo"},
+        "ns": {"type": "namespace", "namespace": "quay.io/ns", "concurrency": "2"},
+    }
+    session = Mock()
+    list(container.iter_repos(conf, {}, session=session))
+    used = [call.args[3] for call in iter_quay_repo.call_args_list]
+    assert used[0] is session
+    thread_sessions = set(used[1:])
+    assert session not in thread_sessions
+    assert 1 <= len(thread_sessions) <= 2
+    for thread_session in thread_sessions:
+        thread_session.close.assert_called_once_with()
+    session.close.assert_not_called()
+
+
+@patch.object(
+    container,
+    "discover_namespace",
+    autospec=True,
+    return_value=["example.com/ns/repo1", "example.com/repos/testrepo"],
+)
+def test_discover_namespaces_tracked(discover_namespace):
+    """
+    Test that repos with a container section of their own, or in more than one
+    namespace, are only checked once.
+    """
+    conf = dict(
+        CONF,
+        ns1={"type": "namespace", "namespace": "example.com/ns"},
+        ns2={"type": "namespace", "namespace": "example.com/other"},
+    )
+    found = container.discover_namespaces(conf, {})
+    assert [
+        [section_name for section_name, section in repo_sections]
+        for section, repo_sections in found
+    ] == [["ns1:example.com/ns/repo1"], []]
+
+
+def test_iter_concurrent_bounded():
+    """
+    Test that the values generated for each item are yielded in order, and
+    that the calls are only allowed to get a few values ahead of the consumer.
+    """
+    generated = []
+    closed = []
+
+    def generate(item):
+        try:
+            for i in range(10):
+                generated.append((item, i))
+                yield item, i
+        finally:
+            closed.append(item)
+
+    results = container._iter_concurrent(generate, ["a", "b", "c"], 1, buffer=2)
+    assert next(results) == ("a", 0)
+    time.sleep(0.2)
+    # Each queue holds 2 values, and the call waiting to put the next one has
+    # generated it already
+    assert len(generated) <= 4
+    results.close()
+    # The call for "b" was waiting for a thread, and is never made
+    assert closed == ["a"]
+    assert list(container._iter_concurrent(generate, ["a", "b", "c"], 2, buffer=2)) == [
+        (item, i) for item in "abc" for i in range(10)
+    ]
+
+
+def test_iter_concurrent_error():
+    """
+    Test that an error raised by a call is raised to the consumer once the
+    values generated before it have been yielded.
+    """
+
+    def generate(item):
+        yield item
+        raise ValueError(item)
+
+    results = container._iter_concurrent(generate, ["a", "b"], 2)
+    assert next(results) == "a"
+    with pytest.raises(ValueError):
+        next(results)
+
+
+@patch.object(container, "list_tags", autospec=True)
+def test_check_repos_repo_locked(list_tags):
+    """
+    Test that repos locked by another run are skipped, and keep their data
+    from the previous run.
+    """
+    repo_locks = Mock()
+    repo_locks.acquire.return_value = False
+    old_data = {
+        "example.com/repos/testrepo": {
+            "latest": {"action": "added", "digest": "abc123"},
+        }
+    }
+    result = container.check_repos(CONF, old_data, repo_locks=repo_locks)
+    list_tags.assert_not_called()
+    repo_locks.acquire.assert_called_once_with("example.com/repos/testrepo")
+    repo_locks.release.assert_not_called()
+    assert result == {
+        "example.com/repos/testrepo": {
+            "ignore": True,
+            "latest": {"action": "added", "digest": "abc123"},
+        }
+    }
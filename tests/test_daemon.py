@@ -0,0 +1,151 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import daemon, digestindex, utils
+from unittest.mock import Mock, patch
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+
+CONF = {
+    "broker": {"topic_prefix": "container"},
+    "test1": {"type": "container", "repo": "quay.io/repos/test1"},
+    "test2": {"type": "container", "repo": "quay.io/repos/test2"},
+}
+
+
+def test_get_repo():
+    assert daemon.get_repo({"docker_url": "quay.io/repos/test1"}) == (
+        "quay.io/repos/test1"
+    )
+    assert daemon.get_repo({"repository": "repos/test1"}) is None
+    assert daemon.get_repo(["quay.io/repos/test1"]) is None
+
+
+def test_notify(tmpdir):
+    runner = daemon.Daemon(CONF, str(tmpdir.join("data")), {}, {})
+    assert runner.notify("quay.io/repos/test1")
+    assert not runner.notify("quay.io/repos/other")
+    assert runner.pending.get_nowait() == "quay.io/repos/test1"
+    assert runner.pending.empty()
+
+
+@patch.object(daemon.messaging, "send_container_updates", autospec=True)
+@patch.object(daemon.container, "check_repos", autospec=True)
+def test_check_repos(check_repos, send_container_updates, tmpdir):
+    """
+    Test that a targeted check only checks the given repos, and merges them
+    into the state.
+    """
+    path = str(tmpdir.join("data"))
+    data = {
+        "quay.io/repos/test1": {"latest": {"digest": "1"}},
+        "quay.io/repos/test2": {"latest": {"digest": "2"}},
+    }
+    check_repos.return_value = {"quay.io/repos/test2": {"latest": {"digest": "3"}}}
+    runner = daemon.Daemon(CONF, path, data, {"checked": None})
+    on_update = Mock()
+    runner.on_update.append(on_update)
+    runner.check(["quay.io/repos/test2"])
+    conf = check_repos.call_args.args[0]
+    assert [name for name, section in conf.container_sections] == ["test2"]
+    assert check_repos.call_args.args[1] is data
+    assert check_repos.call_args.kwargs["checked"] is None
+    send_container_updates.assert_called_once_with(CONF, check_repos.return_value, data)
+    expected = {
+        "quay.io/repos/test1": {"latest": {"digest": "1"}},
+        "quay.io/repos/test2": {"latest": {"digest": "3"}},
+    }
+    assert runner.data == expected
+    assert utils.load_data(path) == expected
+    on_update.assert_called_once_with(expected)
+
+
+@patch.object(daemon.messaging, "send_container_updates", autospec=True)
+@patch.object(daemon.container, "check_repos", autospec=True)
+def test_check_repos_digests(check_repos, send_container_updates, tmpdir):
+    """
+    Test that the digest index is rebuilt by the first check if it does not
+    match the state, and only updated with the repos checked by a targeted
+    check after that.
+    """
+    path = str(tmpdir.join("data"))
+    data = {
+        "quay.io/repos/test1": {"latest": {"action": "added", "digest": "1"}},
+        "quay.io/repos/test2": {"latest": {"action": "added", "digest": "2"}},
+    }
+    digests = digestindex.DigestIndex(path)
+    check_repos.return_value = data
+    runner = daemon.Daemon(CONF, path, {}, {}, digests=digests)
+    runner.check()
+    assert digests.lookup("2") == [("quay.io/repos/test2", "latest")]
+    check_repos.return_value = {
+        "quay.io/repos/test2": {"latest": {"action": "updated", "digest": "3"}}
+    }
+    with patch.object(digests, "update", wraps=digests.update) as update:
+        runner.check(["quay.io/repos/test2"])
+    update.assert_called_once_with(
+        check_repos.return_value,
+        {"quay.io/repos/test2": data["quay.io/repos/test2"]},
+    )
+    assert digests.lookup("1") == [("quay.io/repos/test1", "latest")]
+    assert digests.lookup("2") == []
+    assert digests.lookup("3") == [("quay.io/repos/test2", "latest")]
+    digests.close()
+
+
+@patch.object(daemon.messaging, "send_container_updates", autospec=True)
+@patch.object(daemon.container, "check_repos", autospec=True)
+def test_check_error(check_repos, send_container_updates, tmpdir):
+    """
+    Test that the state is unchanged if messages could not be sent.
+    """
+    path = tmpdir.join("data")
+    check_repos.return_value = {"quay.io/repos/test1": {}}
+    send_container_updates.side_effect = RuntimeError("broker unavailable")
+    repo_locks = Mock()
+    runner = daemon.Daemon(CONF, str(path), {}, {"repo_locks": repo_locks})
+    runner.check()
+    assert runner.data == {}
+    assert not path.check()
+    # The repos locked by the check are released
+    repo_locks.release_all.assert_called_once_with()
+
+
+@patch.object(daemon.Daemon, "check", autospec=True)
+def test_run_webhook(check, tmpdir):
+    """
+    Test that all repos are checked on start, and repos are checked when a
+    webhook is received for them.
+    """
+    runner = daemon.Daemon(CONF, str(tmpdir.join("data")), {}, {}, 3600)
+    checked = threading.Event()
+
+    def check_repos(self, repos=None):
+        if repos is not None:
+            checked.set()
+
+    check.side_effect = check_repos
+    server = daemon.serve(runner, ("127.0.0.1", 0))
+    thread = threading.Thread(target=runner.run)
+    thread.start()
+    try:
+        url = "http://127.0.0.1:{0}/".format(server.server_address[1])
+        payload = json.dumps({"docker_url": "quay.io/repos/test1"}).encode()
+        with urllib.request.urlopen(url, payload) as resp:
+            assert resp.status == 202
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            urllib.request.urlopen(url, b'{"docker_url": "quay.io/repos/other"}')
+        assert excinfo.value.code == 404
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            urllib.request.urlopen(url, b"not json")
+        assert excinfo.value.code == 400
+        assert checked.wait(5)
+    finally:
+        runner.stop()
+        thread.join(5)
+        server.shutdown()
+    assert check.call_args_list[0].args == (runner,)
+    assert check.call_args_list[1].args == (runner, ["quay.io/repos/test1"])
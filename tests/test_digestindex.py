@@ -0,0 +1,158 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import digestindex, utils
+
+DATA = {
+    "quay.io/repos/test1": {
+        "latest": {"action": "added", "digest": "sha256:1"},
+        "v1": {"action": "added", "digest": "sha256:1"},
+    },
+    "quay.io/repos/test2": {
+        "latest": {"action": "added", "digest": "sha256:2"},
+    },
+}
+
+
+def save(index, path, data, previous):
+    index.update(data, previous)
+    utils.save_data(path, data)
+    index.commit()
+
+
+def test_lookup(tmpdir):
+    """
+    Test that the tags of a digest are looked up once the index is committed.
+    """
+    path = str(tmpdir.join("data"))
+    index = digestindex.DigestIndex(path)
+    assert index.lookup("sha256:1") == []
+    save(index, path, DATA, {})
+    assert index.is_current()
+    assert index.lookup("sha256:1") == [
+        ("quay.io/repos/test1", "latest"),
+        ("quay.io/repos/test1", "v1"),
+    ]
+    index.close()
+    index = digestindex.DigestIndex(path)
+    assert index.lookup("sha256:2") == [("quay.io/repos/test2", "latest")]
+    index.close()
+
+
+def test_record_changes(tmpdir):
+    """
+    Test that added, updated and removed tags, and repos which are no longer
+    tracked, are recorded incrementally.
+    """
+    path = str(tmpdir.join("data"))
+    index = digestindex.DigestIndex(path)
+    save(index, path, DATA, {})
+    new_data = {
+        "quay.io/repos/test1": {
+            "latest": {
+                "action": "updated",
+                "digest": "sha256:3",
+                "old_digest": "sha256:1",
+            },
+            "v1": {"action": "removed", "digest": None, "old_digest": "sha256:1"},
+            "v2": {"action": "added", "digest": "sha256:3"},
+        },
+    }
+    items = list(digestindex.iter_items(new_data))
+    assert list(index.record(iter(items), DATA)) == items
+    utils.save_data(path, new_data)
+    index.commit()
+    assert index.lookup("sha256:1") == []
+    assert index.lookup("sha256:2") == []
+    assert index.lookup("sha256:3") == [
+        ("quay.io/repos/test1", "latest"),
+        ("quay.io/repos/test1", "v2"),
+    ]
+
+
+def test_record_ignored(tmpdir):
+    """
+    Test that the tags of repos which could not be checked are kept.
+    """
+    path = str(tmpdir.join("data"))
+    index = digestindex.DigestIndex(path)
+    save(index, path, DATA, {})
+    new_data = dict(
+        DATA, **{"quay.io/repos/test2": {"ignore": True, **DATA["quay.io/repos/test2"]}}
+    )
+    save(index, path, new_data, DATA)
+    assert index.lookup("sha256:2") == [("quay.io/repos/test2", "latest")]
+
+
+def test_rebuild(tmpdir):
+    """
+    Test that the index is rebuilt when the state file was saved without it.
+    """
+    path = str(tmpdir.join("data"))
+    index = digestindex.DigestIndex(path)
+    save(index, path, DATA, {})
+    # Saved by a run which failed before committing the index
+    data = {
+        "quay.io/repos/test1": {"latest": {"action": "added", "digest": "sha256:4"}}
+    }
+    utils.save_data(path, data)
+    assert not index.is_current()
+    unchanged = {
+        "quay.io/repos/test1": {"latest": {"action": "unchanged", "digest": "sha256:4"}}
+    }
+    save(index, path, unchanged, data)
+    assert index.lookup("sha256:1") == []
+    assert index.lookup("sha256:2") == []
+    assert index.lookup("sha256:4") == [("quay.io/repos/test1", "latest")]
+
+
+def test_rollback(tmpdir):
+    """
+    Test that changes which are not committed are discarded.
+    """
+    path = str(tmpdir.join("data"))
+    index = digestindex.DigestIndex(path)
+    save(index, path, DATA, {})
+    index.update({}, DATA)
+    index.rollback()
+    assert index.lookup("sha256:2") == [("quay.io/repos/test2", "latest")]
+
+
+def test_record_stale_tags(tmpdir):
+    """
+    Test that tags which are no longer in the state of their repo, without
+    having been removed, are dropped.
+    """
+    path = str(tmpdir.join("data"))
+    index = digestindex.DigestIndex(path)
+    save(index, path, DATA, {})
+    # v1 is now excluded by a tag filter
+    new_data = {
+        "quay.io/repos/test1": {
+            "latest": {"action": "unchanged", "digest": "sha256:1"}
+        },
+        "quay.io/repos/test2": DATA["quay.io/repos/test2"],
+    }
+    save(index, path, new_data, DATA)
+    assert index.lookup("sha256:1") == [("quay.io/repos/test1", "latest")]
+    assert index.lookup("sha256:2") == [("quay.io/repos/test2", "latest")]
+
+
+def test_update_repos(tmpdir):
+    """
+    Test that only the repos which were checked are updated.
+    """
+    path = str(tmpdir.join("data"))
+    index = digestindex.DigestIndex(path)
+    save(index, path, DATA, {})
+    new_data = {
+        "quay.io/repos/test2": {
+            "latest": {"action": "updated", "digest": "sha256:3"},
+        }
+    }
+    index.update_repos(new_data, DATA)
+    utils.save_data(path, dict(DATA, **new_data))
+    index.commit()
+    assert len(index.lookup("sha256:1")) == 2
+    assert index.lookup("sha256:2") == []
+    assert index.lookup("sha256:3") == [("quay.io/repos/test2", "latest")]
@@ -0,0 +1,106 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import discovery
+from unittest.mock import patch
+import requests
+
+DISCOVERY_DATA = {
+    "swagger": "2.0",
+    "paths": {
+        "/api/v1/repository/{repository}/tag/": {},
+    },
+}
+
+
+@patch.object(discovery, "Session", autospec=True)
+def test_probe_quay(Session):
+    """
+    Test that a host serving the Quay discovery document is detected.
+    """
+    resp = Session.return_value.__enter__.return_value.get.return_value
+    resp.status_code = 200
+    resp.headers = {}
+    resp.json.return_value = DISCOVERY_DATA
+    assert discovery.probe("registry.example.com") is True
+    Session.return_value.__enter__.return_value.get.assert_called_once_with(
+        "https://registry.example.com/api/v1/discovery", timeout=10.0
+    )
+
+
+@patch.object(discovery, "Session", autospec=True)
+def test_probe_not_quay(Session):
+    """
+    Test that hosts without the discovery document are not Quay registries,
+    and hosts which could not be reached are unknown.
+    """
+    resp = Session.return_value.__enter__.return_value.get.return_value
+    resp.headers = {}
+    resp.status_code = 404
+    assert discovery.probe("registry.example.com") is False
+    resp.status_code = 200
+    resp.json.side_effect = ValueError("not JSON")
+    assert discovery.probe("registry.example.com") is False
+    discovery.metrics.registry.clear()
+    resp.status_code = 503
+    assert discovery.probe("registry.example.com") is None
+    Session.return_value.__enter__.return_value.get.side_effect = (
+        requests.exceptions.ConnectionError()
+    )
+    assert discovery.probe("registry.example.com") is None
+    errors = discovery.metrics.registry.values["repotracker_errors_total"]
+    assert errors == {(("host", "registry.example.com"), ("operation", "probe")): 2}
+
+
+@patch.object(discovery, "probe", autospec=True, return_value=True)
+def test_detector_cache(probe):
+    """
+    Test that each host is probed once, and the result cached until it expires.
+    """
+    cache = {}
+    detector = discovery.QuayDetector(["quay.io"], cache=cache)
+    assert detector.is_quay("quay.io/some/repo")
+    probe.assert_not_called()
+    assert detector.is_quay("registry.example.com/some/repo")
+    assert detector.is_quay("registry.example.com/other/repo")
+    probe.assert_called_once_with("registry.example.com")
+    assert cache["registry.example.com"]["quay"] is True
+    cache["registry.example.com"]["checked"] -= detector.ttl + 1
+    probe.return_value = False
+    assert not detector.is_quay("registry.example.com/some/repo")
+    assert probe.call_count == 2
+
+
+@patch.object(discovery, "probe", autospec=True, return_value=None)
+def test_detector_unreachable(probe):
+    """
+    Test that unreachable hosts are only probed once in a run, and are not
+    cached for the next run.
+    """
+    detector = discovery.QuayDetector()
+    assert not detector.is_quay("registry.example.com/some/repo")
+    assert not detector.is_quay("registry.example.com/other/repo")
+    probe.assert_called_once_with("registry.example.com")
+    assert detector.cache == {}
+    detector = discovery.QuayDetector()
+    assert not detector.is_quay("registry.example.com/some/repo")
+    assert probe.call_count == 2
+
+
+@patch.object(discovery, "probe", autospec=True)
+def test_get_detector(probe):
+    """
+    Test that the detector is configured from the quayrepos section.
+    """
+    detector = discovery.get_detector(
+        {"quayrepos": {"repos": "quay.io,quay.example.com", "detect": "false"}}
+    )
+    assert detector.is_quay("quay.example.com/some/repo")
+    assert not detector.is_quay("registry.example.com/some/repo")
+    probe.assert_not_called()
+    detector = discovery.get_detector(
+        {}, {"registry.example.com": {"quay": True, "checked": 0}}
+    )
+    assert detector.quay_repos.prefixes == {"quay.io"}
+    assert detector.detect
+    assert detector.cache["registry.example.com"]["quay"]
@@ -0,0 +1,203 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import latency, tracing
+from unittest.mock import Mock, patch
+import threading
+import time
+import pytest
+
+
+def test_histogram_quantile():
+    """
+    Test that quantiles are reported as the upper bound of their bucket.
+    """
+    histogram = latency.LatencyHistogram()
+    assert histogram.quantile(0.5) is None
+    for i in range(95):
+        histogram.record(0.1)
+    for i in range(5):
+        histogram.record(10.0)
+    assert 0.1 <= histogram.quantile(0.5) < 0.125
+    assert 0.1 <= histogram.quantile(0.95) < 0.125
+    assert 10.0 <= histogram.quantile(0.99) < 12.5
+    histogram.record(1000.0)
+    assert histogram.quantile(1.0) == float("inf")
+
+
+def test_histogram_decay():
+    """
+    Test that older samples lose their weight once max_samples is reached.
+    """
+    histogram = latency.LatencyHistogram(max_samples=10)
+    for i in range(10):
+        histogram.record(10.0)
+    for i in range(10):
+        histogram.record(0.1)
+    assert histogram.total <= 10
+    assert histogram.quantile(0.5) < 0.125
+
+
+def test_tracker_timeout():
+    """
+    Test that timeouts are derived from the p99 latency once enough samples exist.
+    """
+    tracker = latency.LatencyTracker(
+        default_timeout=60.0, min_timeout=5.0, multiplier=3.0, min_samples=10
+    )
+    for i in range(10):
+        tracker.record("quay.io", 4.0)
+    # Adaptive timeouts are disabled by default
+    assert tracker.timeout("quay.io") == 60.0
+    tracker.adaptive = True
+    assert 12.0 <= tracker.timeout("quay.io") < 15.0
+    assert tracker.timeout("example.com") == 60.0
+    for i in range(10):
+        tracker.record("fast.example.com", 0.01)
+    assert tracker.timeout("fast.example.com") == 5.0
+    for i in range(10):
+        tracker.record("slow.example.com", 50.0)
+    assert tracker.timeout("slow.example.com") == 60.0
+
+
+def test_tracker_hedge_delay():
+    """
+    Test that the hedging delay is the p95 latency, when hedging is enabled.
+    """
+    tracker = latency.LatencyTracker(min_samples=10)
+    for i in range(20):
+        tracker.record("quay.io", 1.0)
+    assert tracker.hedge_delay("quay.io") is None
+    tracker.hedge = True
+    assert 1.0 <= tracker.hedge_delay("quay.io") < 1.25
+    assert tracker.hedge_delay("example.com") is None
+
+
+def test_hedged_fast():
+    """
+    Test that a call which completes before the delay is not duplicated.
+    """
+    func = Mock(return_value="result")
+    assert latency.hedged(func, 10) == "result"
+    func.assert_called_once_with()
+
+
+def test_hedged_slow():
+    """
+    Test that a slow call is duplicated, and the first response is used.
+    """
+    release = threading.Event()
+    results = iter(["slow", "fast"])
+
+    def func():
+        result = next(results)
+        if result == "slow":
+            release.wait(10)
+        return result
+
+    try:
+        assert latency.hedged(func, 0.01) == "fast"
+    finally:
+        release.set()
+
+
+def test_hedged_errors():
+    """
+    Test that an error is only raised if every call fails.
+    """
+    release = threading.Event()
+    calls = iter([RuntimeError("first"), "second"])
+
+    def func():
+        result = next(calls)
+        release.wait(10)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    threading.Timer(0.05, release.set).start()
+    assert latency.hedged(func, 0.01) == "second"
+
+    def fail():
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError, match="failed"):
+        latency.hedged(fail, 10)
+
+
+def test_hedged_hedge():
+    """
+    Test that the duplicate call is made with hedge, when given.
+    """
+    release = threading.Event()
+
+    def slow():
+        release.wait(10)
+        return "slow"
+
+    try:
+        assert latency.hedged(slow, 0.01, lambda: "hedge") == "hedge"
+    finally:
+        release.set()
+
+
+def test_hedged_spans():
+    """
+    Test that the spans started by both calls are children of the span of the
+    caller.
+    """
+    tracer = tracing.Tracer()
+    tracer.start()
+    release = threading.Event()
+    results = iter(["slow", "fast"])
+
+    def func():
+        with tracer.span("fetch_page"):
+            result = next(results)
+            if result == "slow":
+                release.wait(10)
+        return result
+
+    with tracer.span("check_repo"):
+        assert latency.hedged(func, 0.01) == "fast"
+    release.set()
+    for _ in range(100):
+        if len(tracer.spans) == 3:
+            break
+        time.sleep(0.01)
+    parents = sorted(
+        (span["name"], parent["name"])
+        for span in tracer.spans
+        for parent in tracer.spans
+        if span["parent"] == parent["id"]
+    )
+    assert parents == [("fetch_page", "check_repo"), ("fetch_page", "check_repo")]
+
+
+@patch.object(latency, "skopeo", new_callable=latency.LatencyTracker)
+@patch.object(latency, "api", new_callable=latency.LatencyTracker)
+def test_configure(api, skopeo):
+    """
+    Test that the shared trackers are configured from the polling section.
+    """
+    latency.configure(
+        {
+            "polling": {
+                "timeout": "30",
+                "min_timeout": "2",
+                "timeout_multiplier": "4",
+                "adaptive_timeouts": "yes",
+                "hedge_requests": "true",
+            }
+        }
+    )
+    for tracker in (api, skopeo):
+        assert tracker.default_timeout == 30.0
+        assert tracker.min_timeout == 2.0
+        assert tracker.multiplier == 4.0
+        assert tracker.adaptive is True
+    assert api.hedge is True
+    assert skopeo.hedge is False
+    latency.configure({})
+    assert api.adaptive is False
+    assert api.hedge is False
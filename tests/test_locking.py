@@ -0,0 +1,116 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import locking, utils
+import os
+import pytest
+
+
+def test_run_lock(tmpdir):
+    """
+    Test that only one run at a time can hold the lock on the state file.
+    """
+    path = str(tmpdir.join("data"))
+    with locking.run_lock(path):
+        with pytest.raises(locking.LockHeld):
+            with locking.run_lock(path):
+                pass
+    with locking.run_lock(path):
+        pass
+
+
+def test_run_lock_shared(tmpdir):
+    """
+    Test that runs locking individual repos may overlap each other, but not a
+    run checking all repos, and can still save the state.
+    """
+    path = str(tmpdir.join("data"))
+    with locking.run_lock(path, shared=True):
+        with locking.run_lock(path, shared=True):
+            with pytest.raises(locking.LockHeld):
+                with locking.run_lock(path):
+                    pass
+            locking.merge_on_save(path, {"quay.io/ns/a": {}})
+    with locking.run_lock(path):
+        with pytest.raises(locking.LockHeld):
+            with locking.run_lock(path, shared=True):
+                pass
+
+
+def test_repo_locks(tmpdir):
+    """
+    Test that a repo can only be locked by one run at a time, and other repos
+    are not affected.
+    """
+    path = str(tmpdir.join("data"))
+    first = locking.RepoLocks(path, {})
+    second = locking.RepoLocks(path, {})
+    assert first.acquire("quay.io/ns/a")
+    assert not second.acquire("quay.io/ns/a")
+    assert second.acquire("quay.io/ns/b")
+    first.release("quay.io/ns/a")
+    assert second.acquire("quay.io/ns/a")
+    second.release("quay.io/ns/a")
+    second.release("quay.io/ns/b")
+
+
+def test_repo_locks_release_all(tmpdir):
+    """
+    Test that all the locks held by a run are released together.
+    """
+    path = str(tmpdir.join("data"))
+    first = locking.RepoLocks(path, {})
+    second = locking.RepoLocks(path, {})
+    assert first.acquire("quay.io/ns/a")
+    assert first.acquire("quay.io/ns/a")
+    assert first.acquire("quay.io/ns/b")
+    first.release_all()
+    assert first.held == {}
+    assert second.acquire("quay.io/ns/a")
+    assert second.acquire("quay.io/ns/b")
+    second.release_all()
+
+
+def test_repo_locks_refresh(tmpdir):
+    """
+    Test that the data is reloaded when another run has saved the state file.
+    """
+    path = str(tmpdir.join("data"))
+    utils.save_data(path, {"quay.io/ns/a": {"latest": {"digest": "1"}}})
+    data = utils.load_data(path)
+    repo_locks = locking.RepoLocks(path, data)
+    utils.save_data(path, {"quay.io/ns/a": {"latest": {"digest": "2"}}})
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    assert repo_locks.acquire("quay.io/ns/a")
+    assert data == {"quay.io/ns/a": {"latest": {"digest": "2"}}}
+    repo_locks.release("quay.io/ns/a")
+
+
+def test_merge_on_save(tmpdir):
+    """
+    Test that repos saved by other runs are kept, unless this run checked them.
+    """
+    path = str(tmpdir.join("data"))
+    utils.save_data(
+        path,
+        {
+            "quay.io/ns/a": {"latest": {"digest": "1"}},
+            "quay.io/ns/b": {"latest": {"digest": "2"}},
+            "quay.io/ns/c": {"latest": {"digest": "3"}},
+        },
+    )
+    locking.merge_on_save(
+        path,
+        {
+            "quay.io/ns/b": {"ignore": True, "latest": {"digest": "old"}},
+            "quay.io/ns/c": {"latest": {"digest": "4"}},
+            "quay.io/ns/d": {"ignore": True, "latest": {"digest": "5"}},
+        },
+    )
+    assert utils.load_data(path) == {
+        "quay.io/ns/a": {"latest": {"digest": "1"}},
+        "quay.io/ns/b": {"latest": {"digest": "2"}},
+        "quay.io/ns/c": {"latest": {"digest": "4"}},
+        "quay.io/ns/d": {"ignore": True, "latest": {"digest": "5"}},
+    }
@@ -2,12 +2,13 @@
 # Copyright 2018 Mike Bonnet <mikeb@redhat.com>
 
 import json
+import pytest
 from unittest.mock import MagicMock, patch, call
 
 producer_mock = MagicMock()
 patch.dict("sys.modules", values={"rhmsg.activemq.producer": producer_mock}).start()
 
-from repotracker import messaging  # noqa: E402
+from repotracker import container, messaging  # noqa: E402
 
 DATA = {
     "example.com/repos/testrepo": {
@@ -44,7 +45,7 @@ def test_gen_msg():
     """
     data = DATA["example.com/repos/testrepo"]["latest"].copy()
     result = messaging.gen_msg(data)
-    expected_body = json.dumps(data)
+    expected_body = json.dumps(data, separators=(",", ":")).encode("utf-8")
     del data["labels"]
     assert result == (data, expected_body)
 
@@ -172,3 +173,180 @@ def test_send_container_updates_all(prod):
         call([messaging.gen_msg(removed_msg), messaging.gen_msg(removed_msg)]),
     ]
     send_msgs.assert_has_calls(calls)
+
+
+@patch.object(messaging, "AMQProducer")
+def test_send_container_updates_iter(prod):
+    """
+    Test that streamed updates are passed through and sent in batches.
+    """
+    added = DATA["example.com/repos/testrepo"]["latest"]
+    unchanged = dict(added, action="unchanged")
+    removed = dict(added, action="removed")
+    items = [
+        ("repo1", "tag1", added),
+        ("repo1", "tag2", unchanged),
+        ("repo1", "tag3", added),
+        ("repo1", "tag4", removed),
+        ("repo2", "tag1", added),
+    ]
+    conf = {"broker": dict(CONF["broker"], batch_size="2")}
+    result = list(messaging.send_container_updates_iter(conf, iter(items)))
+    assert result == items
+    send_msgs = prod.return_value.__enter__.return_value.send_msgs
+    through_topic = prod.return_value.__enter__.return_value.through_topic
+    assert send_msgs.call_args_list == [
+        call([messaging.gen_msg(added), messaging.gen_msg(added)]),
+        call([messaging.gen_msg(added)]),
+        call([messaging.gen_msg(removed)]),
+    ]
+    assert through_topic.call_args_list == [
+        call("container.container.tag.added"),
+        call("container.container.tag.added"),
+        call("container.container.tag.removed"),
+    ]
+
+
+@patch.object(messaging, "AMQProducer")
+def test_send_container_updates_iter_ignore(prod):
+    """
+    Test that no messages are sent for the remaining tags of an ignored repo.
+    """
+    added = DATA["example.com/repos/testrepo"]["latest"]
+    items = [
+        ("repo1", "ignore", True),
+        ("repo1", "tag1", added),
+        ("repo2", "tag1", added),
+    ]
+    result = list(messaging.send_container_updates_iter(CONF, iter(items)))
+    assert result == items
+    prod.return_value.__enter__.return_value.send_msgs.assert_called_once_with(
+        [messaging.gen_msg(added)]
+    )
+
+
+@patch.object(messaging, "gen_msg", wraps=messaging.gen_msg)
+@patch.object(messaging, "AMQProducer")
+def test_send_container_updates_skips_unchanged(prod, gen_msg):
+    """
+    Test that messages are only built for tags which have changed.
+    """
+    added = DATA["example.com/repos/testrepo"]["latest"]
+    unchanged = dict(added, action="unchanged")
+    data = {
+        "repo1": {"tag1": unchanged, "tag2": added, "tag3": unchanged},
+        "repo2": {"ignore": True, "tag1": added},
+    }
+    messaging.send_container_updates(CONF, data)
+    gen_msg.assert_called_once_with(added, None, False)
+
+
+def test_gen_msg_encodes_once():
+    """
+    Test that gen_msg() encodes the body once and leaves the tag data untouched.
+    """
+    data = DATA["example.com/repos/testrepo"]["latest"]
+    with patch.object(messaging.codec, "dumps", wraps=messaging.codec.dumps) as dumps:
+        headers, body = messaging.gen_msg(data)
+    dumps.assert_called_once_with(data)
+    assert "labels" not in headers
+    assert "labels" in data
+    assert json.loads(body) == data
+
+
+def test_gen_msg_delta_added():
+    """
+    Test that a delta body includes the labels of an added tag.
+    """
+    data = DATA["example.com/repos/testrepo"]["latest"]
+    headers, body = messaging.gen_msg(data, None, delta=True)
+    body = json.loads(body)
+    assert body["labels"] == {"foo": "bar"}
+    assert body["labels_hash"] == messaging.hash_labels({"foo": "bar"})
+    keys = list(body)
+    assert keys.index("labels_hash") == keys.index("labels") + 1
+
+
+def test_gen_msg_delta_unchanged_labels():
+    """
+    Test that a delta body omits the labels of an updated tag if they have not changed.
+    """
+    previous = DATA["example.com/repos/testrepo"]["latest"]
+    data = dict(previous, action="updated", digest="def456", old_digest="abc123")
+    headers, body = messaging.gen_msg(data, previous, delta=True)
+    body = json.loads(body)
+    assert "labels" not in body
+    assert body["labels_hash"] == messaging.hash_labels({"foo": "bar"})
+    assert headers == messaging.gen_msg(data)[0]
+
+
+def test_gen_msg_delta_changed_labels():
+    """
+    Test that a delta body includes the labels of an updated tag if they have changed.
+    """
+    previous = DATA["example.com/repos/testrepo"]["latest"]
+    data = dict(previous, action="updated", labels={"foo": "baz"})
+    headers, body = messaging.gen_msg(data, previous, delta=True)
+    assert json.loads(body)["labels"] == {"foo": "baz"}
+
+
+def test_hash_labels_order():
+    """
+    Test that the label hash does not depend on the order of the labels.
+    """
+    assert messaging.hash_labels({"a": "1", "b": "2"}) == messaging.hash_labels(
+        {"b": "2", "a": "1"}
+    )
+    assert messaging.hash_labels({"a": "1"}) != messaging.hash_labels({"a": "2"})
+
+
+@patch.object(messaging, "AMQProducer")
+def test_send_container_updates_delta_null_labels(prod):
+    """
+    Test that delta bodies are sent for images whose labels are null, as
+    reported by skopeo inspect for images without labels.
+    """
+    inspect_data = {
+        "Name": "example.com/repos/testrepo",
+        "Digest": "sha256:abc123",
+        "Created": "2018-01-01T00:00:00Z",
+        "Labels": None,
+    }
+    added = container.gen_result("example.com/repos/testrepo", "latest", inspect_data)
+    added["action"] = "added"
+    conf = {"broker": dict(CONF["broker"], body_format="delta")}
+    data = {"example.com/repos/testrepo": {"latest": added}}
+    messaging.send_container_updates(conf, data, {})
+    ((msgs,), kwargs) = prod.return_value.__enter__.return_value.send_msgs.call_args
+    body = json.loads(msgs[0][1])
+    assert body["labels"] is None
+    assert body["labels_hash"] == messaging.hash_labels({})
+
+
+@patch.object(messaging, "AMQProducer")
+def test_send_container_updates_delta(prod):
+    """
+    Test that delta bodies are sent when configured, using the previous data.
+    """
+    previous = DATA["example.com/repos/testrepo"]["latest"]
+    updated = dict(previous, action="updated", digest="def456", old_digest="abc123")
+    conf = {"broker": dict(CONF["broker"], body_format="delta")}
+    data = {"example.com/repos/testrepo": {"latest": updated}}
+    messaging.send_container_updates(conf, data, DATA)
+    prod.return_value.__enter__.return_value.send_msgs.assert_called_once_with(
+        [messaging.gen_msg(updated, previous, delta=True)]
+    )
+    items = [("example.com/repos/testrepo", "latest", updated)]
+    list(messaging.send_container_updates_iter(conf, iter(items), DATA))
+    prod.return_value.__enter__.return_value.send_msgs.assert_called_with(
+        [messaging.gen_msg(updated, previous, delta=True)]
+    )
+
+
+def test_send_container_updates_bad_format():
+    """
+    Test that an unknown body format is rejected.
+    """
+    conf = {"broker": dict(CONF["broker"], body_format="compact")}
+    with pytest.raises(ValueError, match="Unknown body_format: compact"):
+        messaging.send_container_updates(conf, DATA)
@@ -0,0 +1,108 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import metrics
+from unittest.mock import patch
+import urllib.error
+import urllib.request
+import pytest
+
+
+def test_render():
+    """
+    Test that counters and gauges are rendered in the Prometheus text format.
+    """
+    registry = metrics.Registry()
+    registry.inc("repotracker_tags_total", action="added")
+    registry.inc("repotracker_tags_total", 2, action="added")
+    registry.inc("repotracker_tags_total", action="removed")
+    registry.set("repotracker_state_seconds", 0.5, operation="load")
+    registry.inc("repotracker_errors_total", host='bad"host\\')
+    assert registry.render().decode("utf-8") == (
+        "# HELP repotracker_tags_total Tags found by the checks of the repos, by action\n"
+        "# TYPE repotracker_tags_total counter\n"
+        'repotracker_tags_total{action="added"} 3\n'
+        'repotracker_tags_total{action="removed"} 1\n'
+        "# HELP repotracker_state_seconds Seconds taken by the last load or save of "
+        "the state file\n"
+        "# TYPE repotracker_state_seconds gauge\n"
+        'repotracker_state_seconds{operation="load"} 0.5\n'
+        "# HELP repotracker_errors_total Failures to check a repo, inspect a tag or "
+        "probe the Quay API of the host\n"
+        "# TYPE repotracker_errors_total counter\n"
+        'repotracker_errors_total{host="bad\\"host\\\\"} 1\n'
+    )
+    registry.clear()
+    assert registry.render() == b"\n"
+
+
+@patch.object(metrics.time, "monotonic", side_effect=[1.0, 3.0, 5.0, 6.0, 7.0, 8.0])
+def test_timer(monotonic):
+    """
+    Test that timers add to counters and set gauges.
+    """
+    registry = metrics.Registry()
+    for i in range(2):
+        with registry.timer("repotracker_skopeo_seconds_total", host="example.com"):
+            pass
+    with pytest.raises(RuntimeError):
+        with registry.timer("repotracker_repo_check_seconds", repo="example.com/a"):
+            raise RuntimeError("failed")
+    assert registry.values == {
+        "repotracker_skopeo_seconds_total": {(("host", "example.com"),): 3.0},
+        "repotracker_repo_check_seconds": {(("repo", "example.com/a"),): 1.0},
+    }
+
+
+@patch.object(metrics.time, "monotonic", side_effect=[1.0, 2.0, 10.0, 12.0, 20.0, 21.0])
+def test_timed(monotonic):
+    """
+    Test that only the time spent running a generator is measured, and its
+    return value is returned.
+    """
+
+    def generate():
+        yield "a"
+        yield "b"
+        return True
+
+    def consume():
+        result = yield from registry.timed(
+            "repotracker_repo_check_seconds", generate(), repo="example.com/a"
+        )
+        assert result is True
+
+    registry = metrics.Registry()
+    assert list(consume()) == ["a", "b"]
+    assert registry.values == {
+        "repotracker_repo_check_seconds": {(("repo", "example.com/a"),): 4.0},
+    }
+
+
+def test_write_textfile(tmpdir):
+    path = str(tmpdir.join("repotracker.prom"))
+    with patch.object(metrics, "registry", metrics.Registry()) as registry:
+        registry.inc("repotracker_messages_total", 5, topic="container.tag.added")
+        metrics.write_textfile(path)
+    with open(path) as fobj:
+        assert 'repotracker_messages_total{topic="container.tag.added"} 5\n' in (
+            fobj.read()
+        )
+    assert tmpdir.listdir() == [tmpdir.join("repotracker.prom")]
+
+
+def test_serve():
+    with patch.object(metrics, "registry", metrics.Registry()) as registry:
+        registry.inc("repotracker_http_requests_total", host="quay.io")
+        server = metrics.serve(("127.0.0.1", 0))
+        try:
+            url = "http://127.0.0.1:{}".format(server.server_address[1])
+            with urllib.request.urlopen(url + "/metrics") as resp:
+                assert resp.headers["Content-Type"].startswith("text/plain")
+                body = resp.read().decode("utf-8")
+            assert 'repotracker_http_requests_total{host="quay.io"} 1\n' in body
+            with pytest.raises(urllib.error.HTTPError) as exc:
+                urllib.request.urlopen(url + "/other")
+            assert exc.value.code == 404
+        finally:
+            server.shutdown()
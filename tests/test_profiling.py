@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import container, profiling
+from unittest.mock import patch
+import io
+import os
+import pstats
+import tracemalloc
+
+
+def test_phase_disabled():
+    """
+    Test that phases are not profiled until the profiler is started.
+    """
+    profiler = profiling.Profiler()
+    with profiler.phase("check_repos"):
+        pass
+    assert profiler.phases == {}
+
+
+@patch.object(container.sessions, "get_session", autospec=True)
+def test_profile(get_session, tmpdir):
+    """
+    Test that each phase is profiled, dumped and reported, with the time spent
+    in each backend.
+    """
+    get_session.return_value.get.return_value.json.return_value = {
+        "tags": [],
+        "has_additional": False,
+    }
+    directory = str(tmpdir.join("profile"))
+    profiler = profiling.Profiler()
+    profiler.start(directory)
+    try:
+        with profiler.phase("state_load"):
+            data = [bytes(1024) for i in range(1024)]
+        with profiler.phase("check_repos"):
+            list(container.iter_quay_repo("quay.io/repos/test1"))
+        with profiler.phase("check_repos"):
+            list(container.iter_quay_repo("quay.io/repos/test2"))
+        profiler.dump()
+        out = io.StringIO()
+        profiler.report(out)
+    finally:
+        tracemalloc.stop()
+    del data
+    assert sorted(os.listdir(directory)) == ["check_repos.prof", "state_load.prof"]
+    stats = pstats.Stats(os.path.join(directory, "check_repos.prof"))
+    assert any(func == "iter_quay_repo" for _, _, func in stats.stats)
+    assert profiler.phases["state_load"]["peak"] >= 1024 * 1024
+    lines = out.getvalue().splitlines()
+    assert lines[0].split() == ["Phase", "Seconds", "Peak", "MiB"]
+    assert lines[1].split()[0] == "state_load"
+    assert lines[2].split()[0] == "check_repos"
+    assert lines[3].split()[0] == "quay"
+    assert "Function" in lines[5]
+    assert len(lines) > 6
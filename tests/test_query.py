@@ -0,0 +1,91 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import query, utils
+import json
+import os
+import urllib.error
+import urllib.request
+import pytest
+
+DATA = {
+    "quay.io/repos/test1": {
+        "latest": {"action": "unchanged", "digest": "sha256:1"},
+        "v1": {"action": "added", "digest": "sha256:1"},
+        "old": {"action": "removed", "digest": None, "old_digest": "sha256:0"},
+    },
+    "quay.io/repos/test2": {
+        "ignore": True,
+        "latest": {"action": "unchanged", "digest": "sha256:2"},
+    },
+}
+
+
+def test_index():
+    """
+    Test that tags, digests and repos can be looked up, without removed tags.
+    """
+    index = query.StateIndex(DATA)
+    assert sorted(index.repos) == ["quay.io/repos/test1", "quay.io/repos/test2"]
+    assert index.get_tag("quay.io/repos/test1", "latest")["digest"] == "sha256:1"
+    assert index.get_tag("quay.io/repos/test1", "old") is None
+    assert index.get_tag("quay.io/repos/other", "latest") is None
+    assert index.get_digest("sha256:1") == [
+        ("quay.io/repos/test1", "latest"),
+        ("quay.io/repos/test1", "v1"),
+    ]
+    assert index.get_digest("sha256:2") == [("quay.io/repos/test2", "latest")]
+    assert index.get_digest("sha256:0") == []
+    index.update({})
+    assert index.repos == {}
+
+
+def test_index_refresh(tmpdir):
+    """
+    Test that the index is reloaded when the state file changes.
+    """
+    path = str(tmpdir.join("data"))
+    index = query.StateIndex(path=path)
+    assert index.repos == {}
+    utils.save_data(path, DATA)
+    index.refresh()
+    assert index.get_digest("sha256:2") == [("quay.io/repos/test2", "latest")]
+    utils.save_data(path, {})
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    index.refresh()
+    assert index.repos == {}
+
+
+def test_serve():
+    """
+    Test the queries answered over HTTP.
+    """
+    server = query.serve(query.StateIndex(DATA), ("127.0.0.1", 0))
+    url = "http://127.0.0.1:{0}".format(server.server_address[1])
+
+    def get(path):
+        with urllib.request.urlopen(url + path) as resp:
+            return json.loads(resp.read())
+
+    try:
+        assert get("/repos") == ["quay.io/repos/test1", "quay.io/repos/test2"]
+        assert get("/tags?repo=quay.io/repos/test1") == {
+            "latest": "sha256:1",
+            "v1": "sha256:1",
+        }
+        assert get("/tag?repo=quay.io/repos/test2&tag=latest")["digest"] == "sha256:2"
+        assert get("/digest?digest=sha256:1") == [
+            ["quay.io/repos/test1", "latest"],
+            ["quay.io/repos/test1", "v1"],
+        ]
+        for path, code in [
+            ("/tags?repo=quay.io/repos/other", 404),
+            ("/tag?repo=quay.io/repos/test1", 400),
+            ("/unknown", 404),
+        ]:
+            with pytest.raises(urllib.error.HTTPError) as excinfo:
+                get(path)
+            assert excinfo.value.code == code
+    finally:
+        server.shutdown()
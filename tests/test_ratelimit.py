@@ -0,0 +1,141 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import ratelimit
+from unittest.mock import Mock, patch
+import pytest
+
+
+def response(status_code=200, **headers):
+    return Mock(status_code=status_code, headers=headers)
+
+
+def test_token_bucket_unlimited():
+    """
+    Test that a bucket with no rate never delays requests.
+    """
+    bucket = ratelimit.TokenBucket(clock=Mock(return_value=0))
+    assert [bucket.reserve() for i in range(100)] == [0.0] * 100
+
+
+def test_token_bucket_rate():
+    """
+    Test that requests beyond the burst size are spread out at the configured rate.
+    """
+    clock = Mock(return_value=0.0)
+    bucket = ratelimit.TokenBucket(rate=2.0, burst=2, clock=clock)
+    assert [bucket.reserve() for i in range(4)] == [0.0, 0.0, 0.5, 1.0]
+    clock.return_value = 10.0
+    # The bucket refills, but never beyond its capacity
+    assert [bucket.reserve() for i in range(3)] == [0.0, 0.0, 0.5]
+
+
+def test_token_bucket_block():
+    """
+    Test that a blocked bucket delays requests until the block expires.
+    """
+    clock = Mock(return_value=100.0)
+    bucket = ratelimit.TokenBucket(clock=clock)
+    bucket.block(30)
+    bucket.block(10)
+    assert bucket.reserve() == 30.0
+    clock.return_value = 130.0
+    assert bucket.reserve() == 0.0
+
+
+def test_limiter_acquire_sleeps():
+    """
+    Test that the limiter sleeps when a host is over its rate, and keeps statistics.
+    """
+    sleep = Mock()
+    limiter = ratelimit.RateLimiter(
+        rate=1.0, burst=1, clock=Mock(return_value=0.0), sleep=sleep
+    )
+    limiter.acquire("quay.io")
+    limiter.acquire("quay.io")
+    limiter.acquire("example.com")
+    sleep.assert_called_once_with(1.0)
+    report = limiter.report()
+    assert report["quay.io"]["requests"] == 2
+    assert report["quay.io"]["throttled"] == 1
+    assert report["quay.io"]["waited"] == 1.0
+    assert report["example.com"]["throttled"] == 0
+
+
+def test_limiter_retry_after():
+    """
+    Test that a 429 response with Retry-After blocks further requests to the host.
+    """
+    sleep = Mock()
+    limiter = ratelimit.RateLimiter(clock=Mock(return_value=0.0), sleep=sleep)
+    limiter.update("quay.io", response(429, **{"Retry-After": "20"}))
+    limiter.acquire("example.com")
+    sleep.assert_not_called()
+    limiter.acquire("quay.io")
+    sleep.assert_called_once_with(20.0)
+
+
+def test_limiter_ratelimit_headers():
+    """
+    Test that X-RateLimit headers are recorded, and an exhausted limit blocks
+    requests until it resets.
+    """
+    sleep = Mock()
+    limiter = ratelimit.RateLimiter(clock=Mock(return_value=0.0), sleep=sleep)
+    limiter.update(
+        "quay.io",
+        response(**{"X-RateLimit-Limit": "50", "X-RateLimit-Remaining": "10"}),
+    )
+    assert limiter.report()["quay.io"]["remaining"] == 10
+    limiter.acquire("quay.io")
+    sleep.assert_not_called()
+    limiter.update(
+        "quay.io",
+        response(
+            **{
+                "X-RateLimit-Limit": "50",
+                "X-RateLimit-Remaining": "0",
+                "X-RateLimit-Reset": "15",
+            }
+        ),
+    )
+    limiter.acquire("quay.io")
+    sleep.assert_called_once_with(15.0)
+    report = limiter.report()
+    assert report["quay.io"]["limit"] == 50
+    assert report["quay.io"]["remaining"] == 0
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (None, 1.0),
+        ("5", 5.0),
+        ("-5", 0.0),
+        ("Wed, 21 Oct 2015 07:28:00 GMT", 0.0),
+        ("not a date", 1.0),
+    ],
+)
+def test_parse_retry_after(value, expected):
+    assert ratelimit.parse_retry_after(value) == expected
+
+
+@patch.object(ratelimit.time, "time", return_value=1700000000)
+def test_parse_reset(time):
+    assert ratelimit.parse_reset("1700000030") == 30.0
+    assert ratelimit.parse_reset("30") == 30.0
+    assert ratelimit.parse_reset(None) == 1.0
+
+
+@patch.object(ratelimit, "limiter", new_callable=ratelimit.RateLimiter)
+def test_configure(limiter):
+    """
+    Test that the shared limiter is configured from the polling section.
+    """
+    limiter.acquire("quay.io")
+    ratelimit.configure({"polling": {"rate_limit": "5", "rate_burst": "10"}})
+    assert limiter.buckets["quay.io"].rate == 5.0
+    assert limiter.buckets["quay.io"].capacity == 10
+    ratelimit.configure({})
+    assert limiter.rate == 0.0
+    assert limiter.burst == 1
@@ -0,0 +1,121 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import runner
+from unittest.mock import patch
+import threading
+import time
+import pytest
+
+
+def shell_cmd(reporef, *args, timeout=None):
+    """
+    Run the args as a shell script instead of skopeo.
+    """
+    return ["/bin/sh", "-c", " ".join(args)]
+
+
+def test_build_cmd():
+    """
+    Test that the skopeo command has a timeout, and refers to the repo.
+    """
+    assert runner.build_cmd("quay.io/some/repo:latest", "inspect") == [
+        "/usr/bin/skopeo",
+        "--command-timeout",
+        "60s",
+        "inspect",
+        "docker://quay.io/some/repo:latest",
+    ]
+
+
+@patch.object(runner, "build_cmd", shell_cmd)
+def test_run_all():
+    """
+    Test that commands run concurrently, and their output and exit status are
+    returned in order and recorded.
+    """
+    async_runner = runner.AsyncRunner(concurrency=3)
+    start = time.monotonic()
+    procs = async_runner.run_all(
+        [
+            ("quay.io/repo:a", ("sleep 0.5; echo a",)),
+            ("quay.io/repo:b", ("sleep 0.5; echo b >&2; exit 3",)),
+            ("quay.io/repo:c", ("sleep 0.5; echo c",)),
+        ]
+    )
+    assert time.monotonic() - start < 1.4
+    assert [proc.returncode for proc in procs] == [0, 3, 0]
+    assert procs[0].stdout == "a\n"
+    assert procs[1].stderr == "b\n"
+    assert procs[2].stdout == "c\n"
+    assert len(async_runner.records) == 3
+    assert sorted(record["returncode"] for record in async_runner.records) == [0, 0, 3]
+    assert all(record["runtime"] >= 0.5 for record in async_runner.records)
+    assert not any(record["timed_out"] for record in async_runner.records)
+
+
+@patch.object(runner, "build_cmd", shell_cmd)
+def test_run_all_timeout(tmp_path):
+    """
+    Test that a command which does not complete within its deadline has its
+    whole process group killed.
+    """
+    marker = tmp_path / "marker"
+    async_runner = runner.AsyncRunner(timeout=0.5)
+    start = time.monotonic()
+    (proc,) = async_runner.run_all(
+        [("quay.io/repo:a", (f"(sleep 1; touch {marker}) & sleep 10",))]
+    )
+    assert time.monotonic() - start < 5
+    assert proc.returncode != 0
+    assert "timed out" in proc.stderr
+    assert async_runner.records[0]["timed_out"]
+    # The child of the shell was killed too
+    time.sleep(1)
+    assert not marker.exists()
+    assert not async_runner.procs
+
+
+@patch.object(runner, "build_cmd", shell_cmd)
+def test_kill_running(tmp_path):
+    """
+    Test that kill_running() kills the process groups of the commands running
+    in other threads, and stops new ones from starting.
+    """
+    marker = tmp_path / "marker"
+    async_runner = runner.AsyncRunner(timeout=30)
+    results = []
+
+    def run_all():
+        try:
+            async_runner.run_all(
+                [("quay.io/repo:a", (f"(sleep 1; touch {marker}) & sleep 10",))]
+            )
+        except runner.Terminated as exc:
+            results.append(exc)
+        else:
+            results.append(async_runner.records[0]["returncode"])
+
+    thread = threading.Thread(target=run_all)
+    thread.start()
+    try:
+        while not runner.running:
+            time.sleep(0.01)
+        start = time.monotonic()
+        runner.kill_running()
+        thread.join(5)
+        assert time.monotonic() - start < 5
+        assert results == [-9]
+        time.sleep(1)
+        assert not marker.exists()
+        assert not runner.running
+        with pytest.raises(runner.Terminated):
+            async_runner.run_all([("quay.io/repo:a", ("true",))])
+    finally:
+        runner.stopping.clear()
+
+
+def test_get_concurrency():
+    assert runner.get_concurrency({}) == 1
+    assert runner.get_concurrency({"polling": {"skopeo_concurrency": "8"}}) == 8
+    assert runner.get_concurrency({"polling": {"skopeo_concurrency": "0"}}) == 1
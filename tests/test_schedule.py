@@ -0,0 +1,77 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import schedule
+from unittest.mock import Mock
+import pytest
+
+
+def test_deadline_none():
+    """
+    Test that a deadline without a number of seconds never expires.
+    """
+    deadline = schedule.Deadline()
+    assert not deadline.expired()
+    assert deadline.remaining() is None
+    assert list(deadline.guard([1, 2, 3])) == [1, 2, 3]
+
+
+def test_deadline_expires():
+    """
+    Test that a deadline expires after the given number of seconds.
+    """
+    clock = Mock(return_value=100.0)
+    deadline = schedule.Deadline(30, clock=clock)
+    assert not deadline.expired()
+    assert deadline.remaining() == 30.0
+    clock.return_value = 130.0
+    assert deadline.expired()
+    assert deadline.remaining() == 0.0
+
+
+def test_deadline_guard():
+    """
+    Test that guard() stops generating items once the deadline has expired.
+    """
+    clock = Mock(return_value=0.0)
+    deadline = schedule.Deadline(10, clock=clock)
+
+    def items():
+        yield 1
+        clock.return_value = 10.0
+        yield 2
+
+    guarded = deadline.guard(items())
+    assert next(guarded) == 1
+    with pytest.raises(schedule.DeadlineExceeded):
+        next(guarded)
+
+
+def test_deadline_cap():
+    """
+    Test that cap() reduces timeouts to the time left before the deadline.
+    """
+    assert schedule.Deadline().cap(60.0) == 60.0
+    clock = Mock(return_value=0.0)
+    deadline = schedule.Deadline(10, clock=clock)
+    assert deadline.cap(60.0) == 10.0
+    assert deadline.cap(5.0) == 5.0
+    clock.return_value = 10.0
+    with pytest.raises(schedule.DeadlineExceeded):
+        deadline.cap(60.0)
+
+
+def test_order_sections():
+    """
+    Test that sections are ordered by priority, then least recently checked.
+    """
+    sections = [
+        ("a", {"repo": "example.com/a"}),
+        ("b", {"repo": "example.com/b", "priority": "1"}),
+        ("c", {"repo": "example.com/c"}),
+        ("d", {"repo": "example.com/d"}),
+        ("e", {"repo": "example.com/e", "priority": "-1"}),
+    ]
+    checked = {"example.com/a": 300, "example.com/b": 500, "example.com/c": 100}
+    result = schedule.order_sections(sections, checked)
+    assert [name for name, section in result] == ["b", "d", "c", "a", "e"]
@@ -0,0 +1,108 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import container, shard
+from unittest.mock import patch
+import argparse
+import pytest
+
+
+def test_parse_shard():
+    assert shard.parse_shard("0/1") == (0, 1)
+    assert shard.parse_shard("2/5") == (2, 5)
+    for value in ["5/5", "-1/5", "0/0", "1", "a/b", "1/2/3"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            shard.parse_shard(value)
+
+
+def test_get_shard_balanced():
+    """
+    Test that sections are spread over all the shards.
+    """
+    names = [f"section{i}" for i in range(1000)]
+    counts = [0] * 4
+    for name in names:
+        counts[shard.get_shard(name, 4)] += 1
+    assert all(200 < count < 300 for count in counts)
+
+
+def test_get_shard_rebalance():
+    """
+    Test that adding a shard only moves sections to the new shard.
+    """
+    names = [f"section{i}" for i in range(1000)]
+    moved = 0
+    for name in names:
+        before = shard.get_shard(name, 4)
+        after = shard.get_shard(name, 5)
+        if before != after:
+            assert after == 4
+            moved += 1
+    assert 150 < moved < 250
+
+
+def test_filter_config():
+    """
+    Test that each repo section belongs to exactly one shard, and the other
+    sections to all of them.
+    """
+    conf = {
+        "broker": {"topic_prefix": "container"},
+        "polling": {"rate_limit": "1"},
+        "ns": {"type": "namespace", "namespace": "quay.io/ns"},
+    }
+    for i in range(20):
+        conf[f"repo{i}"] = {"type": "container", "repo": f"quay.io/ns/repo{i}"}
+    shards = [shard.filter_config(conf, index, 3) for index in range(3)]
+    for filtered in shards:
+        assert filtered["broker"] == conf["broker"]
+        assert filtered["polling"] == conf["polling"]
+    sections = [name for filtered in shards for name, section in filtered.items()]
+    assert sorted(name for name in sections if name.startswith(("repo", "ns"))) == (
+        sorted(name for name in conf if name.startswith(("repo", "ns")))
+    )
+    assert sum(len(filtered.container_sections) for filtered in shards) == 20
+    # Repos on other shards are not checked again as part of the namespace
+    for filtered in shards:
+        assert len(filtered.tracked_repos) == 20
+
+
+@patch.object(
+    container, "discover_namespace", autospec=True, return_value=["quay.io/ns/a"]
+)
+def test_filter_config_namespace(discover_namespace):
+    """
+    Test that a repo with a container section on one shard is not checked by
+    the shard of the namespace it is in.
+    """
+    conf = {
+        "ns": {"type": "namespace", "namespace": "quay.io/ns"},
+        "a": {"type": "container", "repo": "quay.io/ns/a"},
+    }
+    index = shard.get_shard("ns", 2)
+    assert shard.get_shard("a", 2) != index
+    filtered = shard.filter_config(conf, index, 2)
+    assert [
+        [name for name, section in repo_sections]
+        for section, repo_sections in container.discover_namespaces(filtered, {})
+    ] == [[]]
+
+
+def test_merge_states():
+    """
+    Test that repos checked successfully take precedence when merging.
+    """
+    first = {
+        "quay.io/ns/a": {"latest": {"digest": "1"}},
+        "quay.io/ns/b": {"latest": {"digest": "2"}},
+    }
+    second = {
+        "quay.io/ns/b": {"ignore": True, "latest": {"digest": "old"}},
+        "quay.io/ns/c": {"latest": {"digest": "3"}},
+    }
+    third = {"quay.io/ns/c": {"latest": {"digest": "4"}}}
+    assert shard.merge_states([first, second, third]) == {
+        "quay.io/ns/a": {"latest": {"digest": "1"}},
+        "quay.io/ns/b": {"latest": {"digest": "2"}},
+        "quay.io/ns/c": {"latest": {"digest": "4"}},
+    }
@@ -0,0 +1,66 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import tagfilter
+
+
+def test_match_globs():
+    """
+    Test that include and exclude globs must match the whole tag.
+    """
+    tag_filter = tagfilter.TagFilter(["v*", "latest"], ["*-ci", "v0.?"])
+    assert tag_filter
+    assert tag_filter.match("latest")
+    assert tag_filter.match("v1.2")
+    assert not tag_filter.match("latest-1")
+    assert not tag_filter.match("v1.2-ci")
+    assert not tag_filter.match("v0.1")
+    assert tag_filter.match("v0.10")
+    assert not tag_filter.match("pr-123")
+
+
+def test_match_regex():
+    """
+    Test that patterns starting with re: are regular expressions.
+    """
+    tag_filter = tagfilter.TagFilter(exclude=[r"re:pr-\d+", "re:sha-[0-9a-f]{7}"])
+    assert tag_filter.match("latest")
+    assert tag_filter.match("pr-")
+    assert not tag_filter.match("pr-123")
+    assert not tag_filter.match("sha-abc1234")
+    assert tag_filter.match("sha-abc12345")
+
+
+def test_empty():
+    """
+    Test that a filter without patterns matches every tag.
+    """
+    tag_filter = tagfilter.TagFilter()
+    assert not tag_filter
+    assert tag_filter.match("anything")
+    assert tag_filter.quay_filter() is None
+
+
+def test_quay_filter():
+    """
+    Test that only a single simple include glob is sent to Quay.
+    """
+    assert tagfilter.TagFilter(["v*"]).quay_filter() == "like:v%"
+    assert tagfilter.TagFilter(["v?.*"], ["*-ci"]).quay_filter() == "like:v_.%"
+    assert tagfilter.TagFilter(["v*", "latest"]).quay_filter() is None
+    assert tagfilter.TagFilter(["re:v.*"]).quay_filter() is None
+    assert tagfilter.TagFilter(["v[0-9]*"]).quay_filter() is None
+    assert tagfilter.TagFilter(["release_*"]).quay_filter() is None
+    assert tagfilter.TagFilter(exclude=["*-ci"]).quay_filter() is None
+
+
+def test_get_filter():
+    """
+    Test that filters are read from the section, and compiled once.
+    """
+    section = {"include_tags": "v*\nlatest", "exclude_tags": "*-ci"}
+    tag_filter = tagfilter.get_filter(section)
+    assert tag_filter.include == ["v*", "latest"]
+    assert tag_filter.exclude == ["*-ci"]
+    assert tagfilter.get_filter(dict(section)) is tag_filter
+    assert not tagfilter.get_filter({})
@@ -0,0 +1,170 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import container, tracing
+import asyncio
+import json
+
+
+def test_span_disabled():
+    """
+    Test that no spans are recorded until the tracer is started.
+    """
+    tracer = tracing.Tracer()
+    with tracer.span("run"):
+        pass
+    assert tracer.spans == []
+
+
+def test_span_parents():
+    """
+    Test that spans are children of the span current when they start, in
+    their thread or task.
+    """
+    tracer = tracing.Tracer()
+    tracer.start()
+
+    def check(repo):
+        with tracer.span("check_repo", repo=repo):
+            return [repo]
+
+    async def skopeo():
+        with tracer.span("skopeo"):
+            await asyncio.sleep(0)
+
+    async def run_all():
+        await asyncio.gather(skopeo(), skopeo())
+
+    with tracer.span("run"):
+        assert list(container._iter_concurrent(check, ["a", "b"], 2)) == ["a", "b"]
+        asyncio.run(run_all())
+    with tracer.span("other"):
+        pass
+    spans = {span["id"]: span for span in tracer.spans}
+    run = [span for span in spans.values() if span["name"] == "run"][0]
+    assert run["parent"] is None
+    children = sorted(
+        (span["name"], span["attrs"].get("repo"))
+        for span in spans.values()
+        if span["parent"] == run["id"]
+    )
+    assert children == [
+        ("check_repo", "a"),
+        ("check_repo", "b"),
+        ("skopeo", None),
+        ("skopeo", None),
+    ]
+    other = [span for span in spans.values() if span["name"] == "other"][0]
+    assert other["parent"] is None
+    assert tracing.current_span.get() is None
+
+
+def test_iterate():
+    """
+    Test that a generator's span is only current while it is running, so the
+    spans of its consumer are not its children.
+    """
+    tracer = tracing.Tracer()
+
+    def generate():
+        with tracer.span("fetch_page"):
+            pass
+        yield "a"
+        with tracer.span("fetch_page"):
+            pass
+        yield "b"
+        return True
+
+    def consume():
+        result = yield from tracer.iterate("check_repo", generate(), repo="a")
+        assert result is True
+
+    assert list(consume()) == ["a", "b"]
+    assert tracer.spans == []
+    tracer.start()
+    with tracer.span("run"):
+        for value in consume():
+            assert tracing.current_span.get() is not None
+            with tracer.span("publish"):
+                pass
+    spans = {span["name"]: span for span in tracer.spans}
+    parents = sorted(
+        (span["name"], parent["name"])
+        for span in tracer.spans
+        for parent in tracer.spans
+        if span["parent"] == parent["id"]
+    )
+    assert parents == [
+        ("check_repo", "run"),
+        ("fetch_page", "check_repo"),
+        ("fetch_page", "check_repo"),
+        ("publish", "run"),
+        ("publish", "run"),
+    ]
+    assert spans["check_repo"]["attrs"] == {"repo": "a"}
+    assert tracing.current_span.get() is None
+
+
+def test_outside():
+    """
+    Test that a generator wrapped with outside() keeps the span which was
+    current when it was wrapped, while it is consumed within another span.
+    """
+    tracer = tracing.Tracer()
+    tracer.start()
+
+    def fetch():
+        with tracer.span("fetch_page"):
+            pass
+        yield "a"
+
+    def diff(tags):
+        for tag in tags:
+            yield tag
+
+    def check():
+        tags = tracer.outside(fetch())
+        yield from tracer.iterate("diff", diff(tags))
+
+    with tracer.span("check_repo"):
+        assert list(check()) == ["a"]
+    parents = sorted(
+        (span["name"], parent["name"])
+        for span in tracer.spans
+        for parent in tracer.spans
+        if span["parent"] == parent["id"]
+    )
+    assert parents == [("diff", "check_repo"), ("fetch_page", "check_repo")]
+    assert tracing.current_span.get() is None
+
+
+def test_write(tmpdir):
+    """
+    Test that spans are written as JSON lines or Chrome trace events.
+    """
+    tracer = tracing.Tracer()
+    tracer.start()
+    with tracer.span("run"):
+        with tracer.span("publish", topic="container.tag.added", messages=2):
+            pass
+    path = str(tmpdir.join("trace.jsonl"))
+    tracer.write(path)
+    with open(path) as fobj:
+        spans = [json.loads(line) for line in fobj]
+    assert [span["name"] for span in spans] == ["run", "publish"]
+    assert spans[1]["parent"] == spans[0]["id"]
+    assert spans[1]["attrs"] == {"topic": "container.tag.added", "messages": 2}
+    assert spans[0]["duration"] >= spans[1]["duration"]
+    path = str(tmpdir.join("trace.json"))
+    tracer.write(path, "chrome")
+    with open(path) as fobj:
+        events = json.load(fobj)["traceEvents"]
+    assert [event["name"] for event in events] == ["run", "publish"]
+    assert all(event["ph"] == "X" for event in events)
+    assert events[1]["args"] == {
+        "topic": "container.tag.added",
+        "messages": 2,
+        "id": spans[1]["id"],
+        "parent": spans[0]["id"],
+    }
+    assert events[0]["ts"] <= events[1]["ts"]
@@ -1,8 +1,13 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 # Copyright 2018 Mike Bonnet <mikeb@redhat.com>
 
-from repotracker import utils
+from repotracker import codec, utils
+from unittest.mock import patch
+import gzip
+import io
 import json
+import lzma
+import pytest
 
 
 def test_load_config(tmpdir):
@@ -102,7 +107,7 @@ def test_save_data(tmpdir):
         }
     }
     utils.save_data(str(data), expected)
-    assert json.dumps(expected) == data.read()
+    assert json.dumps(expected, separators=(",", ":")) == data.read()
 
 
 def test_format_ts_int():
@@ -141,3 +146,172 @@ def test_format_time_empty():
     """
     assert utils.format_time(None) is None
     assert utils.format_time("") is None
+
+
+def test_save_data_iter(tmpdir):
+    """
+    Test that data saved incrementally matches data saved all at once.
+    """
+    expected = tmpdir.join("expected")
+    data = tmpdir.join("data")
+    repos = {
+        "example.com/repos/testrepo": {
+            "latest": {"action": "added", "digest": "abc123"},
+            "stage": {"action": "unchanged", "digest": "def456"},
+        },
+        "example.com/repos/other": {
+            "ignore": True,
+            "latest": {"action": "removed", "digest": None},
+        },
+    }
+    utils.save_data(str(expected), repos)
+    utils.save_data_iter(
+        str(data),
+        (
+            (repo, tag, tagdata)
+            for repo, tags in repos.items()
+            for tag, tagdata in tags.items()
+        ),
+    )
+    assert data.read() == expected.read()
+    assert utils.load_data(str(data)) == repos
+
+
+def test_save_data_iter_empty(tmpdir):
+    """
+    Test that saving no data incrementally results in an empty dict.
+    """
+    data = tmpdir.join("data")
+    utils.save_data_iter(str(data), iter([]))
+    assert utils.load_data(str(data)) == {}
+
+
+def test_save_data_iter_error(tmpdir):
+    """
+    Test that an error while generating data leaves the existing file untouched.
+    """
+    data = tmpdir.join("data")
+    data.write('{"foo": {}}')
+
+    def items():
+        yield "example.com/repos/testrepo", "latest", {"action": "added"}
+        raise RuntimeError("could not query repo")
+
+    with pytest.raises(RuntimeError):
+        utils.save_data_iter(str(data), items())
+    assert data.read() == '{"foo": {}}'
+    assert tmpdir.listdir() == [data]
+
+
+COMPRESSED_DATA = {
+    "example.com/repos/testrepo": {
+        "latest": {
+            "action": "added",
+            "repo": "example.com/repos/testrepo",
+            "tag": "latest",
+            "digest": "abc123",
+            "old_digest": None,
+            "labels": {"description": "Ünïcödé ☃", "size": 12345},
+        },
+        "ignore": True,
+    },
+    "example.com/repos/empty": {},
+    "example.com/repos/other": {
+        "stage": {"action": "removed", "digest": None, "labels": {}},
+    },
+}
+
+
+@pytest.mark.parametrize("ext", [".gz", ".xz"])
+def test_save_load_compressed(tmpdir, ext):
+    """
+    Test that data can be saved to and loaded from a compressed file.
+    """
+    data = tmpdir.join("data.json" + ext)
+    utils.save_data(str(data), COMPRESSED_DATA)
+    opener = gzip.open if ext == ".gz" else lzma.open
+    with opener(str(data), "rb") as fobj:
+        assert fobj.read() == codec.dumps(COMPRESSED_DATA)
+    assert utils.load_data(str(data)) == COMPRESSED_DATA
+
+
+def test_save_load_zstd(tmpdir):
+    """
+    Test that data can be saved to and loaded from a zstd compressed file.
+    """
+    pytest.importorskip("zstandard")
+    data = tmpdir.join("data.json.zst")
+    utils.save_data(str(data), COMPRESSED_DATA)
+    assert utils.load_data(str(data)) == COMPRESSED_DATA
+
+
+@patch.object(utils, "zstandard", new=None)
+def test_save_zstd_missing(tmpdir):
+    """
+    Test that a helpful error is raised when zstandard is not installed.
+    """
+    data = tmpdir.join("data.json.zst")
+    with pytest.raises(RuntimeError, match="zstandard module is required"):
+        utils.save_data(str(data), COMPRESSED_DATA)
+    assert tmpdir.listdir() == []
+
+
+def test_save_data_iter_compressed(tmpdir):
+    """
+    Test that data saved incrementally can be compressed.
+    """
+    data = tmpdir.join("data.json.gz")
+    items = [
+        ("repo1", "latest", {"action": "added"}),
+        ("repo1", "stage", {"action": "unchanged"}),
+        ("repo2", "ignore", True),
+    ]
+    utils.save_data_iter(str(data), iter(items))
+    assert utils.load_data(str(data)) == {
+        "repo1": {"latest": {"action": "added"}, "stage": {"action": "unchanged"}},
+        "repo2": {"ignore": True},
+    }
+
+
+@patch.object(utils._JSONReader, "CHUNK_SIZE", new=3)
+def test_iter_data_small_chunks():
+    """
+    Test that values split across chunks, including multi-byte characters and
+    numbers, are decoded correctly, regardless of whitespace.
+    """
+    raw = json.dumps(COMPRESSED_DATA, ensure_ascii=False, indent=4).encode("utf-8")
+    result = {repo: dict(tags) for repo, tags in utils.iter_data(io.BytesIO(raw))}
+    assert result == COMPRESSED_DATA
+
+
+def test_iter_data_unconsumed():
+    """
+    Test that tags which are not consumed by the caller are skipped.
+    """
+    raw = codec.dumps(COMPRESSED_DATA)
+    repos = [repo for repo, tags in utils.iter_data(io.BytesIO(raw))]
+    assert repos == list(COMPRESSED_DATA)
+
+
+@pytest.mark.parametrize(
+    "raw", [b"[]", b'{"repo": []}', b'{"repo": {"tag": 1} "other": {}}', b"{} {}"]
+)
+def test_iter_data_invalid(raw):
+    """
+    Test that invalid data raises an error.
+    """
+    with pytest.raises(ValueError):
+        for repo, tags in utils.iter_data(io.BytesIO(raw)):
+            list(tags)
+
+
+def test_parse_bool():
+    """
+    Test that boolean config values are parsed like ConfigParser.getboolean().
+    """
+    assert utils.parse_bool("Yes") is True
+    assert utils.parse_bool("on") is True
+    assert utils.parse_bool("0") is False
+    assert utils.parse_bool(False) is False
+    with pytest.raises(ValueError):
+        utils.parse_bool("maybe")
@@ -0,0 +1,209 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright 2018 Mike Bonnet <mikeb@redhat.com>
+
+from repotracker import workqueue
+from unittest.mock import Mock, patch
+import threading
+
+CONF = {
+    "broker": {"topic_prefix": "container"},
+    "polling": {"rate_limit": "1"},
+    "test1": {"type": "container", "repo": "example.com/repos/test1"},
+    "test2": {"type": "container", "repo": "example.com/repos/test2"},
+}
+
+
+def test_claim_lease():
+    """
+    Test that a job is claimed by one worker at a time, until its lease expires.
+    """
+    clock = Mock(return_value=1000.0)
+    queue = workqueue.WorkQueue(":memory:", lease=60, clock=clock)
+    queue.enqueue([("test1", CONF["test1"])], {})
+    job = queue.claim("worker1")
+    assert job == ("test1", CONF["test1"], {})
+    assert queue.claim("worker2") is None
+    clock.return_value = 1050.0
+    assert queue.heartbeat(job, "worker1")
+    clock.return_value = 1100.0
+    assert queue.claim("worker2") is None
+    clock.return_value = 1111.0
+    assert queue.claim("worker2") == job
+    # worker1 lost the lease, its result is discarded
+    assert not queue.heartbeat(job, "worker1")
+    assert not queue.complete(job, "worker1", {"example.com/repos/test1": {}})
+    assert queue.complete(job, "worker2", {"example.com/repos/test1": {"a": 1}})
+    assert queue.counts() == {"done": 1}
+    assert list(queue.results()) == [(job, {"example.com/repos/test1": {"a": 1}})]
+
+
+def test_fail():
+    """
+    Test that a failed job is retried until it has been attempted max_attempts
+    times.
+    """
+    queue = workqueue.WorkQueue(":memory:", max_attempts=2)
+    queue.enqueue([("test1", CONF["test1"])], {})
+    job = queue.claim("worker")
+    queue.fail(job, "worker")
+    assert queue.counts() == {"pending": 1}
+    job = queue.claim("worker")
+    queue.fail(job, "worker")
+    assert queue.counts() == {"failed": 1}
+    assert queue.claim("worker") is None
+
+
+def test_get_job_conf():
+    job = workqueue.Job("test2", CONF["test2"], {})
+    assert workqueue.get_job_conf(CONF, job) == {
+        "broker": CONF["broker"],
+        "polling": CONF["polling"],
+        "test2": CONF["test2"],
+    }
+
+
+@patch.object(workqueue.container, "check_repos", autospec=True)
+def test_check_repos(check_repos):
+    """
+    Test that each repo section is run as a job, and the results are combined.
+    Repos of jobs which failed keep their previous data.
+    """
+
+    def check(conf, data, **options):
+        repo = conf.get("test1", {}).get("repo")
+        if repo is None:
+            raise RuntimeError("failed")
+        return {repo: {"latest": {"action": "added"}}}
+
+    check_repos.side_effect = check
+    data = {"example.com/repos/test2": {"latest": {"action": "unchanged"}}}
+    queue = workqueue.WorkQueue(":memory:")
+    result = workqueue.check_repos(queue, CONF, data, worker="worker")
+    assert check_repos.call_count == 4
+    # Each job is compared against the state of its own repos
+    assert [call.args[1] for call in check_repos.call_args_list] == [{}] + [data] * 3
+    assert result == {
+        "example.com/repos/test1": {"latest": {"action": "added"}},
+        "example.com/repos/test2": {
+            "ignore": True,
+            "latest": {"action": "unchanged"},
+        },
+    }
+    assert queue.counts() == {"done": 1, "failed": 1}
+
+
+def test_enqueue_previous():
+    """
+    Test that the previous state of the repos of each section is stored with
+    its job, so workers do not need the state file.
+    """
+    data = {
+        "example.com/repos/test1": {"latest": {"action": "unchanged"}},
+        "quay.io/ns/a": {"latest": {"action": "added"}},
+        "quay.io/other/b": {"latest": {"action": "added"}},
+    }
+    queue = workqueue.WorkQueue(":memory:")
+    queue.enqueue(
+        [
+            ("test1", CONF["test1"]),
+            ("test2", CONF["test2"]),
+            ("ns", {"type": "namespace", "namespace": "quay.io/ns/"}),
+        ],
+        data,
+    )
+    assert [queue.claim("worker").previous for i in range(3)] == [
+        {"example.com/repos/test1": data["example.com/repos/test1"]},
+        {},
+        {"quay.io/ns/a": data["quay.io/ns/a"]},
+    ]
+
+
+@patch.object(workqueue.container, "check_repos", autospec=True, return_value={})
+def test_run_worker_wait(check_repos, tmpdir):
+    """
+    Test that a worker waits for jobs to be queued, and exits once no jobs have
+    been queued for the wait.
+    """
+    path = str(tmpdir.join("queue.db"))
+    queue = workqueue.WorkQueue(path)
+    queue.enqueue([("test1", CONF["test1"])], {})
+    queue.complete(queue.claim("old"), "old", {})
+    counts = []
+
+    def work():
+        worker_queue = workqueue.WorkQueue(path)
+        counts.append(
+            workqueue.run_worker(
+                worker_queue, CONF, worker="worker", poll_interval=0.01, wait=1
+            )
+        )
+        worker_queue.close()
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    queue.enqueue([("test2", CONF["test2"])], {})
+    while queue.counts() != {"done": 1}:
+        thread.join(0.01)
+    check_repos.assert_called_once()
+    assert thread.is_alive()
+    thread.join()
+    assert counts == [1]
+    # Without a wait, a worker exits when there is nothing to claim
+    assert workqueue.run_worker(queue, CONF, worker="worker") == 0
+
+
+@patch.object(
+    workqueue.container,
+    "discover_namespace",
+    autospec=True,
+    return_value=["example.com/repos/c", "example.com/repos/test1"],
+)
+@patch.object(workqueue.container, "list_tags", autospec=True, return_value=["a"])
+@patch.object(
+    workqueue.container, "inspect_tag", autospec=True, return_value={"Digest": "1"}
+)
+def test_check_repos_namespace_overlap(inspect_tag, list_tags, discover_namespace):
+    """
+    Test that the repos of a namespace which have a container section of their
+    own are only checked by the job of that section.
+    """
+    conf = dict(
+        CONF,
+        quayrepos={"detect": "false"},
+        ns={"type": "namespace", "namespace": "example.com/repos"},
+    )
+    queue = workqueue.WorkQueue(":memory:")
+    result = workqueue.check_repos(queue, conf, {}, worker="worker")
+    assert sorted(call.args[0] for call in list_tags.call_args_list) == [
+        "example.com/repos/c",
+        "example.com/repos/test1",
+        "example.com/repos/test2",
+    ]
+    assert sorted(result) == [
+        "example.com/repos/c",
+        "example.com/repos/test1",
+        "example.com/repos/test2",
+    ]
+
+
+def test_collect_failed_namespace():
+    """
+    Test that a failed namespace job does not replace the result of a repo
+    checked by its own job.
+    """
+    data = {"example.com/repos/test1": {"latest": {"action": "unchanged"}}}
+    queue = workqueue.WorkQueue(":memory:")
+    queue.enqueue(
+        [
+            ("test1", CONF["test1"]),
+            ("ns", {"type": "namespace", "namespace": "example.com/repos"}),
+        ],
+        data,
+    )
+    job = queue.claim("worker")
+    result = {"example.com/repos/test1": {"latest": {"action": "updated"}}}
+    queue.complete(job, "worker", result)
+    job = queue.claim("worker")
+    queue.max_attempts = 1
+    queue.fail(job, "worker")
+    assert workqueue.collect(queue, data) == result